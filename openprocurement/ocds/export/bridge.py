@@ -2,13 +2,19 @@ import logging
 import gevent
 import gevent.pool
 import jsonpatch
-from requests.exceptions import HTTPError
+from requests.exceptions import RequestException
+from time import time
 from functools import partial
-from gevent.queue import Queue
+from collections import deque
+from gevent.queue import Empty, Queue
 from .feed import APIRetreiver
 from .contrib.client import APIClient
 from .storage import TendersStorage
-from .helpers import exists_or_modified
+from .index import ModifiedIndex
+from .bulk import BulkWriter
+from .control import FetchController
+from .history import LatestStates, compact, latest, stub_attachments
+from .checkpoint import Checkpoint
 
 
 logger = logging.getLogger(__name__)
@@ -24,98 +30,245 @@ class APIDataBridge(object):
         self._db = TendersStorage(config['tenders_db']['url'],
                                   config['tenders_db']['name'])
 
+        self.index = ModifiedIndex(self._db)
         self.tenders_queue = Queue(maxsize=500)
+        self.fetch_queue = Queue(maxsize=config.get('fetch_queue_size', 1000))
+        self.in_flight = self.fetched = 0
+        self.latencies = deque(maxlen=1000)
+        self.fetchers = {}
         self.historical = config.get('historical', False)
         self.retreiver = APIRetreiver(
             config['api'],
-            filter_callback=partial(exists_or_modified, self._db)
+            filter_callback=self.index.filter,
+            checkpoint=Checkpoint(config.get('feed_checkpoint', 'feed.json'))
         )
+        self.controller = FetchController(self.fetch_queue,
+                                          self.tenders_queue,
+                                          **config.get('fetch') or {})
+        self.retreiver.pause = self.controller.pause
         self.client = APIClient(
             config['api']['api_key'],
             config['api']['api_host'],
             config['api']['api_version'],
-            historical=self.historical
+            historical=self.historical,
+            on_response=self.controller.observe
         )
 
-        self.fetch_pool = gevent.pool.Pool(20)
+        self.revision_concurrency = config.get('revision_concurrency', 5)
+        self.revision_retries = config.get('revision_retries', 3)
+        self.revision_backoff = config.get('revision_backoff', 0.5)
+        self.compact_every = config.get('compact_every', 100)
+        self.latest = LatestStates(config.get('latest_states', 1000))
+        self.revisions = self.revisions_retried = 0
+        # ids of tenders failed to fetch, queued again once the feed is read
+        self.skipped_checkpoint = Checkpoint(
+            config.get('skipped_checkpoint', 'skipped.json'))
+        self.skipped = set(self.skipped_checkpoint.load().get('ids', []))
+        self.saved_skipped = set(self.skipped)
+        self.retrying = set()
+        self.started = time()
+        self.writer = BulkWriter(self._db, self.tenders_queue,
+                                 prepare=self.prepare_item,
+                                 on_saved=self.saved,
+                                 on_failed=self.latest.discard,
+                                 on_done=self.stored_item,
+                                 **config.get('bulk_save') or {})
 
-    def prepare_pached(self, tenders, version, first=True):
-        if first:
-            first_tender = tenders[0]
+    def stored(self, tender_id):
+        """stored document and latest state of a historical tender"""
+        entry = self.latest.get(tender_id)
+        if entry is None:
+            doc = self._db.get(tender_id)
+            # replayed from the latest snapshot only
+            entry = doc, latest(doc)
+            self.latest.put(*entry)
+        return entry
+
+    def done(self, page):
+        """marks an item of a feed `page` as stored or skipped"""
+        if page is not None:
+            self.retreiver.done(page)
+
+    def stored_item(self, item):
+        page, tender = item
+        self.done(page)
+
+    def saved(self, doc):
+        self.index.update(doc)
+        if self.historical:
+            stub_attachments(doc)
+
+    def prepare_pached(self, tenders, version, stored=None):
+        if stored is None:
+            origin = tenders[0].copy()
+            current = tenders[0]
             tenders = tenders[1:]
         else:
-            first_tender = self._db.get(tenders[0].get('id'))
-        origin = first_tender.copy()
-        patches = first_tender.pop('patches', [])
-        if patches:
-            for patch in patches:
-                first_tender = jsonpatch.apply_patch(first_tender, patch)
+            origin, current = stored
+            origin = origin.copy()
+        patches = list(origin.get('patches') or [])
         for tender in tenders:
             if not tender:
                 continue
-            patch = jsonpatch.make_patch(first_tender, tender).patch
+            patch = jsonpatch.make_patch(current, tender).patch
             if patch:
                 patches.append(patch)
-            first_tender = tender
+            current = tender
         origin['patches'] = patches
         origin['version'] = version
         origin['_id'] = origin['id']
+        origin = compact(origin, self.compact_every)
+        self.latest.put(origin, current)
         return origin
 
+    def fetch_revision(self, tender_id, revision):
+        """revision `revision` of a tender, None if it failed to come"""
+        for attempt in range(self.revision_retries + 1):
+            try:
+                version, tender = self.get_tender(tender_id, str(revision))
+            except (RequestException, ValueError) as e:
+                logger.warn('Failed to get tender id={} revision {}: {}'.format(
+                    tender_id, revision, e))
+                version = None
+            if version == str(revision):
+                self.revisions += 1
+                return tender
+            self.revisions_retried += 1
+            gevent.sleep(self.revision_backoff * 2 ** attempt)
+        logger.error('Failed to get tender id={} revision {}'.format(
+            tender_id, revision))
+
     def fetch_tender_versioned(self, feed_item):
+        """the tender with its history, None if it failed to come"""
         _id = feed_item['id']
-        version, tender = self.client.get_tender(_id)
+        version, tender = self.get_tender(_id)
+        if not version:
+            logger.error('Failed to get tender id={}'.format(_id))
+            return
         logger.info('Got tender id={}, version={}'.format(tender['id'], version))
-        last_date_modified = self._db.view('tenders/by_dateModified', key=tender['id']).rows
-        first = False if last_date_modified else True
-        last_version = 1 if first else self._db.get(_id).get('version')
-        try:
-            revisions = []
-            for i in range(int(last_version), int(version)):
-                try:
-                    gversion, tender = self.client.get_tender(_id, str(i))
-                except:
-                    break
-                if gversion == str(i):
-                    logger.info('Got tender id={} revision {}'.format(_id, i))
-                    revisions.append(tender)
-            revisions.append(tender)
-        except HTTPError:
-            logger.fatal("Falied to retreive tender id={} \n"
-                         "version {}".format(tender['id'], version))
-        logger.info('Finishing fetching revisions of {}'.format(_id))
-        self.tenders_queue.put(self.prepare_pached(revisions, version,
-                                                   first=first))
+        stored = None if self.index.get(_id) is None else self.stored(_id)
+        last_version = 1 if stored is None else stored[0].get('version')
+        started = time()
+        pool = gevent.pool.Pool(self.revision_concurrency)
+        revisions = pool.map(partial(self.fetch_revision, _id),
+                             range(int(last_version), int(version)))
+        missing = revisions.count(None)
+        if missing:
+            # fetched again later rather than saved with a gap in history
+            logger.error('Skipping tender id={}: {} of its revisions'
+                         ' failed'.format(_id, missing))
+            return
+        revisions.append(tender)
+        logger.info('Fetched {} revisions of {} in {:.1f}s'.format(
+            len(revisions), _id, time() - started))
+        return self.prepare_pached(revisions, version, stored)
+
+    def report_revisions(self):
+        logger.info('Revisions: {} fetched, {} retried, {:.1f} per second'.format(
+            self.revisions, self.revisions_retried,
+            self.revisions / (time() - self.started)))
+
+    def prepare_item(self, entry):
+        page, item = entry
+        item['doc_type'] = 'Tender'
+        item['_id'] = item['id']
+        return item
 
     def save_items(self):
         logger.info('Start saving')
+        self.writer.run()
+
+    def get_tender(self, tender_id, version=''):
+        self.controller.throttle()
+        return self.client.get_tender(tender_id, version)
+
+    def fetch_item(self, page, feed_item):
+        """queues the tender of `feed_item` read from `page` for saving"""
+        self.in_flight += 1
+        started = time()
+        tender = None
+        try:
+            if self.historical:
+                tender = self.fetch_tender_versioned(feed_item)
+            else:
+                version, tender = self.get_tender(feed_item['id'])
+            self.fetched += 1
+        except Exception as e:
+            logger.error('Failed to fetch tender id={}: {}'.format(
+                feed_item['id'], e))
+        finally:
+            self.in_flight -= 1
+            self.latencies.append(time() - started)
+        self.retrying.discard(feed_item['id'])
+        if tender:
+            self.skipped.discard(feed_item['id'])
+            self.tenders_queue.put((page, tender))
+        else:
+            self.skipped.add(feed_item['id'])
+            self.done(page)
+
+    def retry_skipped(self):
+        """queues the tenders skipped so far to be fetched again"""
+        retried = self.skipped - self.retrying
+        if retried:
+            logger.info('Retrying {} skipped tenders'.format(len(retried)))
+        for tender_id in retried:
+            self.retrying.add(tender_id)
+            self.fetch_queue.put((None, {'id': tender_id}))
+
+    def save_skipped(self):
+        if self.skipped != self.saved_skipped:
+            self.skipped_checkpoint.save({'ids': sorted(self.skipped)})
+            self.saved_skipped = set(self.skipped)
+
+    def fetch_worker(self, number):
+        """fetches queued feed items while there are more than `number` workers"""
+        while number < self.controller.workers:
+            try:
+                page, feed_item = self.fetch_queue.get(timeout=1)
+            except Empty:
+                continue
+            self.fetch_item(page, feed_item)
+
+    def fetch_workers(self):
+        """keeps as many workers as the controller decided running"""
         while True:
-            for item in self.tenders_queue:
-                if item['id'] in self._db:
-                    doc = self._db.get(item['id'])
-                    item['_rev'] = doc['_rev']
-                item['doc_type'] = 'Tender'
-                item['_id'] = item['id']
-                self._db.save(item)
-                logger.info('Saved doc {}'.format(item['id']))
+            for number in range(self.controller.workers):
+                worker = self.fetchers.get(number)
+                if worker is None or worker.dead:
+                    self.fetchers[number] = gevent.spawn(self.fetch_worker, number)
+            # skipped tenders are kept before the feed moves past them
+            self.save_skipped()
+            self.retreiver.commit()
             gevent.sleep(1)
 
+    def report_fetch(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+        logger.info('Fetch: {} tenders fetched, {} in flight, {} queued,'
+                    ' latency p50 {:.2f}s p95 {:.2f}s p99 {:.2f}s'.format(
+                        self.fetched, self.in_flight, self.fetch_queue.qsize(),
+                        percentile(0.5), percentile(0.95), percentile(0.99)))
+
     def fetch_tenders(self):
         logger.info('Starting downloading tenders')
         while True:
             for feed in self.retreiver:
                 if not feed:
+                    self.index.report()
+                    self.report_fetch()
+                    if self.historical:
+                        self.report_revisions()
+                        logger.info('Latest states: {} hits, {} misses'.format(
+                            self.latest.hits, self.latest.misses))
+                    self.retry_skipped()
                     break
-                if self.historical:
-                    self.fetch_pool.map(self.fetch_tender_versioned, feed)
-                    continue
-                else:
-                    tenders = self.fetch_pool.map(self.client.get_tender, [x['id'] for x in feed])
-                if tenders:
-                    logger.info('Fetched {} tenders'.format(len(tenders)))
-                    for t in tenders:
-                        if t[1]:
-                            self.tenders_queue.put(t[1])
+                for feed_item in feed:
+                    self.fetch_queue.put((feed, feed_item))
             gevent.sleep(0.5)
 
     def _restart(self, gr):
@@ -123,16 +276,21 @@ class APIDataBridge(object):
             g.kill()
         self.jobs = [
             gevent.spawn(self.fetch_tenders),
-            gevent.spawn(self.save_items)
+            gevent.spawn(self.fetch_workers),
+            gevent.spawn(self.save_items),
+            gevent.spawn(self.controller.run)
         ]
         for j in self.jobs:
             j.link_exception(self._restart)
 
     def run(self):
+        self.index.load()
         while True:
             self.jobs = [
                 gevent.spawn(self.fetch_tenders),
-                gevent.spawn(self.save_items)
+                gevent.spawn(self.fetch_workers),
+                gevent.spawn(self.save_items),
+                gevent.spawn(self.controller.run)
             ]
             for j in self.jobs:
                 j.link_exception(self._restart)
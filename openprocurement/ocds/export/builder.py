@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""Incremental releases of historical tenders.
+
+Consecutive revisions of a tender differ in a few fields, yet building
+each release from scratch converts and diffs the whole tender again.
+`ReleaseBuilder` looks at the paths touched by a patch, converts only
+the release sections built from them (down to a single award or
+contract) and diffs only those sections against the previous release.
+Unchanged sections are shared between consecutive releases.
+"""
+from itertools import izip
+from openprocurement.ocds.export.compiler import compile_model
+from openprocurement.ocds.export.replay import replay_patches
+from openprocurement.ocds.export.helpers import (
+    release_id,
+    release_tags,
+    release_update_tags
+)
+
+
+def _unescape(token):
+    return token.replace('~1', '/').replace('~0', '~')
+
+
+def changed_paths(patch):
+    """yields (field, index) of tender fields touched by `patch`
+
+    `index` is the position in a list field when the change happens
+    inside a single element of it, None otherwise.
+    """
+    for op in patch:
+        for path in (op.get('path'), op.get('from')):
+            if path is None:
+                continue
+            tokens = [_unescape(t) for t in path.split('/')[1:]]
+            if not tokens:
+                yield None, None
+                continue
+            index = None
+            if len(tokens) > 2 or (len(tokens) == 2 and op['op'] == 'replace'):
+                if tokens[1].isdigit():
+                    index = int(tokens[1])
+            yield tokens[0], index
+
+
+def changed_sections(previous, release):
+    """top level fields of `release` which are not shared with `previous`"""
+    return [
+        k for k in set(previous) | set(release)
+        if k not in ('id', 'tag') and previous.get(k) is not release.get(k)
+    ]
+
+
+def update_tags(previous, release, sections):
+    """`release_update_tags` limited to fields not shared with `previous`"""
+    changed = changed_sections(previous, release)
+    return release_update_tags(
+        {k: previous[k] for k in changed if k in previous},
+        {k: release[k] for k in changed if k in release},
+        sections
+    )
+
+
+class ReleaseBuilder(object):
+    """Builds releases for consecutive revisions of a tender
+
+    `sources` maps release sections to the tender fields they are built
+    from. Sections missing from it are built from all tender fields but
+    `excludes`. The first release is built from scratch with `build`,
+    following revisions go through `update`.
+    """
+
+    def __init__(self, klass, models_map, callbacks, prefix,
+                 sections, sources, excludes=()):
+        self.klass = klass
+        self.models_map = models_map
+        self.callbacks = callbacks
+        self.prefix = prefix
+        self.sections = sections
+        self.sources = sources
+        self.excludes = frozenset(excludes)
+        self.models = [k for k in klass.__slots__ if k in models_map]
+        self.scalars = [k for k in klass.__slots__ if k not in models_map]
+        self.release = None
+        self.revision = 0
+        self._digests = {}
+
+    def depends(self, section, field):
+        if field is None:
+            return True
+        if section in self.sources:
+            return field in self.sources[section]
+        return field not in self.excludes
+
+    def build(self, tender):
+        release = compile_model(self.klass, self.models_map, self.callbacks)(
+            tender, self.prefix
+        )
+        release['tag'] = list(set(release_tags(release, self.sections)))
+        self.revision = 0
+        self._digests = {}
+        release['id'] = release_id(release, self.revision, self._digests)
+        self.release = release
+        return release
+
+    def convert_items(self, tender, section, indexes):
+        """converts elements of list `section` at `indexes` only"""
+        previous = self.release.get(section)
+        if section in self.callbacks:
+            data = self.callbacks[section](tender)
+        else:
+            data = tender.get(section) if section in tender else None
+        if not data or not previous or len(data) != len(previous) or \
+                max(indexes) >= len(data):
+            return
+        klass = self.models_map[section][0]
+        convert = compile_model(klass, self.models_map, self.callbacks)
+        items = list(previous)
+        for index in indexes:
+            items[index] = convert(data[index])
+        return items
+
+    def update(self, tender, patch):
+        """Returns the release of `tender` after applying `patch`
+
+        A release is made for every revision, the ones not changing the
+        release get no tags.
+        """
+        touched = {}
+        for field, index in changed_paths(patch):
+            touched.setdefault(field, set()).add(index)
+        rebuild = set(self.scalars)
+        partial = {}
+        for section in self.models:
+            fields = [f for f in touched if self.depends(section, f)]
+            if not fields:
+                continue
+            if fields == [section] and None not in touched[section] and \
+                    isinstance(self.models_map[section][1], list):
+                partial[section] = touched[section]
+            else:
+                rebuild.add(section)
+        for section, indexes in partial.items():
+            items = self.convert_items(tender, section, indexes)
+            if items is None:
+                rebuild.add(section)
+                del partial[section]
+            else:
+                partial[section] = items
+
+        data = compile_model(self.klass, self.models_map, self.callbacks,
+                             only=rebuild)(tender, self.prefix)
+        release = {
+            k: v for k, v in self.release.iteritems() if k not in rebuild
+        }
+        release.update(data)
+        release.update(partial)
+
+        previous = self.release
+        self.release = release
+        self.revision += 1
+        release['tag'] = update_tags(previous, release, self.sections)
+        release['id'] = release_id(release, self.revision, self._digests)
+        return release
+
+
+def iter_releases(builder, tender, patches):
+    """yields releases of `tender` and its `patches` made with `builder`"""
+    yield builder.build(tender)
+    for patch, tender in izip(patches, replay_patches(tender, patches)):
+        yield builder.update(tender, patch)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""Batched saving of documents with `_bulk_docs`.
+
+Documents read from a queue are gathered into batches of at most
+`max_docs` documents and `max_bytes` of JSON, and a batch is written
+at the latest `interval` seconds after its first document was read.
+Revisions of stored documents come from a cache of the revisions
+written so far, the others are read with one `_all_docs` request per
+batch. Documents failing with a conflict are written again with their
+revision read anew. Each item read from the queue is passed to
+`on_done` once its batch is written, whether it was saved, failed or
+replaced by a later document of the same id.
+"""
+import logging
+from time import time
+from collections import OrderedDict
+from gevent.queue import Empty
+from simplejson import dumps
+from couchdb.http import ResourceConflict
+
+
+logger = logging.getLogger(__name__)
+
+
+class BulkWriter(object):
+    """saves documents from `queue` to `db` in batches"""
+
+    def __init__(self, db, queue, prepare=None, on_saved=None, on_failed=None,
+                 on_done=None, max_docs=100, max_bytes=8 * 1024 ** 2, interval=1.0,
+                 retries=3, cache_size=100000):
+        self.db = db
+        self.queue = queue
+        self.prepare = prepare
+        self.on_saved = on_saved
+        self.on_failed = on_failed
+        self.on_done = on_done
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.retries = retries
+        self.cache_size = cache_size
+        self.revs = OrderedDict()
+        self.batches = self.saved = self.conflicts = self.failed = 0
+        self.lookups = 0
+        # items of the batch being written
+        self.items = []
+
+    def _cache(self, doc_id, rev):
+        self.revs.pop(doc_id, None)
+        self.revs[doc_id] = rev
+        if len(self.revs) > self.cache_size:
+            self.revs.popitem(last=False)
+
+    def batch(self):
+        """documents read within `interval`, the latest of each id"""
+        docs = OrderedDict()
+        size = 0
+        deadline = None
+        while len(docs) < self.max_docs and size < self.max_bytes:
+            timeout = None if deadline is None else max(0, deadline - time())
+            try:
+                doc = self.queue.get(timeout=timeout)
+            except Empty:
+                break
+            if deadline is None:
+                deadline = time() + self.interval
+            self.items.append(doc)
+            if self.prepare:
+                doc = self.prepare(doc)
+            docs.pop(doc['_id'], None)
+            docs[doc['_id']] = doc
+            size += len(dumps(doc))
+        return docs.values()
+
+    def _resolve(self, docs):
+        unknown = [doc['_id'] for doc in docs if doc['_id'] not in self.revs]
+        if not unknown:
+            return
+        self.lookups += 1
+        for row in self.db.view('_all_docs', keys=unknown):
+            if row.value and not row.value.get('deleted'):
+                self._cache(row.key, row.value['rev'])
+
+    def _fail(self, doc):
+        self.failed += 1
+        if self.on_failed:
+            self.on_failed(doc)
+
+    def write(self, docs):
+        for attempt in range(self.retries + 1):
+            self._resolve(docs)
+            for doc in docs:
+                if doc['_id'] in self.revs:
+                    doc['_rev'] = self.revs[doc['_id']]
+                else:
+                    doc.pop('_rev', None)
+            conflicts = []
+            for doc, (success, doc_id, result) in zip(docs, self.db.update(docs)):
+                if success:
+                    self._cache(doc_id, result)
+                    self.saved += 1
+                    if self.on_saved:
+                        self.on_saved(doc)
+                elif isinstance(result, ResourceConflict):
+                    self.revs.pop(doc_id, None)
+                    conflicts.append(doc)
+                else:
+                    self._fail(doc)
+                    logger.error('Failed to save doc {}: {}'.format(doc_id, result))
+            if not conflicts:
+                break
+            self.conflicts += len(conflicts)
+            docs = conflicts
+        else:
+            for doc in docs:
+                self._fail(doc)
+            logger.error('Failed to save docs {} after {} conflicts'.format(
+                ', '.join(doc['_id'] for doc in docs), self.retries + 1))
+
+    def run(self):
+        while True:
+            docs = self.batch()
+            if not docs:
+                continue
+            self.batches += 1
+            try:
+                self.write(docs)
+            finally:
+                items, self.items = self.items, []
+                if self.on_done:
+                    for item in items:
+                        self.on_done(item)
+            logger.info('Saved batch of {} docs, {} saved in {} batches,'
+                        ' {} conflicts, {} failed'.format(
+                            len(docs), self.saved, self.batches,
+                            self.conflicts, self.failed))
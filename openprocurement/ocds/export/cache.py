@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""On-disk cache of serialized releases.
+
+Most tenders do not change between two runs of `packages`. The cache
+keeps the canonical and extension releases (or records) of each tender
+serialized in a sqlite database, keyed by tender id and kind of output,
+and valid for the `dateModified` (of the tender and its contracts), the
+revisions of historical tenders and the code version they were built
+with.
+Cached releases are inserted into packages as `RawJSON`, so hits are
+neither converted nor serialized again.
+"""
+import os
+import sqlite3
+import logging
+from time import time
+from hashlib import md5
+from simplejson import dumps, RawJSON
+from openprocurement.ocds.export.history import snapshot_revision
+
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS releases (
+    tender_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    date_modified TEXT NOT NULL,
+    version TEXT NOT NULL,
+    canonical BLOB NOT NULL,
+    extension BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL,
+    PRIMARY KEY (tender_id, kind)
+)
+"""
+# compact JSON never contains raw newlines
+SEPARATOR = '\n'
+
+
+def code_version(modules, *extra):
+    """digest of the sources of `modules` and of `extra` settings"""
+    digest = md5()
+    for module in modules:
+        path = module.__file__
+        if path.endswith(('.pyc', '.pyo')) and os.path.exists(path[:-1]):
+            path = path[:-1]
+        with open(path, 'rb') as stream:
+            digest.update(stream.read())
+    for value in extra:
+        digest.update(repr(value))
+    return digest.hexdigest()
+
+
+def modified(tender):
+    """`dateModified` of `tender` and of the contracts joined to it
+
+    Historical tenders keep `dateModified` of their first revision, so
+    their version and number of revisions (the patches along with the
+    ones compacted before the snapshot) are part of the stamp as well.
+    """
+    stamps = [tender.get('dateModified', '')]
+    if 'patches' in tender:
+        stamps.append('{}:{}'.format(
+            tender.get('version', ''),
+            snapshot_revision(tender) + len(tender['patches'] or [])))
+    stamps.extend(
+        contract.get('dateModified', '')
+        for contract in tender.get('contracts') or []
+    )
+    return '|'.join(stamps)
+
+
+def serialize(items):
+    return SEPARATOR.join(dumps(item) for item in items)
+
+
+def deserialize(data):
+    if not data:
+        return []
+    return [RawJSON(item) for item in str(data).split(SEPARATOR)]
+
+
+class ReleaseCache(object):
+    """sqlite cache of the outputs of tenders, evicted by total size
+
+    Entries not used for the longest time are evicted first once the
+    database holds more than `max_size` bytes of releases.
+    """
+
+    def __init__(self, path, version, max_size=2 * 1024 ** 3):
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        self.db.execute(SCHEMA)
+        self.version = version
+        self.max_size = max_size
+        self.size = self.db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM releases').fetchone()[0]
+        self.hits = self.misses = self.evicted = 0
+
+    def get(self, tender, kind):
+        """`RawJSON` canonical and extension outputs of `tender` or None"""
+        row = self.db.execute(
+            'SELECT date_modified, version, canonical, extension'
+            ' FROM releases WHERE tender_id = ? AND kind = ?',
+            (tender['id'], kind)).fetchone()
+        if not row or row[0] != modified(tender) or \
+                row[1] != self.version:
+            self.misses += 1
+            return
+        self.hits += 1
+        self.db.execute(
+            'UPDATE releases SET used = ? WHERE tender_id = ? AND kind = ?',
+            (time(), tender['id'], kind))
+        return [deserialize(row[2]), deserialize(row[3])]
+
+    def put(self, tender, kind, converted):
+        """stores canonical and extension outputs of `tender`
+
+        Returns them as `RawJSON` to be used instead of `converted`.
+        """
+        canonical, extension = [serialize(items) for items in converted]
+        return self.store(tender['id'], modified(tender), kind,
+                          canonical, extension)
+
+    def store(self, tender_id, stamp, kind, canonical, extension):
+        """`put` of outputs already serialized with `serialize`"""
+        size = len(canonical) + len(extension)
+        previous = self.db.execute(
+            'SELECT size FROM releases WHERE tender_id = ? AND kind = ?',
+            (tender_id, kind)).fetchone()
+        if previous:
+            self.size -= previous[0]
+        self.db.execute(
+            'INSERT OR REPLACE INTO releases VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (tender_id, kind, stamp, self.version,
+             canonical, extension, size, time()))
+        self.size += size
+        if self.size > self.max_size:
+            self.evict()
+        return [deserialize(canonical), deserialize(extension)]
+
+    def evict(self):
+        """drops least recently used entries down to 90% of `max_size`"""
+        limit = self.max_size * 0.9
+        rows = self.db.execute(
+            'SELECT tender_id, kind, size FROM releases ORDER BY used')
+        stale = []
+        for tender_id, kind, size in rows:
+            if self.size <= limit:
+                break
+            stale.append((tender_id, kind))
+            self.size -= size
+        rows.close()
+        self.db.executemany(
+            'DELETE FROM releases WHERE tender_id = ? AND kind = ?', stale)
+        self.evicted += len(stale)
+
+    def commit(self):
+        self.db.commit()
+        logger.info('Release cache: {} hits, {} misses, {} evicted,'
+                    ' {} bytes'.format(self.hits, self.misses,
+                                       self.evicted, self.size))
+
+    def close(self):
+        self.commit()
+        self.db.close()
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""Checkpoints of long-running exports.
+
+A checkpoint is a small JSON document replaced atomically: it is
+written to a temporary file renamed over the previous one, so a crash
+never leaves a partial checkpoint behind.
+"""
+import os
+from simplejson import dump, load
+
+
+class Checkpoint(object):
+    """state saved to the file at `path`"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """the saved state, empty if nothing was saved yet"""
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as stream:
+            return load(stream)
+
+    def save(self, state):
+        temporary = '{}.tmp'.format(self.path)
+        with open(temporary, 'w') as stream:
+            dump(state, stream)
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.rename(temporary, self.path)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""Code-generated converters for Model subclasses.
+
+`Model.__init__` and `Model.__export__` walk `__slots__`, the callbacks
+and the models map for every nested object of every tender. The compiler
+does that walk once per (class, models map, callbacks) and generates a
+flat function for each reachable class which turns raw data straight
+into the exported dict.
+"""
+import logging
+from functools import partial
+from openprocurement.ocds.export.helpers import get_ocid
+
+
+logger = logging.getLogger(__name__)
+_converters = {}
+
+
+class _Attributes(dict):
+    """ stands in for a model instance while evaluating its properties """
+
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+def _export_value(value):
+    if not value:
+        return
+    if isinstance(value, (tuple, list)):
+        return [
+            x.__export__() if hasattr(x, '__export__') else x
+            for x in value if x
+        ] or None
+    if hasattr(value, '__export__'):
+        return value.__export__() or None
+    return value
+
+
+def _callback_key(callback):
+    if isinstance(callback, partial):
+        return (partial, callback.func, callback.args,
+                tuple(sorted((callback.keywords or {}).items())))
+    return callback
+
+
+def _cache_key(klass, models_map, callbacks):
+    return (
+        klass,
+        tuple(sorted((key, value[0], isinstance(value[1], list))
+                     for key, value in models_map.iteritems())),
+        tuple(sorted((key, _callback_key(value))
+                     for key, value in callbacks.iteritems())),
+    )
+
+
+def _properties(klass):
+    return [
+        (name, getattr(klass, name)) for name in dir(klass)
+        if not name.startswith('__') and name not in klass.__slots__
+        and isinstance(getattr(klass, name), property)
+    ]
+
+
+def _reachable(klass, models_map):
+    found = []
+    pending = [klass]
+    while pending:
+        current = pending.pop()
+        if current in found:
+            continue
+        found.append(current)
+        for key in current.__slots__:
+            if key in models_map:
+                pending.append(models_map[key][0])
+    return found
+
+
+def _generate(klass, name, names, models_map, callbacks, namespace, only=None):
+    from openprocurement.ocds.export.models import Release, release_defaults
+
+    is_release = issubclass(klass, Release)
+    slots = []
+    for key in klass.__slots__:
+        if key not in slots:
+            slots.append(key)
+    skip = ('ocid', 'id') if is_release else ()
+    properties = [
+        (prop, descriptor) for prop, descriptor in _properties(klass)
+        if only is None or prop in only
+    ]
+
+    lines = ['def {}(raw{}):'.format(
+        name, ", ocid='ocds-xxxx-'" if is_release else '')]
+    exported = {}
+    attributes = []
+    for index, key in enumerate(slots):
+        if key in skip or (only is not None and key not in only):
+            continue
+        value, result = 'v{}'.format(index), 'e{}'.format(index)
+        if key in callbacks:
+            callback = '{}_cb{}'.format(name, index)
+            namespace[callback] = callbacks[key]
+            lines.append('    {} = {}(raw)'.format(value, callback))
+        else:
+            lines.append('    {0} = raw.get({1!r}) if {1!r} in raw else None'.format(
+                value, key))
+        if key in models_map:
+            child, _type = models_map[key]
+            if isinstance(_type, list):
+                lines.append('    {} = [{}(x) for x in {}] if {} else None'.format(
+                    result, names[child], value, value))
+            else:
+                lines.append('    {} = {}({}) if {} else None'.format(
+                    result, names[child], value, value))
+            attributes.append((key, result, value))
+        else:
+            lines.append(
+                '    {0} = ([x for x in {1} if x] if isinstance({1}, _sequence)'
+                ' else {1}) if {1} else None'.format(result, value))
+            attributes.append((key, value, value))
+        if is_release and key in release_defaults:
+            lines.append('    if not {}: {} = {!r}'.format(
+                value, result, release_defaults[key]))
+        exported[key] = result
+
+    if properties:
+        lines.append('    attrs = _Attributes()')
+        for key, source, value in attributes:
+            lines.append('    if {}: attrs[{!r}] = {}'.format(value, key, source))
+        for index, (prop, descriptor) in enumerate(properties):
+            getter = '{}_prop{}'.format(name, index)
+            namespace[getter] = descriptor.fget
+            result = 'p{}'.format(index)
+            lines.append('    try:')
+            lines.append('        {} = _export_value({}(attrs))'.format(result, getter))
+            lines.append('    except Exception:')
+            lines.append('        {} = None'.format(result))
+            exported[prop] = result
+
+    if is_release:
+        exported['ocid'] = "_get_ocid(ocid, raw.get('tenderID'))"
+    lines.append('    out = {}')
+    for key in sorted(exported):
+        if key == 'ocid' and is_release:
+            lines.append('    out[{!r}] = {}'.format(key, exported[key]))
+        else:
+            lines.append('    if {0}: out[{1!r}] = {0}'.format(exported[key], key))
+    lines.append('    return out')
+    return '\n'.join(lines)
+
+
+def compile_model(klass, models_map, callbacks, only=None):
+    """Returns a function converting raw data into `klass(...).__export__()`
+
+    The result of compilation is cached per process. Release classes get
+    an extra `ocid` argument which is the prefix passed to `Release`,
+    their `id` is left to callers (see `helpers.release_id`).
+    With `only` just these fields of `klass` are converted, nested
+    models are always converted in full.
+    """
+    if only is not None:
+        only = frozenset(only)
+    key = _cache_key(klass, models_map, callbacks) + (only,)
+    if key in _converters:
+        return _converters[key]
+    classes = _reachable(klass, models_map)
+    names = {
+        model: 'convert_{}_{}'.format(model.__name__, index)
+        for index, model in enumerate(classes)
+    }
+    module = {
+        '_sequence': (tuple, list),
+        '_Attributes': _Attributes,
+        '_export_value': _export_value,
+        '_get_ocid': get_ocid,
+    }
+    for model in classes:
+        source = _generate(model, names[model], names, models_map,
+                           callbacks, module, only if model is klass else None)
+        exec(compile(source, '<{}>'.format(names[model]), 'exec'), module)
+    logger.debug('Compiled converters for {}'.format(
+        ', '.join(model.__name__ for model in classes)))
+    _converters[key] = module[names[klass]]
+    return _converters[key]
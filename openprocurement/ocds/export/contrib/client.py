@@ -23,6 +23,8 @@ class APIClient(object):
             "Content-type": "application/json"
         }
         self.historical = options.get('historical', False)
+        # called with the status and seconds taken by each response
+        self.on_response = options.get('on_response')
         resourse = options.get('resourse', 'tenders')
         self.resourse_url = '{}/{}'.format(self.base_url, resourse)
         APIAdapter = requests.adapters.HTTPAdapter(max_retries=5,
@@ -50,6 +52,8 @@ class APIClient(object):
         args.update(url=url)
         try:
             resp = self.session.get(**args)
+            if self.on_response:
+                self.on_response(resp.status_code, resp.elapsed.total_seconds())
             if resp.ok:
                 #if self.historical and version and version != resp.headers.get(VERSION, ''):
                 #    import pdb;pdb.set_trace()
@@ -8,25 +8,45 @@ from ..exceptions import LBMismatchError
 logger = logging.getLogger()
 
 
-def retreiver(client, params, cookie, queue, _filter, name='forward'):
+class Page(list):
+    """feed items read by the `name` retreiver, continued from `offset`"""
+
+    def __init__(self, items, name, offset):
+        super(Page, self).__init__(items)
+        self.name = name
+        self.offset = offset
+
+
+def cookies_changed(session, cookies):
+    """if the load balancer cookies of `session` differ from `cookies`"""
+    values = {}
+    for cookie in session.cookies:
+        values.setdefault(cookie.name, set()).add(cookie.value)
+    return any(values.get(k) != {v} for k, v in cookies.iteritems())
+
+
+def retreiver(client, params, cookie, queue, _filter, name='forward',
+              pause=None):
     logger.info("starting fetching feed {}".format(name))
     while True:
         r = client.get_tenders(params)
         if not r['data'] and name != 'forward':
             break
-        if client.session.cookies != cookie:
+        if cookies_changed(client.session, cookie):
             logger.error("{} lb mismatch error, exit".format(name))
             raise LBMismatchError
         logger.info("{} got response {} items".format(name, len(r['data'])))
         try:
             if r['data']:
-                queue.put(filter(_filter, r['data']))
+                queue.put(Page(_filter(r['data']), name, r['next_page']['offset']))
         except Full:
             logger.warn('{} queue is full, waiting'.format(name))
             while queue.full():
                 gevent.sleep(random.uniform(0, 2))
-            queue.put(filter(_filter, r['data']))
-        gevent.sleep(random.uniform(0, 2) * 5)
+            queue.put(Page(_filter(r['data']), name, r['next_page']['offset']))
+        gevent.sleep(pause() if pause else random.uniform(0, 2) * 5)
         params['offset'] = r['next_page']['offset']
     logger.warn('{} finished'.format(name))
+    # marks the end of the pages of the retreiver
+    queue.put(Page([], name, None))
     return 1
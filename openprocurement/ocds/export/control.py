@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""Adaptive concurrency of fetching tenders.
+
+A `FetchController` decides how many tenders are fetched at a time and
+how long the feed pauses between pages, from the fill level of the
+queue of feed items waiting to be fetched (the backlog) and of the
+queue of tenders waiting to be saved, and from latency and rate of
+throttled (429) or failed (5xx) responses of the API.
+
+Every `watch_interval` seconds:
+
+- too many errors, too slow responses or a full save queue take a
+  worker away and slow the feed down,
+- a backlog filled over `workers_inc_threshold` percents adds a worker,
+- a backlog filled under `workers_dec_threshold` percents takes a
+  worker away and speeds the feed up.
+
+Each throttled or failed response also delays the following requests
+by `client_inc_step_timeout` seconds more, each successful one by
+`client_dec_step_timeout` seconds less.
+"""
+import logging
+from collections import deque
+from gevent import sleep
+
+
+logger = logging.getLogger(__name__)
+
+
+def fill(queue):
+    """percents of `queue` filled"""
+    if not queue.maxsize:
+        return 0
+    return 100.0 * queue.qsize() / queue.maxsize
+
+
+class FetchController(object):
+    """fetch concurrency and feed pacing for `backlog` and `output` queues"""
+
+    def __init__(self, backlog, output, workers_min=3, workers_max=20,
+                 workers_inc_threshold=75, workers_dec_threshold=35,
+                 client_inc_step_timeout=0.1, client_dec_step_timeout=0.02,
+                 latency_max=2.0, error_max=0.05, pace_min=1, pace_max=10,
+                 watch_interval=10, window=100):
+        self.backlog = backlog
+        self.output = output
+        self.workers_min = workers_min
+        self.workers_max = workers_max
+        self.inc_threshold = workers_inc_threshold
+        self.dec_threshold = workers_dec_threshold
+        self.inc_step = client_inc_step_timeout
+        self.dec_step = client_dec_step_timeout
+        self.latency_max = latency_max
+        self.error_max = error_max
+        self.pace_min = pace_min
+        self.pace_max = pace_max
+        self.interval = watch_interval
+        self.responses = deque(maxlen=window)
+        self.workers = workers_max
+        self.pace = pace_max
+        self.delay = 0.0
+
+    def observe(self, status, elapsed):
+        """records a response with `status` which took `elapsed` seconds"""
+        failed = status == 429 or status >= 500
+        self.responses.append((failed, elapsed))
+        if failed:
+            self.delay += self.inc_step
+        else:
+            self.delay = max(0.0, self.delay - self.dec_step)
+
+    def throttle(self):
+        """waits before a request to the API"""
+        if self.delay:
+            sleep(self.delay)
+
+    def pause(self):
+        """seconds the feed waits before reading its next page"""
+        return self.pace
+
+    def metrics(self):
+        count = len(self.responses)
+        return {
+            'workers': self.workers,
+            'pace': self.pace,
+            'delay': round(self.delay, 3),
+            'errors': sum(f for f, _ in self.responses) / float(count) if count else 0.0,
+            'latency': sum(e for _, e in self.responses) / count if count else 0.0,
+            'backlog': fill(self.backlog),
+            'saving': fill(self.output),
+        }
+
+    def adjust(self):
+        """updates the decisions from the current metrics and returns them"""
+        metrics = self.metrics()
+        if (metrics['errors'] > self.error_max or
+                metrics['latency'] > self.latency_max or
+                metrics['saving'] >= self.inc_threshold):
+            self.workers = max(self.workers_min, self.workers - 1)
+            self.pace = min(self.pace_max, self.pace * 2)
+        elif metrics['backlog'] >= self.inc_threshold:
+            self.workers = min(self.workers_max, self.workers + 1)
+        elif metrics['backlog'] <= self.dec_threshold:
+            self.workers = max(self.workers_min, self.workers - 1)
+            self.pace = max(self.pace_min, self.pace / 2.0)
+        metrics.update(workers=self.workers, pace=self.pace)
+        return metrics
+
+    def run(self):
+        while True:
+            sleep(self.interval)
+            logger.info('Fetch control: {}'.format(', '.join(
+                '{}={}'.format(k, v) for k, v in sorted(self.adjust().items()))))
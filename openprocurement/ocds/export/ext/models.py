@@ -1,5 +1,5 @@
-import jsonpatch
 from copy import deepcopy
+from itertools import izip
 from openprocurement.ocds.export.models import (
     Award,
     Tender,
@@ -11,6 +11,10 @@ from openprocurement.ocds.export.models import (
     Document,
     callbacks,
     modelsMap,
+    sections,
+    sources,
+    tender_excludes,
+    release_tender,
     Release,
     Organization,
     Contact,
@@ -25,8 +29,16 @@ from openprocurement.ocds.export.helpers import (
     convert_questions,
     unique_documents,
     build_package,
-    compile_releases
+    release_id,
+    release_tags
 )
+from openprocurement.ocds.export.compiler import compile_model
+from openprocurement.ocds.export.builder import (
+    ReleaseBuilder,
+    iter_releases
+)
+from openprocurement.ocds.export.replay import replay_patches
+from openprocurement.ocds.export.merge import ReleaseMerger
 
 extensions = {
     'bids': lambda raw_data: convert_bids(raw_data.get('bids')),
@@ -353,63 +365,41 @@ def update_models_map():
     return models_ext
 
 
+sections_ext = sections + ('bids',)
+sources_ext = dict(sources, bids=('bids',))
+tender_excludes_ext = ('awards', 'contracts')
+
+
 def release_tender_ext(tender, modelsMap, callbacks, prefix):
-    release = ReleaseExt(tender, modelsMap, callbacks, prefix).__export__()
-    tag = ['tender']
-    for op in ['awards', 'contracts', 'bids']:
-        if op in release:
-            tag.append(op[:-1])
-    release['tag'] = tag
+    release = compile_model(ReleaseExt, modelsMap, callbacks)(tender, prefix)
+    release['tag'] = release_tags(release, sections_ext)
     if 'tender' in release:
         release['tender']['date'] = tender.get('date')
+    release['id'] = release_id(release)
     return release
 
 
-def release_tenders_ext(tender, modelsMap, callbacks, prefix):
-
-    def prepare_first_tags(release):
-        tag = ['tender']
-        for f in ['awards', 'contracts', 'bids']:
-            if f in release:
-                tag.append(f[:-1])
-        return list(set(tag))
-
+def iter_tender_releases_ext(tender, modelsMap, callbacks, prefix):
+    """yields releases of a historical tender as they are built"""
     assert 'patches' in tender
     patches = tender.pop('patches')
+    builder = ReleaseBuilder(ReleaseExt, modelsMap, callbacks, prefix,
+                             sections_ext, sources_ext, tender_excludes_ext)
+    return iter_releases(builder, tender, patches)
 
-    first_release = ReleaseExt(tender, modelsMap, callbacks).__export__()
-    first_release['tag'] = prepare_first_tags(first_release)
-    releases = [first_release]
-    for patch in patches:
-        tender = jsonpatch.apply_patch(tender, patch)
-        next_release = ReleaseExt(tender, modelsMap, callbacks).__export__()
-        if first_release != next_release:
-            diff = jsonpatch.make_patch(first_release, next_release).patch
-            tag = []
-            for op in diff:
-                if op['path'] in ['/tag', '/id']:
-                    continue
-                if op['op'] != 'add':
-                    if not any(p in op['path'] for p in ['awards', 'contracts', 'bids']):
-                        tag.append('tenderUpdate')
-                    else:
-                        for p in ['awards', 'contracts', 'bids']:
-                            if p in op['path']:
-                                tag.append(p[:-1] + 'Update')
-                else:
-                    for p in ['awards', 'contracts', 'bids']:
-                        if p in op['path']:
-                            tag.append(p[:-1])
-            next_release['tag'] = list(set(tag))
-            releases.append(next_release)
-        first_release = next_release
-    return releases
+
+def release_tenders_ext(tender, modelsMap, callbacks, prefix):
+    return list(iter_tender_releases_ext(tender, modelsMap, callbacks, prefix))
 
 
 def record_tenders_ext(tender, modelsMap, callbacks, prefix):
     record = {}
-    record['releases'] = release_tenders_ext(tender, modelsMap, callbacks, prefix)
-    record['compiledRelease'] = compile_releases(record['releases'])
+    merger = ReleaseMerger()
+    record['releases'] = [
+        merger.add(release) for release in
+        iter_tender_releases_ext(tender, modelsMap, callbacks, prefix)
+    ]
+    record['compiledRelease'] = merger.compiled(record['releases'])
     record['ocid'] = record['releases'][0]['ocid']
     return record
 
@@ -421,7 +411,7 @@ def package_tenders_ext(tenders, modelsMap, callbacks, config):
         if not tender:
             continue
         if 'patches' in tender:
-            releases.extend(release_tenders_ext(tender, config.get('prefix')))
+            releases.extend(release_tenders_ext(tender, modelsMap, callbacks, config.get('prefix')))
         else:
             releases.append(release_tender_ext(tender, modelsMap, callbacks, config.get('prefix')))
     package['releases'] = releases
@@ -439,3 +429,100 @@ def package_records_ext(tenders, modelsMap, callbacks, config):
         records.append(record_tenders_ext(tender, modelsMap, callbacks, config.get('prefix')))
     package['records'] = records
     return package
+
+
+def release_tender_profiles(tender, models_ext, callbacks_ext, prefix):
+    """Converts `tender` into canonical and extension releases
+
+    The callbacks of both profiles leave the tender as it is, so both
+    releases are converted from the same tender without copying it.
+    """
+    release = release_tender(tender, modelsMap, callbacks, prefix)
+    release_ext = release_tender_ext(tender, models_ext, callbacks_ext, prefix)
+    return release, release_ext
+
+
+def iter_tender_releases_profiles(tender, models_ext, callbacks_ext, prefix):
+    """Historical variant of `release_tender_profiles`
+
+    Yields canonical and extension releases of every revision, as
+    `iter_tender_releases` and `iter_tender_releases_ext` do. The patches
+    are replayed once for both profiles.
+    """
+    assert 'patches' in tender
+    patches = tender['patches']
+    tender = {k: v for k, v in tender.iteritems() if k != 'patches'}
+
+    builder = ReleaseBuilder(Release, modelsMap, callbacks, prefix,
+                             sections, sources, tender_excludes)
+    builder_ext = ReleaseBuilder(ReleaseExt, models_ext, callbacks_ext, prefix,
+                                 sections_ext, sources_ext, tender_excludes_ext)
+    yield builder.build(tender), builder_ext.build(tender)
+    for patch, tender in izip(patches, replay_patches(tender, patches)):
+        yield builder.update(tender, patch), builder_ext.update(tender, patch)
+
+
+def release_tenders_profiles(tender, models_ext, callbacks_ext, prefix):
+    """Returns canonical and extension lists of releases of a historical tender"""
+    releases, releases_ext = [], []
+    for release, release_ext in iter_tender_releases_profiles(
+            tender, models_ext, callbacks_ext, prefix):
+        releases.append(release)
+        releases_ext.append(release_ext)
+    return releases, releases_ext
+
+
+def tender_releases_profiles(tender, models_ext, callbacks_ext, prefix):
+    """Canonical and extension lists of releases of any `tender`"""
+    if 'patches' in tender:
+        return release_tenders_profiles(tender, models_ext, callbacks_ext, prefix)
+    return [[release] for release in release_tender_profiles(
+        tender, models_ext, callbacks_ext, prefix)]
+
+
+def tender_records_profiles(tender, models_ext, callbacks_ext, prefix):
+    """Canonical and extension records of a historical `tender`"""
+    mergers = [ReleaseMerger(), ReleaseMerger()]
+    converted = [[], []]
+    for pair in iter_tender_releases_profiles(
+            tender, models_ext, callbacks_ext, prefix):
+        for merger, releases, release in zip(mergers, converted, pair):
+            releases.append(merger.add(release))
+    return [
+        {
+            'releases': releases,
+            'compiledRelease': merger.compiled(releases),
+            'ocid': releases[0]['ocid'],
+        }
+        for merger, releases in zip(mergers, converted)
+    ]
+
+
+def package_tenders_profiles(tenders, models_ext, callbacks_ext, config):
+    """Builds canonical and extension packages in a single conversion"""
+    packages = [build_package(config), build_package(config)]
+    history = [[], []]
+    for tender in tenders:
+        if not tender:
+            continue
+        converted = tender_releases_profiles(tender, models_ext, callbacks_ext, config.get('prefix'))
+        for releases, new in zip(history, converted):
+            releases.extend(new)
+    for package, releases in zip(packages, history):
+        package['releases'] = releases
+    return packages
+
+
+def package_records_profiles(tenders, models_ext, callbacks_ext, config):
+    """Builds canonical and extension record packages in a single conversion"""
+    packages = [build_package(config), build_package(config)]
+    history = [[], []]
+    for tender in tenders:
+        if not tender:
+            continue
+        converted = tender_records_profiles(tender, models_ext, callbacks_ext, config.get('prefix'))
+        for records, record in zip(history, converted):
+            records.append(record)
+    for package, records in zip(packages, history):
+        package['records'] = records
+    return packages
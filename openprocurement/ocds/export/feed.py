@@ -1,10 +1,12 @@
 import gevent
 import logging
 import functools
+from collections import deque
 from gevent.queue import Queue
 from openprocurement.ocds.export.helpers import get_start_point
 from .contrib.retreive import retreiver
 from .contrib.client import get_retreive_clients
+from .exceptions import LBMismatchError
 
 
 logger = logging.getLogger(__name__)
@@ -12,7 +14,8 @@ logger = logging.getLogger(__name__)
 
 class APIRetreiver(object):
 
-    def __init__(self, config, filter_callback=lambda x: x):
+    def __init__(self, config, filter_callback=lambda x: x, pause=None,
+                 checkpoint=None):
         if not isinstance(config, dict):
             raise TypeError(
                 "Expected a dict as config, got {}".format(type(config))
@@ -24,9 +27,36 @@ class APIRetreiver(object):
 
         self.tender_queue = Queue(maxsize=config.get('queue_max_size', 250))
         self.filter_callback = filter_callback
-        
+        # seconds to wait between pages, random when not given
+        self.pause = pause
+        # position of the feed past the stored pages, saved by `commit`
+        self.checkpoint = checkpoint
+        self.position = checkpoint.load() if checkpoint else {}
+        self.committed = dict(self.position)
+        # position past the pages read, retreivers continue from it
+        self.read = dict(self.position)
+        # pages read of each retreiver with items not stored yet
+        self.pages = {'forward': deque(), 'backward': deque()}
+
+    def _resume(self, forward_params, backward_params):
+        """params of retreivers continuing from the saved position"""
+        logger.info('Resuming feed from {}'.format(self.read))
+        self.origin_cookie.clear()
+        self.origin_cookie.update(self.read['cookies'])
+        forward_params['offset'] = self.read['forward']
+        if self.read['backward_done']:
+            return forward_params, None
+        backward_params.update(descending='1',
+                               offset=self.read['backward'])
+        return forward_params, backward_params
+
     def _start(self):
         logger.info('Retreivers starting')
+        for g in getattr(self, 'workers', []):
+            g.kill()
+        # pages left from previous retreivers are read again
+        while not self.tender_queue.empty():
+            self.tender_queue.get()
         self.origin_cookie, self.forward_client, self.backward_client = get_retreive_clients(
             self.api_key,
             self.api_host,
@@ -35,38 +65,85 @@ class APIRetreiver(object):
         self.forward = functools.partial(retreiver, self.forward_client)
         self.backward = functools.partial(retreiver, self.backward_client)
 
-        forward_params, backward_params = get_start_point(
-            self.forward_client,
-            self.backward_client,
-            self.origin_cookie,
-            self.tender_queue,
-            self.filter_callback,
-            self.api_extra_params
-        )
+        if self.read.get('backward') or self.read.get('backward_done'):
+            forward_params, backward_params = self._resume(
+                dict(self.api_extra_params or {}, feed='changes'),
+                dict(self.api_extra_params or {}, feed='changes'))
+            self.cookies = dict(self.origin_cookie)
+        else:
+            self.cookies = dict(self.origin_cookie)
+            forward_params, backward_params = get_start_point(
+                self.forward_client,
+                self.backward_client,
+                self.cookies,
+                self.tender_queue,
+                self.filter_callback,
+                self.api_extra_params
+            )
+            self.position = {
+                'cookies': self.cookies,
+                'forward': forward_params['offset'],
+                'backward': None,
+                'backward_done': False
+            }
+            self.read = dict(self.position)
+            self.pages = {'forward': deque(), 'backward': deque()}
 
         fg = gevent.spawn(
             self.forward,
             forward_params,
-            self.origin_cookie,
-            self.tender_queue,
-            self.filter_callback,
-        )
-        bg = gevent.spawn(
-            self.backward,
-            backward_params,
-            self.origin_cookie,
+            self.cookies,
             self.tender_queue,
             self.filter_callback,
-            name='backward'
+            pause=self.pause
         )
+        if backward_params is None:
+            bg = gevent.spawn(lambda: 1)
+        else:
+            bg = gevent.spawn(
+                self.backward,
+                backward_params,
+                self.cookies,
+                self.tender_queue,
+                self.filter_callback,
+                name='backward',
+                pause=self.pause
+            )
         self.workers = [fg, bg]
 
     def _restart(self):
         logger.warn('Restarting retreivers')
-        for g in self.workers:
-            g.kill()
+        if any(isinstance(g.exception, LBMismatchError) for g in self.workers):
+            # offsets of another server are not to be trusted
+            logger.warn('Load balancer cookie changed, starting the feed over')
+            self.position = {}
+            self.read = {}
         self._start()
 
+    def _advance(self, position, page):
+        """moves `position` of the feed past `page`"""
+        if page.offset is None:
+            position['backward_done'] = True
+        else:
+            position[page.name] = page.offset
+
+    def _complete(self, name):
+        """moves the position past the leading pages with all items stored"""
+        pages = self.pages[name]
+        while pages and pages[0].pending <= 0:
+            self._advance(self.position, pages.popleft())
+
+    def done(self, page):
+        """marks an item of `page` as stored or given up"""
+        page.pending -= 1
+        self._complete(page.name)
+
+    def commit(self):
+        """saves the position of the feed past the stored pages"""
+        if self.checkpoint and self.position != self.committed:
+            self.checkpoint.save(self.position)
+            self.committed = dict(self.position)
+
     def __iter__(self):
         self._start()
         while True:
@@ -76,8 +153,15 @@ class APIRetreiver(object):
                     logger.fatal('Backward fails')
                     self._restart()
             if forward.dead or forward.ready():
-                logger.warm('Forward worker died!')
+                logger.warn('Forward worker died!')
                 self._restart()
             if self.tender_queue.empty():
                 gevent.sleep(1)
-            yield self.tender_queue.get()
+                continue
+            page = self.tender_queue.get()
+            self._advance(self.read, page)
+            page.pending = len(page)
+            self.pages[page.name].append(page)
+            self._complete(page.name)
+            if page.offset is not None:
+                yield page
@@ -4,12 +4,15 @@ import yaml
 import os
 import zipfile
 import argparse
-from simplejson import dump
+from hashlib import md5
+from simplejson import dump, dumps
 from gevent.pool import Pool
 from iso8601 import parse_date
 from datetime import datetime
 from collections import Counter
 from .exceptions import LBMismatchError
+from .contrib.retreive import Page, cookies_changed
+from .merge import ReleaseMerger
 
 from boto.s3 import connect_to_region
 from boto.s3.connection import (
@@ -112,66 +115,81 @@ def unique_documents(documents, extension=False):
     """adds `-<number>` to docs with same ids"""
     if not documents:
         return
-    if extension:
-        for doc in documents:
-            if 'documentOf' in doc:
-                doc['documentScope'] = doc.pop('documentOf')
     cout = Counter(doc['id'] for doc in documents)
-    for i in [i for i, c in cout.iteritems() if c > 1]:
-        for index, d in enumerate([d for d in documents if d['id'] == i]):
-            d['id'] = d['id'] + '-{}'.format(index)
-    return documents
+    seen = Counter()
+    new = []
+    for doc in documents:
+        if extension and 'documentOf' in doc:
+            doc = doc.copy()
+            doc['documentScope'] = doc.pop('documentOf')
+        _id = doc['id']
+        if cout[_id] > 1:
+            doc = dict(doc, id=_id + '-{}'.format(seen[_id]))
+            seen[_id] += 1
+        new.append(doc)
+    return new
 
 
 def convert_cancellation_and_tenderers(tender):
+    """returns a copy of tender with cancellations and tenderers applied"""
+    tender = tender.copy()
     cancellations = tender.get('cancellations', '')
     if cancellations:
         for cancellation in cancellations:
             if cancellation['cancellationOf'] == 'tender':
                 tender['pendingCancellation'] = True
             elif cancellation['cancellationOf'] == 'lot':
-                for lot in tender.get('lots', []):
-                    if lot['id'] == cancellation['relatedLot']:
-                        lot['pendingCancellation'] = True
+                tender['lots'] = [
+                    dict(lot, pendingCancellation=True)
+                    if lot['id'] == cancellation['relatedLot'] else lot
+                    for lot in tender.get('lots', [])
+                ]
             cancellation_docs = prepare_cancellation_documents(cancellation)
             if 'documents' in tender:
-                tender['documents'].extend(cancellation_docs)
+                tender['documents'] = tender['documents'] + cancellation_docs
             else:
                 tender['documents'] = cancellation_docs
-    if unique_tenderers(tender):
-        tender['tenderers'] = unique_tenderers(tender)
+    tenderers = unique_tenderers(tender)
+    if tenderers:
+        tender['tenderers'] = tenderers
     return tender
 
 
 def prepare_cancellation_documents(cancellation):
-    for doc in cancellation.get('documents', []):
-        doc['documentType'] = 'tenderCancellation' if \
-                cancellation['cancellationOf'] == 'tender' else 'lotCancellation'
-    return cancellation.get('documents', [])
+    document_type = 'tenderCancellation' if \
+            cancellation['cancellationOf'] == 'tender' else 'lotCancellation'
+    return [
+        dict(doc, documentType=document_type)
+        for doc in cancellation.get('documents', [])
+    ]
 
 
 def convert_questions(tender):
     questions = tender.get('questions')
     if not questions:
         return
+    new = []
     for question in questions:
         if question['questionOf'] == 'lot':
-            question['relatedLot'] = question['relatedItem']
-            del question['relatedItem']
-    return questions
+            question = question.copy()
+            question['relatedLot'] = question.pop('relatedItem')
+        new.append(question)
+    return new
 
 
 def award_converter(tender):
     if 'lots' in tender:
-        for award in tender.get('awards', []):
-            award['items'] = [
+        return [
+            dict(award, items=[
                 item for item in tender.get('items')
                 if item.get('relatedLot') == award.get('lotID')
-            ]
-    else:
-        for award in tender.get('awards', []):
-            award['items'] = tender.get('items')
-    return tender.get('awards', [])
+            ])
+            for award in tender.get('awards', [])
+        ]
+    return [
+        dict(award, items=tender.get('items'))
+        for award in tender.get('awards', [])
+    ]
 
 
 def convert_bids(bids):
@@ -195,17 +213,17 @@ def convert_unit_and_location(items):
         return
     new = []
     for item in items:
-        new_loc = {}
+        item = item.copy()
         if 'unit' in item:
             unit_code = item['unit'].get('code')
             if units.get(unit_code):
-                item['unit'] = units[unit_code]
-                item['unit']['scheme'] = "UNCEFACT"
-                item['unit']['id'] = unit_code
+                item['unit'] = dict(units[unit_code],
+                                    scheme="UNCEFACT",
+                                    id=unit_code)
             elif item['unit'].get('id'):
                 pass
             else:
-                item['unit']['id'] = unit_code
+                item['unit'] = dict(item['unit'], id=unit_code)
         if 'deliveryLocation' in item:
             if item['deliveryLocation'].get('latitude'):
                 new_loc = {'geometry': {'coordinates': item['deliveryLocation'].values()}}
@@ -251,26 +269,169 @@ def get_start_point(forward, backward, cookie, queue,
     if extra:
         [x.update(extra) for x in [forward_params, backward_params]]
     r = backward.get_tenders(backward_params)
-    if backward.session.cookies != cookie:
+    if cookies_changed(backward.session, cookie):
         raise LBMismatchError
     backward_params['offset'] = r['next_page']['offset']
     forward_params['offset'] = r['prev_page']['offset']
-    queue.put(filter(callback, r['data']))
+    queue.put(Page(callback(r['data']), 'backward', backward_params['offset']))
     return forward_params, backward_params
 
 
-def exists_or_modified(storage, doc):
-    resp = storage.view('tenders/by_dateModified', key=doc['id'])
-    try:
-        date_mod = next(r['value'] for r in resp)
-        return date_mod < doc.get('dateModified')
-    except StopIteration:
-        return True
+def release_id(release, revision=0, digests=None):
+    """deterministic id of `release`
+
+    md5 of the ocid, the number of the revision the release is built
+    from and the content of the release. `digests` keeps digests of top
+    level fields between calls: fields shared by identity with the
+    previous release are not serialized again.
+    """
+    if digests is None:
+        digests = {}
+    digest = md5('{}/{}'.format(release.get('ocid'), revision))
+    for key in sorted(release):
+        if key == 'id':
+            continue
+        value = release[key]
+        cached = digests.get(key)
+        if cached is None or cached[0] is not value:
+            cached = digests[key] = (
+                value, md5(dumps(value, sort_keys=True)).digest()
+            )
+        digest.update(key)
+        digest.update(cached[1])
+    return digest.hexdigest()
+
+
+def release_tags(release, sections):
+    """tags of a standalone release: tender plus present `sections`"""
+    tag = ['tender']
+    for op in sections:
+        if op in release:
+            tag.append(op[:-1])
+    return tag
+
+
+class _Changes(object):
+    """changes between two releases by section, as a patch would have them
+
+    Values are compared as `jsonpatch.make_patch` does, without making
+    the operations: lists by position, objects by key. A value removed
+    in one place and added in another is a move, which is no addition.
+    A list element replaced with another not moved from elsewhere is an
+    update. Unlike a patch, values shifted along a list of lists are
+    not told apart from updated ones.
+    """
+
+    def __init__(self):
+        self.updated = set()
+        self.removes = []
+        self.adds = []
+
+    def _take(self, pending, value):
+        for index in range(len(pending) - 1, -1, -1):
+            other = pending[index][1]
+            if type(other) is type(value) and other == value:
+                return pending.pop(index)
+
+    def remove(self, section, value, swap=None):
+        entry = [section, value, swap]
+        added = self._take(self.adds, value)
+        if added is not None:
+            # moved to where it was added
+            self.updated.add(added[0])
+        else:
+            self.removes.append(entry)
+        return entry
+
+    def add(self, section, value, swap=None):
+        removed = self._take(self.removes, value)
+        if removed is not None:
+            # moved here
+            self.updated.add(section)
+        else:
+            self.adds.append([section, value, swap])
+
+    def replace(self, section, old, new):
+        self.add(section, new, swap=self.remove(section, old))
+
+    def compare(self, section, old, new):
+        if isinstance(old, dict) and isinstance(new, dict):
+            for key in old:
+                if key not in new:
+                    self.remove(section, old[key])
+            for key in new:
+                if key not in old:
+                    self.add(section, new[key])
+            for key in old:
+                if key in new and old[key] is not new[key]:
+                    self.compare(section, old[key], new[key])
+        elif isinstance(old, list) and isinstance(new, list):
+            for index in range(max(len(old), len(new))):
+                if index >= len(new):
+                    self.remove(section, old[index])
+                elif index >= len(old):
+                    self.add(section, new[index])
+                elif old[index] is new[index] or old[index] == new[index]:
+                    continue
+                elif isinstance(old[index], (dict, list)) and \
+                        type(old[index]) is type(new[index]):
+                    self.compare(section, old[index], new[index])
+                else:
+                    self.replace(section, old[index], new[index])
+        elif dumps(old) != dumps(new):
+            self.updated.add(section)
+
+    def sections(self):
+        """(added, updated) sections"""
+        added, updated = set(), set(self.updated)
+        for section, _, _ in self.removes:
+            updated.add(section)
+        for section, _, swap in self.adds:
+            if swap is not None and any(swap is r for r in self.removes):
+                # removed and added in place
+                updated.add(section)
+            else:
+                added.add(section)
+        return added, updated
+
+
+def release_update_tags(previous, release, sections):
+    """derives tags of `release` from its difference to `previous`
+
+    The release is compared section by section without building a
+    patch: a changed or removed value of `tender` (any field of the
+    release but `id`, `tag` and `sections`) is a `tenderUpdate`, added
+    ones give no tag. Each of `sections` gives its singular name for
+    added values, even within an existing element, and `<name>Update`
+    for changed or removed ones. Fields shared by identity are skipped.
+    """
+    changes = _Changes()
+    for key in set(previous) | set(release):
+        if key in ('id', 'tag'):
+            continue
+        section = key if key in sections else None
+        if key not in release:
+            changes.remove(section, previous[key])
+        elif key not in previous:
+            changes.add(section, release[key])
+        elif previous[key] is not release[key]:
+            changes.compare(section, previous[key], release[key])
+    added, updated = changes.sections()
+    tag = set(section[:-1] for section in added if section)
+    tag.update(
+        section[:-1] + 'Update' if section else 'tenderUpdate'
+        for section in updated
+    )
+    return list(tag)
 
 
 def compile_releases(releases, versioned=False):
-    return ocdsmerge.merge(releases) if not versioned\
-            else ocdsmerge.merge_versioned(releases)
+    if versioned:
+        return ocdsmerge.merge_versioned(releases)
+    merger = ReleaseMerger()
+    for release in releases:
+        merger.add(release)
+    return merger.compiled(releases)
 
 
 def dump_json(path, name, data, pretty=False):
@@ -362,6 +523,14 @@ def parse_args():
                         action='store_true',
                         help='Choose to include contracting',
                         default=False)
+    parser.add_argument('-w', '--workers',
+                        type=int,
+                        default=1,
+                        help='Number of processes converting tenders')
+    parser.add_argument('--since-last-run',
+                        action='store_true',
+                        default=False,
+                        help='Export only tenders modified since the last export')
     return parser.parse_args()
 
 
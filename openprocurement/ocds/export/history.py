@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""Compaction of patch chains of historical tenders.
+
+A historical tender is stored as its first revision with the `patches`
+leading to every later one. Once `every` patches pile up, the document
+is compacted: its state after all of them becomes the new stored
+snapshot and the patches are moved with the previous snapshot to a
+segment kept as an attachment of the document. Updates replay only the
+patches made since the latest snapshot, and documents stop growing with
+the number of revisions.
+
+The `history` of a compacted document lists its segments with the
+revision their snapshot starts from. Exports restore the whole chain
+from all of the segments.
+"""
+from base64 import b64encode
+from collections import OrderedDict
+from simplejson import dumps
+from openprocurement.ocds.export.replay import apply_patches
+
+
+SEGMENT = 'history-{:06d}.json'
+# fields of stored documents which are not fields of tenders
+META = ('_id', '_rev', '_attachments', 'doc_type', 'version', 'patches',
+        'history')
+
+
+def snapshot(doc):
+    """tender stored as the snapshot of `doc`"""
+    return {k: v for k, v in doc.iteritems() if k not in META}
+
+
+def snapshot_revision(doc):
+    """number of patches preceding the snapshot of `doc`"""
+    if not doc.get('history'):
+        return 0
+    last = doc['history'][-1]
+    return last['revision'] + last['patches']
+
+
+def latest(doc):
+    """latest revision of the tender stored in `doc`"""
+    return apply_patches(snapshot(doc), doc.get('patches') or [])
+
+
+def compact(doc, every=100):
+    """`doc` compacted if it holds at least `every` patches"""
+    patches = doc.get('patches') or []
+    if len(patches) < every:
+        return doc
+    revision = snapshot_revision(doc)
+    name = SEGMENT.format(revision)
+    segment = dumps({
+        'revision': revision,
+        'document': snapshot(doc),
+        'patches': patches
+    })
+    compacted = {k: v for k, v in doc.iteritems() if k in META}
+    compacted.update(latest(doc))
+    compacted['patches'] = []
+    compacted['history'] = list(doc.get('history') or []) + [
+        {'revision': revision, 'patches': len(patches), 'name': name}
+    ]
+    attachments = compacted['_attachments'] = dict(doc.get('_attachments') or {})
+    attachments[name] = {
+        'content_type': 'application/json',
+        'data': b64encode(segment)
+    }
+    return compacted
+
+
+def restore(doc, segments):
+    """`doc` as its first revision with all patches, from its `segments`"""
+    if not segments:
+        return doc
+    restored = {k: v for k, v in doc.iteritems() if k in META}
+    restored.update(segments[0]['document'])
+    restored['patches'] = [
+        patch for segment in segments for patch in segment['patches']
+    ] + list(doc.get('patches') or [])
+    restored.pop('history', None)
+    restored.pop('_attachments', None)
+    return restored
+
+
+def stub_attachments(doc):
+    """`doc` referring to its saved attachments instead of sending them"""
+    if doc.get('_attachments'):
+        doc['_attachments'] = {
+            name: {'stub': True} for name in doc['_attachments']
+        }
+    return doc
+
+
+class LatestStates(object):
+    """latest states of at most `size` stored tenders, least recent dropped
+
+    Entries hold the document to be stored for a tender with the state
+    of its latest revision, so an update does not read the document nor
+    replay its patches.
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, tender_id):
+        """stored document and latest state of `tender_id`, or None"""
+        entry = self.entries.pop(tender_id, None)
+        if entry is None:
+            self.misses += 1
+            return
+        self.hits += 1
+        self.entries[tender_id] = entry
+        return entry
+
+    def put(self, doc, state):
+        self.entries.pop(doc['id'], None)
+        self.entries[doc['id']] = (doc, state)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def discard(self, doc):
+        """drops `doc` failed to be stored"""
+        entry = self.entries.get(doc['id'])
+        if entry and entry[0] is doc:
+            del self.entries[doc['id']]
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""In-memory index of `dateModified` of stored tenders.
+
+The bridge skips feed items of tenders stored with the same or a later
+`dateModified`. The index is loaded once from `tenders/by_dateModified`
+and kept up to date as tenders are saved, so whole pages of the feed are
+filtered without requests to the database. Ids missing from the index
+(tenders saved by another process since it was loaded) are looked up
+with one multi-key request per page.
+
+Ids and dates are kept as byte strings: about 250 bytes an entry, some
+750MB for three million tenders.
+"""
+import sys
+import logging
+from time import time
+
+
+logger = logging.getLogger(__name__)
+VIEW = 'tenders/by_dateModified'
+
+
+class ModifiedIndex(object):
+    """`dateModified` of tenders of `storage` by tender id"""
+
+    def __init__(self, storage, batch=10000):
+        self.storage = storage
+        self.batch = batch
+        self.dates = {}
+        self.hits = self.misses = self.lookups = 0
+
+    def load(self):
+        started = time()
+        for row in self.storage.iterview(VIEW, self.batch):
+            self.dates[str(row.key)] = str(row.value or '')
+        logger.info('Loaded dateModified of {} tenders in {:.1f}s, about'
+                    ' {} bytes'.format(len(self.dates), time() - started,
+                                       self.size()))
+
+    def size(self):
+        """approximate memory used by the index in bytes"""
+        return sys.getsizeof(self.dates) + sum(
+            sys.getsizeof(key) + sys.getsizeof(value)
+            for key, value in self.dates.iteritems()
+        )
+
+    def get(self, tender_id):
+        return self.dates.get(tender_id)
+
+    def update(self, tender):
+        self.dates[str(tender['id'])] = str(tender.get('dateModified') or '')
+
+    def _lookup(self, ids):
+        self.lookups += 1
+        for row in self.storage.view(VIEW, keys=ids):
+            self.dates[str(row.key)] = str(row.value or '')
+
+    def filter(self, items):
+        """feed `items` of tenders new or modified since they were stored"""
+        missing = [item['id'] for item in items if item['id'] not in self.dates]
+        if missing:
+            self.misses += len(missing)
+            self._lookup(missing)
+        self.hits += len(items) - len(missing)
+        return [
+            item for item in items
+            if item['id'] not in self.dates
+            or self.dates[item['id']] < item.get('dateModified')
+        ]
+
+    def report(self):
+        logger.info('dateModified index: {} tenders, {} hits, {} misses in'
+                    ' {} lookups'.format(len(self.dates), self.hits,
+                                         self.misses, self.lookups))
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""Compiled releases built while releases are produced.
+
+`ocdsmerge.merge` flattens every release of a record once all of them
+are built. `ReleaseMerger` folds releases one by one into the flattened
+compiled release, so only the compiled release and the current release
+are held by the merge. Fields shared by identity with the previously
+folded release are not flattened again: their values are already in
+the compiled release.
+"""
+from collections import OrderedDict
+import ocdsmerge
+from ocdsmerge.merge import flatten, process_flattened, unflatten
+
+
+class ReleaseMerger(object):
+    """Incremental `ocdsmerge.merge`
+
+    The result is the same as of `ocdsmerge.merge` as long as releases
+    are added in order of their dates, which `ordered` tells.
+    """
+
+    def __init__(self):
+        self.merged = OrderedDict({('tag',): ['compiled']})
+        self.previous = {}
+        self.date = None
+        self.ordered = True
+
+    def add(self, release):
+        """folds `release` into the compiled release and returns it"""
+        date = release['date']
+        if self.date is not None and date < self.date:
+            self.ordered = False
+        else:
+            self.date = date
+        changed = {
+            key: value for key, value in release.iteritems()
+            if key != 'tag' and self.previous.get(key) is not value
+        }
+        if changed:
+            self.merged.update(process_flattened(flatten((), {}, changed)))
+        self.previous = release
+        return release
+
+    def compiled(self, releases=None):
+        """the compiled release
+
+        When releases were added out of order `releases` are merged
+        from scratch instead.
+        """
+        if not self.ordered:
+            return ocdsmerge.merge(releases)
+        return unflatten(self.merged)
@@ -1,6 +1,4 @@
-import jsonpatch
 import logging
-from uuid import uuid4
 from urllib import quote
 from functools import partial
 from openprocurement.ocds.export.helpers import (
@@ -9,9 +7,13 @@ from openprocurement.ocds.export.helpers import (
     award_converter,
     get_ocid,
     build_package,
-    compile_releases,
-    convert_status
+    convert_status,
+    release_id,
+    release_tags
 )
+from openprocurement.ocds.export.compiler import compile_model
+from openprocurement.ocds.export.builder import ReleaseBuilder, iter_releases
+from openprocurement.ocds.export.merge import ReleaseMerger
 
 logger = logging.getLogger(__name__)
 invalidsymbols = ["`", "~", "!", "@", "#", "$", '"', u"\u200E"]
@@ -44,6 +46,10 @@ callbacks = {
     'uri': partial(quote_uri, 'uri'),
     'url': partial(quote_uri, 'url')
 }
+release_defaults = {
+    'initiationType': 'tender',
+    'language': 'uk',
+}
 
 
 class Model(object):
@@ -271,11 +277,11 @@ class Release(Model):
     )
 
     def __init__(self, raw_data, modelsMap, callbacks, ocid='ocds-xxxx-'):
-        self.initiationType = 'tender'
-        self.language = 'uk'
+        for key, value in release_defaults.iteritems():
+            setattr(self, key, value)
         super(Release, self).__init__(raw_data, modelsMap, callbacks)
         self.ocid = get_ocid(ocid, raw_data.get('tenderID'))
-        self.id = uuid4().hex
+        self.id = release_id(self.__export__())
 
 
 modelsMap = {
@@ -305,61 +311,45 @@ modelsMap = {
 }
 
 
-def release_tender(tender, modelsMap, callbacks, prefix):
-    release = Release(tender, modelsMap, callbacks, prefix).__export__()
-    tag = ['tender']
-    for op in ['awards', 'contracts']:
-        if op in release:
-            tag.append(op[:-1])
-    release['tag'] = tag
-    return release
+sections = ('awards', 'contracts')
+# tender fields release sections are built from, the release `tender`
+# is built from all fields except `tender_excludes`
+sources = {
+    'awards': ('awards', 'items', 'lots'),
+    'contracts': ('contracts',),
+    'buyer': ('procuringEntity',),
+}
+tender_excludes = ('awards', 'contracts', 'date', 'dateModified')
 
 
-def release_tenders(tender, modelsMap, callbacks, prefix):
+def release_tender(tender, modelsMap, callbacks, prefix):
+    release = compile_model(Release, modelsMap, callbacks)(tender, prefix)
+    release['tag'] = release_tags(release, sections)
+    release['id'] = release_id(release)
+    return release
 
-    def prepare_first_tags(release):
-        tag = ['tender']
-        for f in ['awards', 'contracts']:
-            if f in release:
-                tag.append(f[:-1])
-        return list(set(tag))
 
+def iter_tender_releases(tender, modelsMap, callbacks, prefix):
+    """yields releases of a historical tender as they are built"""
     assert 'patches' in tender
     patches = tender.pop('patches')
+    builder = ReleaseBuilder(Release, modelsMap, callbacks, prefix,
+                             sections, sources, tender_excludes)
+    return iter_releases(builder, tender, patches)
 
-    first_release = Release(tender, modelsMap, callbacks).__export__()
-    first_release['tag'] = prepare_first_tags(first_release)
-    releases = [first_release]
-    for patch in patches:
-        tender = jsonpatch.apply_patch(tender, patch)
-        next_release = Release(tender, modelsMap, callbacks).__export__()
-        if first_release != next_release:
-            diff = jsonpatch.make_patch(first_release, next_release).patch
-            tag = []
-            for op in diff:
-                if op['path'] in ['/tag', '/id']:
-                    continue
-                if op['op'] != 'add':
-                    if not any(p in op['path'] for p in ['awards', 'contracts']):
-                        tag.append('tenderUpdate')
-                    else:
-                        for p in ['awards', 'contracts']:
-                            if p in op['path']:
-                                tag.append(p[:-1] + 'Update')
-                else:
-                    for p in ['awards', 'contracts']:
-                        if p in op['path']:
-                            tag.append(p[:-1])
-            next_release['tag'] = list(set(tag))
-            releases.append(next_release)
-        first_release = next_release
-    return releases
+
+def release_tenders(tender, modelsMap, callbacks, prefix):
+    return list(iter_tender_releases(tender, modelsMap, callbacks, prefix))
 
 
 def record_tenders(tender, modelsMap, callbacks, prefix):
     record = {}
-    record['releases'] = release_tenders(tender, modelsMap, callbacks, prefix)
-    record['compiledRelease'] = compile_releases(record['releases'])
+    merger = ReleaseMerger()
+    record['releases'] = [
+        merger.add(release) for release in
+        iter_tender_releases(tender, modelsMap, callbacks, prefix)
+    ]
+    record['compiledRelease'] = merger.compiled(record['releases'])
     record['ocid'] = record['releases'][0]['ocid']
     return record
 
@@ -371,7 +361,7 @@ def package_tenders(tenders, modelsMap, callbacks, config):
         if not tender:
             continue
         if 'patches' in tender:
-            releases.extend(release_tenders(tender, config.get('prefix')))
+            releases.extend(release_tenders(tender, modelsMap, callbacks, config.get('prefix')))
         else:
             releases.append(release_tender(tender, modelsMap, callbacks, config.get('prefix')))
     package['releases'] = releases
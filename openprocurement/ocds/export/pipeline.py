@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""Stages of greenlets connected by bounded queues.
+
+Each stage takes items from its inbox, processes them and puts results
+into its outbox, so reading, conversion and uploads of packages run at
+the same time. Blocking calls (CouchDB reads, S3 requests, zip writes)
+are run in the gevent thread pool with `threaded=True` and do not stop
+other stages. Every stage accounts the time its greenlets spend waiting
+on queues, which gives its utilisation at the end of a run.
+"""
+import logging
+from time import time
+from gevent import spawn, sleep, joinall, killall, get_hub
+from gevent.event import AsyncResult
+
+
+logger = logging.getLogger(__name__)
+END = object()
+
+
+class Stage(object):
+    """`concurrency` greenlets applying `func` to items of `inbox`
+
+    Results other than None are put into `outbox`. Instead of `func` a
+    `transform` taking and returning iterators may be given, it runs in
+    a single greenlet. Once the inbox is exhausted `on_end` is called
+    and the end of data is passed to `outbox` and to queues in `ends`.
+    """
+
+    def __init__(self, name, inbox, func=None, transform=None, outbox=None,
+                 concurrency=1, threaded=False, on_end=None, ends=()):
+        self.name = name
+        self.inbox = inbox
+        self.func = func
+        self.transform = transform
+        self.outbox = outbox
+        self.concurrency = 1 if transform else concurrency
+        self.threaded = threaded
+        self.on_end = on_end
+        self.ends = ([outbox] if outbox is not None else []) + list(ends)
+        self.items = 0
+        self.idle = 0.0
+        self.started = self.finished = None
+        self.running = 0
+
+    def _get(self):
+        start = time()
+        item = self.inbox.get()
+        self.idle += time() - start
+        return item
+
+    def _put(self, item):
+        start = time()
+        self.outbox.put(item)
+        self.idle += time() - start
+
+    def _call(self, func, *args):
+        if self.threaded:
+            return get_hub().threadpool.apply(func, args)
+        return func(*args)
+
+    def _items(self):
+        while True:
+            item = self._get()
+            if item is END:
+                self.inbox.put(END)
+                return
+            self.items += 1
+            yield item
+
+    def _work(self):
+        try:
+            if self.transform:
+                results = self.transform(self._items())
+            else:
+                results = (self._call(self.func, item) for item in self._items())
+            for result in results:
+                if result is not None and self.outbox is not None:
+                    self._put(result)
+        finally:
+            self.running -= 1
+        if not self.running:
+            if self.on_end:
+                self.on_end()
+            for queue in self.ends:
+                queue.put(END)
+            self.finished = time()
+
+    def start(self):
+        self.started = time()
+        self.running = self.concurrency
+        return [spawn(self._work) for _ in range(self.concurrency)]
+
+    def utilisation(self):
+        elapsed = ((self.finished or time()) - self.started) * self.concurrency
+        return 1 - self.idle / elapsed if elapsed else 0.0
+
+    def report(self):
+        return '{}: {} items, {} greenlets, {:.1%} busy'.format(
+            self.name, self.items, self.concurrency, self.utilisation())
+
+
+class Source(Stage):
+    """stage putting items of `iterable` into `outbox`"""
+
+    def __init__(self, name, iterable, outbox, threaded=False):
+        super(Source, self).__init__(name, None, outbox=outbox,
+                                     threaded=threaded)
+        self.iterable = iter(iterable)
+
+    def _items(self):
+        while True:
+            item = self._call(next, self.iterable, END)
+            if item is END:
+                return
+            self.items += 1
+            yield item
+
+    def _work(self):
+        try:
+            for item in self._items():
+                self._put(item)
+        finally:
+            self.running -= 1
+        for queue in self.ends:
+            queue.put(END)
+        self.finished = time()
+
+
+def submit(jobs, func, *args, **kwargs):
+    """queues a call of `func` to the stage reading `jobs`
+
+    Returns an `AsyncResult` of the call. Without `jobs` the call is made
+    at once.
+    """
+    result = AsyncResult()
+    if jobs is None:
+        result.set(func(*args, **kwargs))
+    else:
+        jobs.put((result, func, args, kwargs))
+    return result
+
+
+def run_job(job, apply=None):
+    """runs a call queued with `submit` in the gevent thread pool
+
+    Another `apply` with the signature of `ThreadPool.apply` may be given.
+    """
+    result, func, args, kwargs = job
+    apply = apply or get_hub().threadpool.apply
+    try:
+        result.set(apply(func, args, kwargs))
+    except Exception as e:
+        result.set_exception(e)
+
+
+def wait_result(result, interval=0.01):
+    """cooperatively waits for a `multiprocessing` async `result`"""
+    while not result.ready():
+        sleep(interval)
+    return result.get()
+
+
+class Pipeline(object):
+    """runs `stages` until all of them are done
+
+    The first error of any stage stops the whole pipeline and is raised.
+    """
+
+    def __init__(self, stages):
+        self.stages = stages
+
+    def run(self):
+        greenlets = []
+        for stage in self.stages:
+            greenlets.extend(stage.start())
+        try:
+            joinall(greenlets, raise_error=True)
+        finally:
+            killall([g for g in greenlets if not g.dead])
+
+    def report(self):
+        for stage in self.stages:
+            logger.info('Stage {}'.format(stage.report()))
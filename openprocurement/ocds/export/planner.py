@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""Uploads skipped when their content did not change.
+
+Packages carry the date they were published, so their bytes change on
+every run even when their releases do not. The planner compares the
+md5 of the releases (or records) of each package with the manifest of
+the previous run. An unchanged package differs from the previous one
+only in its header, which holds its `publishedDate` and `uri`: its first
+part, header included, is uploaded and the other parts are copied from
+the previous package within the bucket. Packages of a single part and
+archives are uploaded again. An object already stored at its key with
+the ETag of the package (a rerun) is not uploaded at all.
+
+The manifest maps names of objects without the date of the run (like
+`merged/release-0000001.json`) to their key, content digest, ETag, size
+and size of the header, and is saved to the bucket as `manifest.json`.
+"""
+import os
+import logging
+from hashlib import md5
+from tempfile import NamedTemporaryFile
+from botocore.exceptions import ClientError
+from gevent import spawn
+from simplejson import dumps, loads
+
+
+logger = logging.getLogger(__name__)
+MANIFEST = 'manifest.json'
+
+
+def missing(error):
+    """if a request failed with `error` as the object does not exist"""
+    return error.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound')
+
+
+def read_object(bucket, key):
+    """body of the object `key` of `bucket` or None"""
+    try:
+        return bucket.Object(key).get()['Body'].read()
+    except ClientError as e:
+        if not missing(e):
+            raise
+
+
+def stored_etag(bucket, key):
+    """ETag of the object `key` of `bucket` or None"""
+    try:
+        return bucket.Object(key).e_tag
+    except ClientError as e:
+        if not missing(e):
+            raise
+
+
+def etag(digests):
+    """ETag of an object uploaded in parts with md5 `digests`"""
+    if len(digests) == 1:
+        return '"{}"'.format(digests[0].hexdigest())
+    joined = md5(''.join(digest.digest() for digest in digests))
+    return '"{}-{}"'.format(joined.hexdigest(), len(digests))
+
+
+def file_etag(path, part_size):
+    """ETag of the file at `path` uploaded by `Uploader.upload_file`"""
+    digests = []
+    with open(path, 'rb') as stream:
+        for data in iter(lambda: stream.read(part_size), ''):
+            digests.append(md5(data))
+    return etag(digests or [md5()])
+
+
+class UploadPlanner(object):
+    """uploads through `uploader` what differs from the `previous` manifest"""
+
+    def __init__(self, uploader, previous=None):
+        self.uploader = uploader
+        self.previous = previous or {}
+        self.manifest = {}
+        self.saved = self.copied = self.skipped = 0
+
+    @classmethod
+    def load(cls, uploader):
+        """planner comparing with the manifest saved in the bucket"""
+        body = uploader.apply(read_object, (uploader.bucket, MANIFEST))
+        if body is None:
+            logger.info('No manifest of a previous run, uploading everything')
+            return cls(uploader)
+        return cls(uploader, loads(body))
+
+    def _stored(self, key, tag):
+        """if `key` is stored with the ETag `tag` already"""
+        if self.uploader.apply(stored_etag, (self.uploader.bucket, key)) != tag:
+            return False
+        self.skipped += 1
+        logger.info('{} is stored already, not uploaded'.format(key))
+        return True
+
+    def _previous(self, name, content, size, head):
+        """the previous object `name` with the same content past its header"""
+        entry = self.previous.get(name)
+        if (head is None or not content or size <= self.uploader.part_size or
+                not entry or entry['content'] != content or 'head' not in entry):
+            return
+        if entry['size'] - entry['head'] == size - head:
+            return entry
+
+    def put(self, name, key, body, content, content_type='application/json'):
+        """uploads `body` with the content digest `content` to `key`"""
+        tag = etag([md5(body)])
+        if self._stored(key, tag):
+            self.saved += len(body)
+        else:
+            self.uploader.put(key, body, content_type)
+        self.manifest[name] = dict(key=key, content=content, etag=tag, size=len(body))
+
+    def upload_file(self, name, key, path, content, content_type='application/zip',
+                    head=None):
+        """uploads the file at `path` with the content digest `content`
+
+        The file differs from an object of the same content in its first
+        `head` bytes at most, if given.
+        """
+        size = os.path.getsize(path)
+        tag = self.uploader.apply(file_etag, (path, self.uploader.part_size))
+        previous = self._previous(name, content, size, head)
+        if self._stored(key, tag):
+            self.saved += size
+        elif previous:
+            self.uploader.upload_head(path, key, previous['key'],
+                                      previous['head'] - head, content_type)
+            self.copied += 1
+            self.saved += size - self.uploader.part_size
+        else:
+            self.uploader.upload_file(path, key, content_type)
+        self.manifest[name] = dict(key=key, content=content, etag=tag, size=size)
+        if head is not None:
+            self.manifest[name]['head'] = head
+
+    def contents(self, prefix):
+        """digest of the contents of objects named with `prefix`, in order"""
+        digest = md5()
+        for name in sorted(self.manifest):
+            if name.startswith(prefix):
+                digest.update(self.manifest[name]['content'])
+        return digest.hexdigest()
+
+    def save(self):
+        self.uploader.put(MANIFEST, dumps(self.manifest, indent=4, sort_keys=True))
+        logger.info('Unchanged objects: {} copied past their header, {} kept,'
+                    ' {} bytes not uploaded'.format(self.copied, self.skipped,
+                                                    self.saved))
+
+
+class PlannedSink(object):
+    """uploads a package through an `UploadPlanner` once it is written
+
+    The package is written to a temporary file as its content is only
+    known at the end and unchanged packages are not uploaded. The first
+    data written is the header of the package.
+    """
+
+    def __init__(self, planner, name, key, content_type='application/json'):
+        self.planner = planner
+        self.name = name
+        self.key = key
+        self.content_type = content_type
+        self.stream = NamedTemporaryFile()
+        self.head = None
+
+    def write(self, data):
+        if self.head is None:
+            self.head = len(data)
+        self.stream.write(data)
+
+    def close(self, digest=None):
+        self.stream.flush()
+        return spawn(self._upload, digest)
+
+    def _upload(self, digest):
+        try:
+            self.planner.upload_file(self.name, self.key, self.stream.name,
+                                     digest, self.content_type, self.head)
+        finally:
+            self.stream.close()
+
+    def abort(self):
+        self.stream.close()
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""Replay of JSON patch chains on a single working document.
+
+`jsonpatch.apply_patch` deep-copies the whole document for every patch,
+so replaying the history of a tender copies it once per revision.
+`PatchReplay` applies RFC 6902 operations to one working document and
+copies only the objects on the path of each operation (copy on write).
+Neither the source document nor the patch values are ever modified, and
+a snapshot taken between patches stays valid after further patches are
+applied, at no cost.
+"""
+from copy import deepcopy
+from jsonpatch import (
+    InvalidJsonPatch,
+    JsonPatchConflict,
+    JsonPatchTestFailed,
+    JsonPointerException
+)
+
+
+_containers = (dict, list)
+
+
+def _parse(pointer):
+    if not isinstance(pointer, basestring):
+        raise InvalidJsonPatch("Path must be a string, not {!r}".format(pointer))
+    if not pointer:
+        return []
+    if not pointer.startswith('/'):
+        raise JsonPointerException('Location must start with /')
+    return [
+        part.replace('~1', '/').replace('~0', '~')
+        for part in pointer.split('/')[1:]
+    ]
+
+
+def _index(container, part, pointer, append=False):
+    if isinstance(container, dict):
+        return part
+    if not isinstance(container, list):
+        raise JsonPointerException(
+            "Document '{}' does not support indexing".format(pointer))
+    if append and part == '-':
+        return len(container)
+    if not part.isdigit() or (part != '0' and part.startswith('0')):
+        raise JsonPointerException("'{}' is not a valid list index".format(part))
+    return int(part)
+
+
+class PatchReplay(object):
+    """Applies consecutive patches to `document` without deep copies
+
+    Containers copied since the last `snapshot` are owned by the replay
+    and modified in place; any other container is copied the first time
+    an operation goes through it.
+    """
+
+    def __init__(self, document):
+        self.document = document
+        self._owned = {}
+
+    def _own(self, container):
+        if id(container) in self._owned:
+            return container
+        if isinstance(container, dict):
+            container = dict(container)
+        else:
+            container = list(container)
+        self._owned[id(container)] = container
+        return container
+
+    def _parent(self, parts, pointer):
+        """writable container holding the last part of `parts`"""
+        if not isinstance(self.document, _containers):
+            raise JsonPointerException(
+                "Document '{}' does not support indexing".format(pointer))
+        container = self.document = self._own(self.document)
+        for part in parts[:-1]:
+            key = _index(container, part, pointer)
+            try:
+                child = container[key]
+            except (KeyError, IndexError):
+                raise JsonPointerException(
+                    "member '{}' not found in {}".format(part, pointer))
+            if not isinstance(child, _containers):
+                raise JsonPointerException(
+                    "Document '{}' does not support indexing".format(pointer))
+            child = container[key] = self._own(child)
+            container = child
+        return container
+
+    def _get(self, parts, pointer):
+        value = self.document
+        for part in parts:
+            key = _index(value, part, pointer)
+            try:
+                value = value[key]
+            except (KeyError, IndexError):
+                raise JsonPointerException(
+                    "member '{}' not found in {}".format(part, pointer))
+        return value
+
+    def _add(self, parts, pointer, value):
+        if not parts:
+            self.document = value
+            return
+        container = self._parent(parts, pointer)
+        key = _index(container, parts[-1], pointer, append=True)
+        if isinstance(container, list):
+            if key > len(container):
+                raise JsonPatchConflict("can't insert outside of list")
+            container.insert(key, value)
+        else:
+            container[key] = value
+
+    def _remove(self, parts, pointer):
+        if not parts:
+            raise JsonPatchConflict("can't remove a whole document")
+        container = self._parent(parts, pointer)
+        key = _index(container, parts[-1], pointer)
+        try:
+            return container.pop(key)
+        except (KeyError, IndexError):
+            raise JsonPatchConflict(
+                "can't remove a non-existent object '{}'".format(parts[-1]))
+
+    def _replace(self, parts, pointer, value):
+        if not parts:
+            self.document = value
+            return
+        container = self._parent(parts, pointer)
+        key = _index(container, parts[-1], pointer)
+        if isinstance(container, list):
+            if key >= len(container):
+                raise JsonPatchConflict("can't replace outside of list")
+        elif key not in container:
+            raise JsonPatchConflict(
+                "can't replace a non-existent object '{}'".format(key))
+        container[key] = value
+
+    def apply_operation(self, operation):
+        if not isinstance(operation, dict) or 'op' not in operation:
+            raise InvalidJsonPatch("Operation does not contain 'op' member")
+        if 'path' not in operation:
+            raise InvalidJsonPatch("Operation must have a 'path' member")
+        op = operation['op']
+        pointer = operation['path']
+        parts = _parse(pointer)
+        if op in ('add', 'replace', 'test') and 'value' not in operation:
+            raise InvalidJsonPatch(
+                "The operation does not contain a 'value' member")
+        if op in ('move', 'copy') and 'from' not in operation:
+            raise InvalidJsonPatch(
+                "The operation does not contain a 'from' member")
+
+        if op == 'add':
+            self._add(parts, pointer, operation['value'])
+        elif op == 'remove':
+            self._remove(parts, pointer)
+        elif op == 'replace':
+            self._replace(parts, pointer, operation['value'])
+        elif op == 'move':
+            source = _parse(operation['from'])
+            if source == parts:
+                return
+            if source == parts[:len(source)]:
+                raise JsonPatchConflict(
+                    'Cannot move values into their own children')
+            self._add(parts, pointer,
+                      self._remove(source, operation['from']))
+        elif op == 'copy':
+            value = deepcopy(self._get(_parse(operation['from']),
+                                       operation['from']))
+            self._add(parts, pointer, value)
+        elif op == 'test':
+            try:
+                value = self._get(parts, pointer)
+            except JsonPointerException as e:
+                raise JsonPatchTestFailed(str(e))
+            if value != operation['value']:
+                raise JsonPatchTestFailed(
+                    '{!r} ({}) is not equal to tested value {!r} ({})'.format(
+                        value, type(value), operation['value'],
+                        type(operation['value'])))
+        else:
+            raise InvalidJsonPatch("Unknown operation {!r}".format(op))
+
+    def apply(self, patch):
+        """applies `patch` to the working document and returns it"""
+        for operation in patch:
+            self.apply_operation(operation)
+        return self.document
+
+    def snapshot(self):
+        """the working document, left intact by further patches"""
+        self._owned = {}
+        return self.document
+
+
+def replay_patches(document, patches):
+    """yields `document` after each of `patches`
+
+    Every yielded document is a snapshot sharing unchanged objects with
+    the previous one, so none of them may be modified by the caller.
+    """
+    replay = PatchReplay(document)
+    for patch in patches:
+        replay.apply(patch)
+        yield replay.snapshot()
+
+
+def apply_patches(document, patches):
+    """`document` after applying all `patches`, `document` is left intact"""
+    replay = PatchReplay(document)
+    for patch in patches:
+        replay.apply(patch)
+    return replay.document
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""Concurrent scans of CouchDB views split into ranges of keys.
+
+A scan is split into many more ranges than it has readers. Every
+reader greenlet takes the next range not read yet and fetches its pages
+of documents in a thread pool. Documents are yielded range after range,
+so they come in the order of keys as from a sequential `iterview`.
+Pages read ahead of the range being yielded share a budget of `buffer`
+pages, the range being yielded is read up to `prefetch` pages ahead, so
+readers keep going past a slow range without holding the whole view in
+memory. Pages are sized after the observed size of documents to hold
+about `page_bytes` of them.
+"""
+import logging
+from iso8601 import parse_date
+from simplejson import dumps
+from gevent import spawn, killall
+from gevent.event import Event
+from gevent.queue import Queue
+from gevent.threadpool import ThreadPool
+from openprocurement.ocds.export.pipeline import END
+
+
+logger = logging.getLogger(__name__)
+# documents serialized to estimate the size of a page
+SAMPLE = 10
+# ranges a scan is split into for each of its readers
+SPLIT = 64
+
+
+def id_boundaries(ranges):
+    """keys splitting random hex document ids into `ranges` ranges"""
+    step = 16 ** 4 // ranges
+    return ['{:04x}'.format(step * index) for index in range(1, ranges)]
+
+
+def date_boundaries(start, end, ranges):
+    """keys splitting dates from `start` to `end` into `ranges` ranges"""
+    start = parse_date(start)
+    step = (parse_date(end) - start) // ranges
+    return [(start + step * index).isoformat() for index in range(1, ranges)]
+
+
+class RangeScanner(object):
+    """documents of `view` of `db` read in ranges split at `boundaries`
+
+    `startkey` and `endkey` bound the whole scan, the end is inclusive
+    as in views. `prepare` is called with the documents of every page
+    in the thread reading it, and returns the documents to yield.
+    Ranges are read by `readers` greenlets, one for each range if not
+    given, and `buffer` is `prefetch` pages for each reader by default.
+    """
+
+    def __init__(self, db, view, boundaries, startkey=None, endkey=None,
+                 prepare=None, readers=None, prefetch=4, buffer=None,
+                 page=100, min_page=10, max_page=1000,
+                 page_bytes=16 * 1024 ** 2):
+        self.db = db
+        self.view = view
+        keys = [startkey] + list(boundaries) + [endkey]
+        self.ranges = [
+            (start, end, index == len(boundaries))
+            for index, (start, end) in enumerate(zip(keys, keys[1:]))
+        ]
+        self.prepare = prepare
+        self.readers = readers or len(self.ranges)
+        self.prefetch = prefetch
+        self.buffer = buffer or prefetch * self.readers
+        self.page = page
+        self.min_page = min_page
+        self.max_page = max_page
+        self.page_bytes = page_bytes
+        self.pages = self.docs = self.bytes = 0
+        # pages read and not yielded yet, index of the range being yielded
+        self.buffered = self.current = 0
+        self.changed = Event()
+
+    def _fetch(self, start, docid, end, inclusive, limit):
+        options = {'limit': limit + 1, 'include_docs': True}
+        if start is not None:
+            options['startkey'] = start
+        if docid is not None:
+            options['startkey_docid'] = docid
+        if end is not None:
+            options['endkey'] = end
+            options['inclusive_end'] = inclusive
+        rows = list(self.db.view(self.view, **options))
+        docs = [row.doc for row in rows[:limit]]
+        sample = docs[:SAMPLE]
+        size = sum(len(dumps(doc)) for doc in sample) // len(sample) if sample else 0
+        if self.prepare and docs:
+            docs = list(self.prepare(docs))
+        following = (rows[limit].key, rows[limit].id) if len(rows) > limit else None
+        return docs, size, following
+
+    def _notify(self):
+        """wakes up the readers waiting for room to read a page"""
+        changed, self.changed = self.changed, Event()
+        changed.set()
+
+    def _wait(self, index, queue):
+        """waits until the range `index` may read a page into `queue`"""
+        while True:
+            if index == self.current:
+                if queue.qsize() < self.prefetch:
+                    return
+            elif self.buffered < self.buffer:
+                return
+            self.changed.wait()
+
+    def _read(self, index, keys, queue):
+        start, end, inclusive = keys
+        docid, limit = None, self.page
+        try:
+            while True:
+                self._wait(index, queue)
+                docs, size, following = self.pool.apply(
+                    self._fetch, (start, docid, end, inclusive, limit))
+                self.pages += 1
+                self.docs += len(docs)
+                self.bytes += size * len(docs)
+                if size:
+                    limit = max(self.min_page,
+                                min(self.max_page, self.page_bytes // size))
+                self.buffered += 1
+                queue.put(docs)
+                if following is None:
+                    break
+                start, docid = following
+        except Exception as e:
+            queue.put(e)
+        queue.put(END)
+
+    def _reader(self, ranges, queues):
+        """reads the ranges of `ranges` not taken by other readers"""
+        for index, keys in ranges:
+            self._read(index, keys, queues[index])
+
+    def __iter__(self):
+        queues = [Queue() for _ in self.ranges]
+        ranges = iter(enumerate(self.ranges))
+        self.pool = ThreadPool(self.readers)
+        readers = [spawn(self._reader, ranges, queues)
+                   for _ in range(self.readers)]
+        try:
+            for self.current, queue in enumerate(queues):
+                self._notify()
+                for docs in iter(queue.get, END):
+                    if isinstance(docs, Exception):
+                        raise docs
+                    self.buffered -= 1
+                    self._notify()
+                    for doc in docs:
+                        yield doc
+        finally:
+            killall(readers)
+            # pages being fetched are let finish before the threads stop
+            self.pool.join()
+            self.pool.kill()
+            logger.info('Scanned {}: {} ranges, {} readers, {} pages,'
+                        ' {} documents, about {} bytes'.format(
+                            self.view, len(self.ranges), self.readers,
+                            self.pages, self.docs, self.bytes))
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import argparse
+import random
+import simplejson
+import jsonpatch
+from os.path import dirname, join
+from timeit import default_timer
+from openprocurement.ocds.export.replay import replay_patches
+
+
+TENDER = join(dirname(dirname(__file__)), 'tests', 'data', 'tender.json')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('Patch replay benchmark')
+    parser.add_argument('-t', '--tender', default=TENDER,
+                        help="Path to tender document")
+    parser.add_argument('-n', '--revisions', type=int, default=1000,
+                        help="Length of patch chain")
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def make_chain(tender, revisions, seed):
+    """`revisions` patches growing and editing `tender` as a real history does"""
+    rnd = random.Random(seed)
+    current = dict(tender, documents=[], awards=[], description='')
+    patches = [[
+        {'op': 'add', 'path': '/documents', 'value': []},
+        {'op': 'add', 'path': '/awards', 'value': []},
+        {'op': 'add', 'path': '/description', 'value': ''},
+    ]]
+    for revision in range(revisions):
+        patch = [{
+            'op': 'add',
+            'path': '/dateModified',
+            'value': '2017-01-01T00:00:{:06d}'.format(revision)
+        }]
+        choice = rnd.random()
+        if choice < 0.3:
+            patch.append({'op': 'add', 'path': '/documents/-', 'value': {
+                'id': str(revision), 'title': 'document {}'.format(revision)}})
+        elif choice < 0.5:
+            patch.append({'op': 'add', 'path': '/awards/-', 'value': {
+                'id': str(revision), 'status': 'pending'}})
+        elif choice < 0.8 and current['awards']:
+            index = rnd.randrange(len(current['awards']))
+            patch.append({'op': 'replace', 'path': '/awards/{}/status'.format(index),
+                          'value': rnd.choice(['active', 'unsuccessful'])})
+        else:
+            patch.append({'op': 'replace', 'path': '/description',
+                          'value': 'description {}'.format(revision)})
+        current = jsonpatch.apply_patch(current, patch)
+        patches.append(patch)
+    return patches
+
+
+def apply_each(tender, patches):
+    for patch in patches:
+        tender = jsonpatch.apply_patch(tender, patch)
+        yield tender
+
+
+def measure(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = default_timer()
+        func()
+        elapsed = default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run():
+    args = parse_args()
+    with open(args.tender) as stream:
+        tender = simplejson.load(stream)
+    tender.pop('patches', None)
+    patches = make_chain(tender, args.revisions, args.seed)
+
+    results = [
+        ('jsonpatch.apply_patch', measure(
+            lambda: list(apply_each(tender, patches)), args.repeat)),
+        ('replay_patches', measure(
+            lambda: list(replay_patches(tender, patches)), args.repeat)),
+    ]
+    print('{} revisions, best of {}'.format(args.revisions, args.repeat))
+    for name, elapsed in results:
+        print('{:<24}{:>10.3f}s{:>10.1f}x'.format(
+            name, elapsed, results[0][1] / elapsed))
+
+
+if __name__ == '__main__':
+    run()
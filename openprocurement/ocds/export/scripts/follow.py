@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""Continuous export of tenders following the `_changes` feed.
+
+Changed tenders are converted as soon as they are read and rolled into
+packages of at most `max_tenders` tenders, published at least every
+`max_age` seconds. A package holds the releases of the latest revision
+of each of its tenders. Once a package is uploaded the sequence of its
+last change is saved to the checkpoint. A restarted exporter resumes
+from it: changes of a package not published yet are read again and the
+package is published under the same name. Tenders failing to convert
+are logged and kept in the checkpoint until a later change of them
+converts.
+
+The `releases.json` index lists the packages in pages of at most
+`index_size` links: a full page is published once as
+`releases-<page>.json` and the index of the next page links to it as
+`prev`, so each publish uploads one page only.
+"""
+import argparse
+import logging
+from collections import OrderedDict
+from functools import partial
+from time import time
+from gevent import get_hub, sleep, spawn
+from gevent.queue import Empty, Queue
+from openprocurement.ocds.export.checkpoint import Checkpoint
+from simplejson import dumps
+from openprocurement.ocds.export.helpers import build_package, read_config
+from openprocurement.ocds.export.pipeline import Stage, run_job
+from openprocurement.ocds.export.writer import PackageWriter, S3Sink
+from openprocurement.ocds.export.scripts.packages import (
+    PROFILES,
+    REGISTRY,
+    configure,
+    convert_tender,
+    get_uploader,
+    upload_settings
+)
+
+
+LOGGER = logging.getLogger(__name__)
+# defaults of the `follow` section of the config
+FOLLOW = {
+    'checkpoint': 'follow.json',
+    'max_tenders': 4096,
+    'max_age': 60,
+    'index_size': 1000,
+    'name': 'live',
+    'queue_size': 1024,
+}
+
+
+def read_changes(storage, since, queue, retry=10):
+    """puts changes of tenders to be exported after `since` into `queue`
+
+    The feed is read in the gevent thread pool and is reopened from the
+    last sequence read when its connection fails or closes.
+    """
+    threadpool = get_hub().threadpool
+    while True:
+        try:
+            changes = storage.changes(feed='continuous', since=since,
+                                      include_docs=True, heartbeat=30000,
+                                      filter='_view', view='tenders/all')
+            while True:
+                change = threadpool.apply(next, (changes, None))
+                if change is None:
+                    break
+                if 'seq' in change:
+                    since = change['seq']
+                    queue.put(change)
+        except Exception as e:
+            LOGGER.warning('Changes feed failed: {}'.format(e))
+        sleep(retry)
+
+
+class Follower(object):
+    """rolls changed tenders into packages and checkpoints them"""
+
+    def __init__(self, checkpoint, max_tenders=4096, max_age=60,
+                 index_size=1000):
+        self.checkpoint = checkpoint
+        self.max_tenders = max_tenders
+        self.max_age = max_age
+        self.index_size = index_size
+        state = checkpoint.load()
+        self.seq = state.get('last_seq', 0)
+        self.nth = state.get('packages', 0)
+        # ids of tenders failed to convert
+        self.failed = set(state.get('failed', []))
+        self.pending = OrderedDict()
+        self.opened = None
+        self.jobs = Queue()
+        uploader = get_uploader()
+        self.uploads = Stage('upload', self.jobs,
+                             func=partial(run_job, apply=uploader.apply),
+                             concurrency=uploader.concurrency)
+        self.uploads.start()
+
+    def load(self, tender):
+        """`tender` with its history restored and its contracts joined"""
+        if tender.get('history'):
+            tender = next(REGISTRY['tenders_storage'].restore_history([tender]))
+        contracts = REGISTRY['contracts_storage']
+        if contracts:
+            tender_contracts = contracts.get_contracts_by_ten_id(tender['id'])
+            if tender_contracts:
+                tender['contracts'] = tender_contracts
+        return tender
+
+    def add(self, change):
+        """converts the tender of `change` into the pending package
+
+        Documents are read and the tender is converted in the gevent
+        thread pool, so the feed and uploads go on meanwhile.
+        """
+        self.seq = change['seq']
+        if change.get('deleted'):
+            return
+        threadpool = get_hub().threadpool
+        try:
+            tender = threadpool.apply(self.load, (change['doc'],))
+            converted = convert_tender(tender, apply=threadpool.apply)
+        except Exception as e:
+            LOGGER.error('Failed to convert tender id={} of change {}: {}'.format(
+                change['id'], change['seq'], e))
+            self.failed.add(change['id'])
+            return
+        self.failed.discard(change['id'])
+        self.pending.pop(tender['id'], None)
+        self.pending[tender['id']] = converted
+        if self.opened is None:
+            self.opened = time()
+
+    def timeout(self):
+        """seconds until the pending package is due, None without one"""
+        if self.opened is None:
+            return
+        return max(0, self.opened + self.max_age - time())
+
+    def due(self):
+        return len(self.pending) >= self.max_tenders or self.timeout() == 0
+
+    def publish(self):
+        """uploads the pending package and checkpoints its last change"""
+        config = REGISTRY['config']
+        kind = 'records' if REGISTRY['record'] else 'releases'
+        part_size = int(upload_settings()['part_size'])
+        self.nth += 1
+        name = self.package_name(self.nth)
+        results = []
+        for index, (url, prefix, _) in enumerate(PROFILES):
+            package = build_package(config.get('release'))
+            package['uri'] = REGISTRY[url].format(config.get('bucket'), REGISTRY['max_date'], name)
+            key = '{}_{}/{}'.format(prefix, REGISTRY['max_date'], name)
+            writer = PackageWriter(package, kind, [
+                S3Sink(REGISTRY['bucket'], key, part_size=part_size, jobs=self.jobs)
+            ])
+            for converted in self.pending.itervalues():
+                writer.write_items(converted[index])
+            results.extend(writer.close())
+        for result in results:
+            result.get()
+        self.publish_index()
+        if REGISTRY['cache']:
+            REGISTRY['cache'].commit()
+        self.checkpoint.save({'last_seq': self.seq, 'packages': self.nth,
+                              'failed': sorted(self.failed)})
+        LOGGER.info('Published {} with {} tenders up to change {}'.format(
+            name, len(self.pending), self.seq))
+        self.pending.clear()
+        self.opened = None
+
+    def package_name(self, nth):
+        kind = 'record' if REGISTRY['record'] else 'release'
+        return '{}-{:07d}.json'.format(kind, nth)
+
+    def publish_index(self):
+        """uploads the page of the index listing the last package"""
+        bucket = REGISTRY['config'].get('bucket')
+        page = (self.nth - 1) // self.index_size + 1
+        first = (page - 1) * self.index_size + 1
+        for url, prefix, _ in PROFILES:
+            links = {'all': [
+                REGISTRY[url].format(bucket, REGISTRY['max_date'], self.package_name(nth))
+                for nth in range(first, self.nth + 1)
+            ]}
+            if page > 1:
+                links['prev'] = REGISTRY[url].format(
+                    bucket, REGISTRY['max_date'], 'releases-{:04d}.json'.format(page - 1))
+            body = dumps({'links': links}, indent=4)
+            directory = '{}_{}'.format(prefix, REGISTRY['max_date'])
+            if self.nth == page * self.index_size:
+                get_uploader().put('{}/releases-{:04d}.json'.format(directory, page), body)
+            get_uploader().put('{}/releases.json'.format(directory), body)
+
+    def run(self, storage, queue_size=1024):
+        changes = Queue(queue_size)
+        reader = spawn(read_changes, storage, self.seq, changes)
+        LOGGER.info('Following changes since {}'.format(self.seq))
+        while not reader.dead:
+            try:
+                self.add(changes.get(timeout=self.timeout()))
+            except Empty:
+                pass
+            if self.due():
+                self.publish()
+        reader.get()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('Continuous export')
+    parser.add_argument('-c', '--config', required=True,
+                        help="Path to configuration file")
+    parser.add_argument('-rec', action='store_true', default=False,
+                        help='Choose to export record packages')
+    parser.add_argument('-contracting', action='store_true', default=False,
+                        help='Choose to include contracting')
+    return parser.parse_args()
+
+
+def run():
+    args = parse_args()
+    config = read_config(args.config)
+    configure(config, args.rec, args.contracting, log='follow.log')
+    settings = dict(FOLLOW, **config.get('follow') or {})
+    REGISTRY['max_date'] = settings['name']
+    follower = Follower(Checkpoint(settings['checkpoint']),
+                        int(settings['max_tenders']),
+                        float(settings['max_age']),
+                        int(settings['index_size']))
+    follower.run(REGISTRY['tenders_storage'], int(settings['queue_size']))
+
+
+if __name__ == '__main__':
+    run()
@@ -2,21 +2,60 @@
 import os
 import logging
 import couchdb.json
-import zipfile
 import boto3
 import requests
-from simplejson import dump, dumps
-from gevent import spawn, sleep, joinall
+from collections import deque
+from hashlib import md5
+from itertools import chain
+from multiprocessing import Pool
+from simplejson import dump, dumps, loads
+from functools import partial
+from gevent import spawn, sleep, joinall, get_hub
 from os.path import join
 from gevent.queue import Queue
-from gevent.event import Event
 from jinja2 import Environment, PackageLoader
-from openprocurement.ocds.export.storage import TendersStorage
-from openprocurement.ocds.export.models import package_tenders, package_records,\
-    callbacks, modelsMap
+from openprocurement.ocds.export import (
+    builder,
+    compiler,
+    helpers,
+    merge,
+    models,
+)
+from openprocurement.ocds.export.ext import models as ext_models
+from openprocurement.ocds.export.cache import (
+    ReleaseCache,
+    code_version,
+    deserialize,
+    modified,
+    serialize
+)
+from openprocurement.ocds.export.compiler import compile_model
+from openprocurement.ocds.export.pipeline import (
+    Pipeline,
+    Source,
+    Stage,
+    run_job,
+    wait_result
+)
+from openprocurement.ocds.export.writer import PackageWriter, S3Sink, ZipSink
+from openprocurement.ocds.export.scanner import RangeScanner
+from openprocurement.ocds.export.planner import (
+    PlannedSink,
+    UploadPlanner,
+    read_object
+)
+from openprocurement.ocds.export.storage import ContractsStorage, TendersStorage
+from openprocurement.ocds.export.uploader import Uploader
+from openprocurement.ocds.export.models import (
+    package_tenders,
+    package_records
+)
 from openprocurement.ocds.export.ext.models import (
+    ReleaseExt,
     package_tenders_ext,
     package_records_ext,
+    tender_releases_profiles,
+    tender_records_profiles,
     update_callbacks,
     update_models_map
 )
@@ -25,7 +64,9 @@ from openprocurement.ocds.export.helpers import (
     parse_dates,
     update_index,
     parse_args,
-    connect_bucket
+    connect_bucket,
+    build_package,
+    now
 )
 logging.getLogger('boto').setLevel(logging.WARN)
 logging.getLogger('boto3').setLevel(logging.WARN)
@@ -50,64 +91,90 @@ REGISTRY = {
     'can_url': 'http://{}/merged_{}/{}',
     'ext_url': 'http://{}/merged_with_extensions_{}/{}',
     'zip_path': '',
-    'zipq': Queue(),
-    'zipq_ext': Queue(),
-    'done': Event(),
-    'archives': Queue(),
+    'cache': None,
+    'uploader': None,
+    'planner': None,
+}
+# modules whose code defines the output cached by `ReleaseCache`
+CONVERTERS = (builder, compiler, helpers, merge, models, ext_models)
+# package url, s3 key prefix and archive directory of each profile
+PROFILES = (
+    ('can_url', 'merged', 'zip_path'),
+    ('ext_url', 'merged_with_extensions', 'zip_path_ext'),
+)
+# chain of the last full export and the deltas published after it
+EXPORTS = 'exports.json'
+# defaults of the `pipeline` section of the config
+PIPELINE = {
+    'queue_size': 64,
+    'scan_ranges': 1,
+}
+# defaults of the `upload` section of the config
+UPLOAD = {
+    'concurrency': 4,
+    'part_size': 8 * 1024 ** 2,
+    'retries': 3,
+    'skip_unchanged': False,
 }
-REGISTRY['package_funcs'] = [package_records, package_records_ext] if REGISTRY['record']\
-                            else  [package_tenders, package_tenders_ext]
+
+
+def pipeline_settings():
+    return dict(PIPELINE, **REGISTRY['config'].get('pipeline') or {})
+
+
+def upload_settings():
+    return dict(UPLOAD, **REGISTRY['config'].get('upload') or {})
+
+
+def make_uploader():
+    settings = upload_settings()
+    return Uploader(REGISTRY['bucket'],
+                    concurrency=int(settings['concurrency']),
+                    part_size=int(settings['part_size']),
+                    retries=int(settings['retries']))
+
+
+def get_uploader():
+    return REGISTRY['uploader'] or make_uploader()
 
 
 def dump_json_to_s3(name, data, pretty=False):
     LOGGER.info('Upload {} to s3 bucket'.format(name))
     time = REGISTRY['max_date']
 
-    dir_name = 'merged_with_extensions_{}/{}'.format(time, name) if\
-               'extensions' in data['uri'] else 'merged_{}/{}'.format(time, name)
+    prefix = 'merged_with_extensions' if 'extensions' in data['uri'] else 'merged'
+    dir_name = '{}_{}/{}'.format(prefix, time, name)
     try:
-        if pretty:
-            REGISTRY['bucket'].put_object(Key=dir_name, Body=dumps(data, indent=4), ContentType="application/json")
+        body = dumps(data, indent=4) if pretty else dumps(data)
+        if REGISTRY['planner']:
+            content = md5(dumps(dict(data, publishedDate=None, uri=None))).hexdigest()
+            REGISTRY['planner'].put('{}/{}'.format(prefix, name), dir_name, body, content)
         else:
-            REGISTRY['bucket'].put_object(Key=dir_name, Body=dumps(data), ContentType="application/json")
+            get_uploader().put(dir_name, body)
         del data
-        LOGGER.info("Successfully uploaded {}".format(name))
     except Exception as e:
         LOGGER.fatal("Exception duting upload {}".format(e))
 
 
-def zip_package(name, data):
-    zip_path = REGISTRY['zip_path'] if not 'ext' in data['uri'] else REGISTRY['zip_path_ext']
-    full_path = join(zip_path, 'releases.zip')
-    dir_name = 'merged_with_extensions_{}/releases.zip'.format(REGISTRY['max_date']) if\
-               'ext' in zip_path else 'merged_{}/releases.zip'.format(REGISTRY['max_date'])
-
-    with zipfile.ZipFile(full_path, 'a', zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
-        if not isinstance(data, (str, unicode)):
-            data = dumps(data)
-        try:
-            zf.writestr(name, data)
-            LOGGER.info("{} written to atchive {}".format(name, full_path))
-            del data
-        except Exception as e:
-            LOGGER.fatal("Unable to write package {} to archive {}".format(name, full_path))
-
-
 def upload_archives():
     LOGGER.info('Start uploading archives')
-    dirs = [
-        'merged_{}/releases.zip'.format(REGISTRY['max_date']),
-        'merged_with_extensions_{}/releases.zip'.format(REGISTRY['max_date'])
-    ]
+    uploader = get_uploader()
+    planner = REGISTRY['planner']
+    greenlets = []
+    for _, prefix, zip_path in PROFILES:
+        path = join(REGISTRY[zip_path], 'releases.zip')
+        key = '{}_{}/releases.zip'.format(prefix, REGISTRY['max_date'])
+        if planner:
+            # an archive did not change if none of its packages did
+            content = planner.contents('{}/{}-'.format(
+                prefix, 'record' if REGISTRY['record'] else 'release'))
+            greenlets.append(spawn(planner.upload_file, '{}/releases.zip'.format(prefix),
+                                   key, path, content))
+        else:
+            greenlets.append(spawn(uploader.upload_file, path, key))
+    joinall(greenlets, raise_error=True)
+    uploader.report()
 
-    paths = [
-        join(REGISTRY['zip_path'], 'releases.zip'),
-        join(REGISTRY['zip_path_ext'], 'releases.zip'),
-    ]
-    g = []
-    for path, name in zip(paths, dirs):
-        g.append(spawn(REGISTRY['bucket'].upload_file(path, name)))
-    joinall(g)
 
 def upload_releases_json(amount, max_date):
     upload_paths = ["merged_with_extensions_{}/releases.json".format(max_date), "merged_{}/releases.json".format(max_date)]
@@ -120,59 +187,329 @@ def upload_releases_json(amount, max_date):
                         for k in range(1, amount + 1)]
             }
         }
-        REGISTRY['bucket'].put_object(Key=upload, Body=dumps(to_upload, indent=4), ContentType="application/json")
-
-def fetch_and_dump(total):
-    num = 0
-    result = []
-    nth = 0
-    for res in REGISTRY['tenders_storage'].get_tender(REGISTRY['contracts_storage']):
-        if num == total:
-            nth += 1
-            start = result[0]['id']
-            end = result[-1]['id']
-            LOGGER.info('Start packaging {}th package! Params: startdoc={},'
-                        ' enddoc={}'.format(nth, start, end))
-            name = 'record-{0:07d}.json'.format(nth) if REGISTRY['record'] else 'release-{0:07d}.json'.format(nth)
-            max_date = REGISTRY['max_date']
-            try:
-                for pack, params in zip(REGISTRY['package_funcs'],
-                                        [{'uri': REGISTRY['can_url'],
-                                          'models': modelsMap,
-                                          'callbacks': callbacks,
-                                          'q': REGISTRY['zipq']},
-                                         {'uri': REGISTRY['ext_url'],
-                                          'models': update_models_map(),
-                                          'callbacks': update_callbacks(),
-                                          'q': REGISTRY['zipq_ext']}]):
-                    LOGGER.info("Start package: {}".format(pack.__name__))
-                    package = pack(result, params['models'], params['callbacks'], REGISTRY['config'].get('release'))
-                    package['uri'] = params['uri'].format(REGISTRY['config'].get("bucket"), max_date, name)
-                    if nth == 1:
-                        pretty_package = pack(result[:24], params['models'], params['callbacks'], REGISTRY['config'].get('release'))
-                        pretty_package['uri'] = params['uri'].format(REGISTRY['config'].get("bucket"), max_date, 'example.json')
-                        dump_json_to_s3('example.json', pretty_package, pretty=True)
-
-                    dump_json_to_s3(name, package)
-                    zip_package(name, package)
-                    del package
-                result = [res]
-                num = 1
-            except Exception as e:
-                LOGGER.info('Error: {}'.format(e))
-                return
-
-            LOGGER.info('Done {}th package! Params: startdoc={}, enddoc={}'.format(nth, start, end))
+        get_uploader().put(upload, dumps(to_upload, indent=4))
+
+def convert_profiles(tender):
+    """canonical and extension releases (or records) converted from `tender`"""
+    config = REGISTRY['config'].get('release')
+    if REGISTRY['record']:
+        return [[record] for record in tender_records_profiles(
+            tender, update_models_map(), update_callbacks(), config.get('prefix'))]
+    return tender_releases_profiles(
+        tender, update_models_map(), update_callbacks(), config.get('prefix'))
+
+
+def convert_tender(tender, use_cache=True, apply=None):
+    """canonical and extension releases (or records) of `tender`
+
+    With the release cache configured, tenders not modified since they
+    were cached are not converted: their serialized releases are reused.
+    The conversion is run with `apply` (e.g. of a thread pool) if given,
+    the cache is used by the calling thread only.
+    """
+    cache = REGISTRY['cache'] if use_cache else None
+    kind = 'records' if REGISTRY['record'] else 'releases'
+    if cache:
+        converted = cache.get(tender, kind)
+        if converted is not None:
+            return converted
+    if apply is None:
+        converted = convert_profiles(tender)
+    else:
+        converted = apply(convert_profiles, (tender,))
+    if cache:
+        converted = cache.put(tender, kind, converted)
+    return converted
+
+
+def build_packages(tenders, use_cache=True):
+    """canonical and extension packages from one conversion of `tenders`"""
+    config = REGISTRY['config'].get('release')
+    kind = 'records' if REGISTRY['record'] else 'releases'
+    packages = [build_package(config), build_package(config)]
+    for package in packages:
+        package[kind] = []
+    for tender in tenders:
+        if not tender:
+            continue
+        for package, items in zip(packages, convert_tender(tender, use_cache)):
+            package[kind].extend(items)
+    return packages
+
+
+def open_writers(name, uploads=None, archives=(None, None)):
+    """streaming writers of canonical and extension packages `name`
+
+    Uploads and archiving are queued to `uploads` and `archives` (one
+    queue for each profile) when given.
+    """
+    config = REGISTRY['config']
+    kind = 'records' if REGISTRY['record'] else 'releases'
+    part_size = int(upload_settings()['part_size'])
+    writers = []
+    for (url, prefix, zip_path), jobs in zip(PROFILES, archives):
+        package = build_package(config.get('release'))
+        package['uri'] = REGISTRY[url].format(config.get('bucket'), REGISTRY['max_date'], name)
+        key = '{}_{}/{}'.format(prefix, REGISTRY['max_date'], name)
+        if REGISTRY['planner']:
+            upload = PlannedSink(REGISTRY['planner'], '{}/{}'.format(prefix, name), key)
         else:
-            result.append(res)
-            num += 1
-    return nth
+            upload = S3Sink(REGISTRY['bucket'], key, part_size=part_size, jobs=uploads)
+        sinks = [
+            upload,
+            ZipSink(join(REGISTRY[zip_path], 'releases.zip'), name, jobs=jobs),
+        ]
+        writers.append(PackageWriter(package, kind, sinks))
+    return writers
 
-def run():
-    args = parse_args()
-    config = read_config(args.config)
+
+def dump_examples(tenders):
+    packages = build_packages(tenders, use_cache=False)
+    for package, (url, _, _) in zip(packages, PROFILES):
+        package['uri'] = REGISTRY[url].format(
+            REGISTRY['config'].get("bucket"), REGISTRY['max_date'], 'example.json')
+        dump_json_to_s3('example.json', package, pretty=True)
+
+
+def init_worker(config, record):
+    """preloads settings and converters in a conversion process"""
+    REGISTRY['config'] = config
+    REGISTRY['record'] = record
+    REGISTRY['cache'] = None
+    compile_model(ReleaseExt, update_models_map(), update_callbacks())
+
+
+def convert_batch(tenders):
+    """serialized canonical and extension outputs of `tenders`"""
+    return [
+        [serialize(items) for items in convert_tender(tender, use_cache=False)]
+        for tender in tenders
+    ]
+
+
+def make_pool(workers, config, record):
+    """pool of `workers` conversion processes, None for a single one
+
+    The pool is to be made before any thread is started: processes
+    forked from a threaded one may deadlock on locks held by threads.
+    """
+    if workers <= 1:
+        return
+    return Pool(workers, initializer=init_worker, initargs=(config, record))
+
+
+def convert_tenders(tenders, pool=None, batch_size=16):
+    """yields `tenders` with their converted releases, in order
+
+    With a `pool` of processes, batches of tenders missing from the
+    release cache are converted by it.
+    """
+    if pool is None:
+        for tender in tenders:
+            yield tender, convert_tender(tender)
+        return
+
+    cache = REGISTRY['cache']
+    kind = 'records' if REGISTRY['record'] else 'releases'
+    workers = pool._processes
+    pending = deque()
+
+    def finish(entries, result):
+        converted = iter(wait_result(result) if result else [])
+        for tender, cached in entries:
+            if cached is None:
+                canonical, extension = next(converted)
+                if cache:
+                    cached = cache.store(tender['id'], modified(tender), kind,
+                                         canonical, extension)
+                else:
+                    cached = [deserialize(canonical), deserialize(extension)]
+            yield tender, cached
+
+    batch = []
+    for tender in chain(tenders, [None]):
+        if tender:
+            batch.append(tender)
+        if len(batch) < batch_size and tender is not None:
+            continue
+        entries = [
+            (item, cache.get(item, kind) if cache else None)
+            for item in batch
+        ]
+        misses = [item for item, cached in entries if cached is None]
+        result = pool.apply_async(convert_batch, (misses,)) if misses else None
+        pending.append((entries, result))
+        batch = []
+        while pending and (len(pending) > workers * 2 or tender is None):
+            for item in finish(*pending.popleft()):
+                yield item
+
+
+class PackageStream(object):
+    """writes converted tenders into packages of `total` tenders"""
+
+    def __init__(self, total, uploads=None, archives=(None, None)):
+        self.total = total
+        self.uploads = uploads
+        self.archives = archives
+        self.writers = None
+        self.closing = []
+        self.examples = []
+        self.nth = 0
+        self.num = 0
+        self.start = self.end = None
+        self.error = None
+
+    def write(self, item):
+        tender, converted = item
+        if self.writers is None:
+            self.nth += 1
+            self.num = 0
+            self.start = tender['id']
+            name = 'record-{0:07d}.json'.format(self.nth) if REGISTRY['record'] else 'release-{0:07d}.json'.format(self.nth)
+            LOGGER.info('Start packaging {}th package! Params: startdoc={}'.format(self.nth, self.start))
+            self.writers = open_writers(name, self.uploads, self.archives)
+        for writer, items in zip(self.writers, converted):
+            writer.write_items(items)
+        self.num += 1
+        self.end = tender['id']
+        if self.nth == 1 and len(self.examples) < 24:
+            self.examples.append(tender)
+        if self.num == self.total:
+            self.close_package()
+
+    def close_package(self):
+        results = []
+        for writer in self.writers:
+            results.extend(result for result in writer.close() if result is not None)
+        self.closing.append(results)
+        self.writers = None
+        if REGISTRY['cache']:
+            REGISTRY['cache'].commit()
+        LOGGER.info('Done {}th package! Params: startdoc={}, enddoc={}'.format(self.nth, self.start, self.end))
+
+    def close(self):
+        """closes the last package and waits for all uploads"""
+        if self.writers is not None:
+            self.close_package()
+        for results in self.closing:
+            for result in results:
+                result.get()
+
+    def abort(self):
+        for writer in self.writers or []:
+            writer.abort()
+        self.writers = None
+
+    def completed(self):
+        """number of packages written and uploaded, in order"""
+        count = 0
+        for results in self.closing:
+            if not all(result.ready() and result.successful() for result in results):
+                break
+            count += 1
+        return count
+
+
+def export_tenders(tenders, total, pool=None):
+    """streams `tenders` into packages of `total` tenders
+
+    Reading, conversion, writing, uploads and archiving run as stages of
+    a pipeline connected by bounded queues. Returns the `PackageStream`,
+    with the `error` that stopped the run if any.
+    """
+    size = int(pipeline_settings()['queue_size'])
+    uploader = get_uploader()
+    threadpool = get_hub().threadpool
+    threadpool.maxsize = max(threadpool.maxsize, len(PROFILES) + 1)
+    read, converted, jobs = Queue(size), Queue(size), Queue(size)
+    archives = [Queue(size) for _ in PROFILES]
+    stream = PackageStream(total, jobs, archives)
+    stages = [
+        # scanners read in threads of their own
+        Source('read', tenders, read,
+               threaded=not isinstance(tenders, RangeScanner)),
+        Stage('convert', read, outbox=converted,
+              transform=lambda items: convert_tenders(items, pool)),
+        Stage('write', converted, func=stream.write, on_end=stream.close,
+              ends=[jobs] + archives),
+        Stage('upload', jobs, func=partial(run_job, apply=uploader.apply),
+              concurrency=uploader.concurrency),
+    ]
+    stages.extend(
+        Stage('archive {}'.format(prefix), queue, func=run_job)
+        for (_, prefix, _), queue in zip(PROFILES, archives)
+    )
+    pipeline = Pipeline(stages)
+    try:
+        pipeline.run()
+    except Exception as e:
+        LOGGER.info('Error: {}'.format(e))
+        stream.abort()
+        stream.error = e
+    finally:
+        pipeline.report()
+        if REGISTRY['contracts_storage']:
+            REGISTRY['contracts_storage'].report()
+    if stream.examples and not stream.error:
+        dump_examples(stream.examples)
+    return stream
+
+
+def fetch_and_dump(total, pool=None):
+    """streams all tenders into packages of `total` tenders
+
+    Returns the number of packages written.
+    """
+    tenders = REGISTRY['tenders_storage'].get_tender(
+        REGISTRY['contracts_storage'], int(pipeline_settings()['scan_ranges']))
+    stream = export_tenders(tenders, total, pool)
+    return stream.completed() if stream.error else stream.nth
+
+
+def read_exports():
+    """the chain of exports published to the bucket or None"""
+    uploader = get_uploader()
+    body = uploader.apply(read_object, (uploader.bucket, EXPORTS))
+    return loads(body) if body else None
+
+
+def record_export(exports, seq, amount):
+    """chains the packages of this run to `exports` and publishes them
+
+    `seq` is the sequence of the tenders database when the run started:
+    a delta run exports tenders changed after it. A full export (without
+    `exports`) starts a new chain.
+    """
+    entry = {
+        'name': REGISTRY['max_date'],
+        'packages': amount,
+        'seq': seq,
+        'releases': [
+            'http://{}/{}_{}/releases.json'.format(
+                REGISTRY['bucket'].name, prefix, REGISTRY['max_date'])
+            for _, prefix, _ in PROFILES
+        ],
+    }
+    if exports is None:
+        exports = {'full': entry, 'deltas': []}
+    else:
+        entry['since'] = exports['seq']
+        exports['deltas'].append(entry)
+    exports['seq'] = seq
+    get_uploader().put(EXPORTS, dumps(exports, indent=4))
+    return exports
+
+
+def delta_name(started):
+    """name of a delta run from the time it `started`"""
+    return 'delta_{}'.format(started.split('.')[0].replace(':', ''))
+
+
+def configure(config, record=False, contracting=False, log='pack.log'):
+    """fills `REGISTRY` from `config`"""
     REGISTRY['config'] = config
-    handler = logging.FileHandler(os.path.join(config.get('log_dir'), 'pack.log'))
+    handler = logging.FileHandler(os.path.join(config.get('log_dir'), log))
     formatter = logging.Formatter('%(asctime)s  %(name)-10s %(levelname)-7s %(message)s')
     handler.setFormatter(formatter)
     LOGGER.addHandler(handler)
@@ -180,19 +517,49 @@ def run():
                                         aws_access_key_id=config.get("aws_access_key_id"),
                                         aws_secret_access_key=config.get("aws_secret_access_key")).Bucket(config['bucket']
                                         )
+    REGISTRY['uploader'] = make_uploader()
     REGISTRY['tenders_storage'] = TendersStorage(config['tenders_db']['url'],
                                                  config['tenders_db']['name'])
     REGISTRY['db'] = REGISTRY['tenders_storage']
-    LOGGER.info('Start packaging')
-    REGISTRY['record'] = args.rec
-    REGISTRY['contracting'] = args.contracting
+    REGISTRY['record'] = record
+    REGISTRY['contracting'] = contracting
+    if contracting:
+        REGISTRY['contracts_storage'] = ContractsStorage(config['contracts_db']['url'],
+                                                         config['contracts_db']['name'])
     REGISTRY['zip_path'] = config['path_can']
     REGISTRY['zip_path_ext'] = config['path_ext']
+    if config.get('release_cache'):
+        REGISTRY['cache'] = ReleaseCache(
+            config['release_cache']['path'],
+            code_version(CONVERTERS, config.get('release'), contracting),
+            int(config['release_cache'].get('max_size', 2 * 1024 ** 3))
+        )
+
+
+def run():
+    args = parse_args()
+    config = read_config(args.config)
+    # forked before threads of uploads and reads are started
+    pool = make_pool(args.workers, config, args.rec)
+    try:
+        export(args, config, pool)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+
+def export(args, config, pool=None):
+    configure(config, args.rec, args.contracting)
+    if upload_settings()['skip_unchanged']:
+        REGISTRY['planner'] = UploadPlanner.load(REGISTRY['uploader'])
+    LOGGER.info('Start packaging')
     nam = 'records' if args.rec else 'releases'
 
     if args.dates:
         datestart, datefinish = parse_dates(args.dates)
-        to_release = REGISTRY['tenders_storage'].get_between_dates(datestart, datefinish)
+        to_release = REGISTRY['tenders_storage'].get_between_dates(
+            datestart, datefinish, int(pipeline_settings()['scan_ranges']))
         if args.rec:
             package_func = package_records_ext if args.ext else package_records
         else:
@@ -208,14 +575,41 @@ def run():
             path = os.path.join(archive, 'releases.zip')
             if os.path.exists(path):
                 os.remove(path)
+        # read before any tender, so that none saved during the run is
+        # left out of the next delta
+        seq = REGISTRY['tenders_storage'].get_update_seq()
         max_date = REGISTRY['tenders_storage'].get_max_date().split('T')[0]
+        exports = read_exports() if args.since_last_run else None
+        if args.since_last_run and not exports:
+            LOGGER.warn('No previous export found, exporting all tenders')
+        if exports:
+            # delta packages are new by definition and must not replace
+            # the manifest of the full export
+            REGISTRY['planner'] = None
+            max_date = delta_name(now())
+            tenders = REGISTRY['tenders_storage'].get_changed_since(
+                exports['seq'], REGISTRY['contracts_storage'])
+            LOGGER.info('Exporting tenders changed since {}'.format(exports['seq']))
+        else:
+            tenders = REGISTRY['tenders_storage'].get_tender(
+                REGISTRY['contracts_storage'], int(pipeline_settings()['scan_ranges']))
         REGISTRY['max_date'] = max_date
         total = int(args.number) if args.number else 4096
         sleep(1)
         LOGGER.info("Start working")
-        amount = fetch_and_dump(total)
-        upload_archives()
-        bucket = connect_bucket(config)
-        upload_releases_json(amount, max_date)
-        update_index(ENV, bucket)
+        stream = export_tenders(tenders, total, pool)
+        amount = stream.completed() if stream.error else stream.nth
+        if REGISTRY['cache']:
+            REGISTRY['cache'].close()
+        if exports and not amount:
+            LOGGER.info('No tenders changed since {}'.format(exports['seq']))
+        else:
+            upload_archives()
+            bucket = connect_bucket(config)
+            upload_releases_json(amount, max_date)
+            if REGISTRY['planner']:
+                REGISTRY['planner'].save()
+            if not stream.error:
+                record_export(exports, seq, amount)
+            update_index(ENV, bucket)
         requests.get('http://ping.pushmon.com/pushmon/ping/WDMnYJy')
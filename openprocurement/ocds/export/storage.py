@@ -1,20 +1,40 @@
 # -*- coding: utf-8 -*-
+import logging
+from functools import partial
+from itertools import islice
+from threading import Lock
+from time import time
 from couchdb import Database, http
 from couchdb.design import ViewDefinition
+from simplejson import loads
+from openprocurement.ocds.export.history import restore
+from openprocurement.ocds.export.scanner import (
+    SPLIT,
+    RangeScanner,
+    date_boundaries,
+    id_boundaries
+)
 
 
-tenders_map = u"""
-function(doc) {
+logger = logging.getLogger(__name__)
+
+
+# conditions of tenders to be exported
+tenders_filter = u"""
     if(doc.status.indexOf('draft') !== -1) {return;};
     if(doc.status.indexOf('terminated') !== -1) {return;};
     if((doc.doc_type || "" ) !== 'Tender') {return;}
     if((doc.title || "" ).search("ТЕСТУВАННЯ") !== -1) {return;}
     if((doc.title_ru || "" ).search("ТЕСТИРОВАНИЕ") !== -1) {return;}
     if((doc.title_en || "" ).search("TESTING") !== -1) {return;}
-    if((doc.mode || "") === 'test') {return;};
+    if((doc.mode || "") === 'test') {return;};"""
+
+
+tenders_map = u"""
+function(doc) {%s
     emit(doc._id, null);
 }
-"""
+""" % tenders_filter
 
 
 tenders_all = ViewDefinition(
@@ -46,6 +66,23 @@ get_contracts_by_tender_id = ViewDefinition(
 )
 
 
+def join_contracts(tenders, contracts, size=1000):
+    """yields `tenders` with their contracts from `contracts`
+
+    Contracts of `size` tenders at a time are fetched with one request.
+    """
+    tenders = iter(tenders)
+    while True:
+        batch = list(islice(tenders, size))
+        if not batch:
+            return
+        found = contracts.get_contracts_by_ten_ids([tender['id'] for tender in batch])
+        for tender in batch:
+            if tender['id'] in found:
+                tender['contracts'] = found[tender['id']]
+            yield tender
+
+
 def get_or_create(url, name):
     resource = http.Resource(url, session=None)
     try:
@@ -64,18 +101,38 @@ class TendersStorage(Database):
                                         tenders_date_modified,
                                         tenders_date_modified_for_package])
 
-    def get_tender(self, contracts=False):
-        for item in self.iterview('tenders/all',
-                                  1000,
-                                  include_docs=True,
-                                  ):
-            tender = item.doc
-            if contracts and contracts.get_contracts_by_ten_id(tender['id']):
-                tender['contracts'] = contracts.get_contracts_by_ten_id(tender['id'])
-                yield tender
-            else:
-                yield tender
-
+    def get_tender(self, contracts=False, ranges=1):
+        """tenders to be exported in order of ids
+
+        With more than one of `ranges` they are read concurrently by as
+        many readers.
+        """
+        if ranges > 1:
+            return RangeScanner(self, 'tenders/all', id_boundaries(ranges * SPLIT),
+                                prepare=partial(self.prepare, contracts=contracts),
+                                readers=ranges)
+        tenders = (item.doc for item in self.iterview('tenders/all',
+                                                      1000,
+                                                      include_docs=True,
+                                                      ))
+        return self.prepare(tenders, contracts)
+
+    def restore_history(self, tenders):
+        """`tenders` with the patches of their compacted history restored"""
+        for tender in tenders:
+            if tender.get('history'):
+                tender = restore(tender, [
+                    loads(self.get_attachment(tender, entry['name']).read())
+                    for entry in tender['history']
+                ])
+            yield tender
+
+    def prepare(self, tenders, contracts=False):
+        """`tenders` as they are exported"""
+        tenders = self.restore_history(tenders)
+        if contracts:
+            tenders = join_contracts(tenders, contracts)
+        return tenders
 
     def get_max_date(self):
         return next(iter(
@@ -84,7 +141,42 @@ class TendersStorage(Database):
                       descending=True).rows
         )).get('key')
 
-    def get_between_dates(self, sdate, edate):
+    def get_update_seq(self):
+        """sequence of the latest change of the database"""
+        return self.info()['update_seq']
+
+    def get_changed_since(self, since, contracts=False, batch=1000):
+        """tenders to be exported changed after the sequence `since`
+
+        Changes are read in the order they were saved rather than by
+        `dateModified`, which neither advances for historical tenders
+        nor orders tenders saved concurrently. Tenders changed again
+        while they are read come once, as they were first read.
+        """
+        return self.prepare(self._get_changed_since(since, batch), contracts)
+
+    def _get_changed_since(self, since, batch):
+        seen = set()
+        while True:
+            changes = self.changes(since=since, limit=batch, include_docs=True,
+                                   filter='_view', view='tenders/all')
+            if not changes['results']:
+                return
+            for change in changes['results']:
+                if change['id'] not in seen and not change.get('deleted'):
+                    seen.add(change['id'])
+                    yield change['doc']
+            since = changes['last_seq']
+
+    def get_between_dates(self, sdate, edate, ranges=1):
+        if ranges > 1:
+            return RangeScanner(self, 'tenders/by_dateModified_pack',
+                                date_boundaries(sdate, edate, ranges * SPLIT),
+                                startkey=sdate, endkey=edate,
+                                prepare=self.prepare, readers=ranges)
+        return self.prepare(self._get_between_dates(sdate, edate))
+
+    def _get_between_dates(self, sdate, edate):
         for item in self.iterview('tenders/by_dateModified_pack',
                                   1000,
                                   startkey=sdate,
@@ -100,9 +192,33 @@ class ContractsStorage(Database):
         get_or_create(db_url, name)
         super(ContractsStorage, self).__init__(url=url)
         ViewDefinition.sync_many(self, [get_contracts_by_tender_id])
+        self.requests = 0
+        self.elapsed = 0.0
+        self.joined = 0
+        self.lock = Lock()
 
     def get_contracts_by_ten_id(self, tender_id):
         return [item.doc for item in self.view('contracts/get_by_tender_id',
                                                key=tender_id,
                                                include_docs=True)
                                                if item.doc.get('status') != 'merged']
+
+    def get_contracts_by_ten_ids(self, tender_ids):
+        """contracts of `tender_ids` with one request, by tender id"""
+        start = time()
+        found = {}
+        for item in self.view('contracts/get_by_tender_id',
+                              keys=tender_ids,
+                              include_docs=True):
+            if item.doc.get('status') != 'merged':
+                found.setdefault(item.key, []).append(item.doc)
+        with self.lock:
+            # joins of concurrent scans run in several threads
+            self.requests += 1
+            self.joined += len(tender_ids)
+            self.elapsed += time() - start
+        return found
+
+    def report(self):
+        logger.info('Contracts join: {} tenders, {} requests, {:.1f}s'.format(
+            self.joined, self.requests, self.elapsed))
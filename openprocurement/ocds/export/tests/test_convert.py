@@ -8,6 +8,7 @@ from openprocurement.ocds.export.helpers import (
     convert_bids,
     convert_unit_and_location,
     create_auction,
+    release_update_tags,
 )
 
 from .utils import (
@@ -18,6 +19,8 @@ from .utils import (
     question
 )
 from copy import deepcopy
+import random
+import jsonpatch
 
 
 class TestConvertHelpers(object):
@@ -49,9 +52,11 @@ class TestConvertHelpers(object):
         lot_canc['relatedLot'] = '73039fc5ebf944b19d43a2122c4c3e8b'
         lot_canc['cancellationOf'] = 'lot'
         ten['cancellations'] = [cancellation.copy(), lot_canc]
-        convert_cancellation_and_tenderers(ten)
-        assert 'pendingCancellation' in ten
-        assert 'pendingCancellation' in ten['lots'][0]
+        new = convert_cancellation_and_tenderers(ten)
+        assert 'pendingCancellation' in new
+        assert 'pendingCancellation' in new['lots'][0]
+        assert 'pendingCancellation' not in ten
+        assert 'pendingCancellation' not in ten['lots'][0]
 
     def test_prepare_cancellation_documents(self):
         docs = prepare_cancellation_documents(cancellation.copy())
@@ -98,3 +103,118 @@ class TestConvertHelpers(object):
         for key in ['minimalStep', 'period', 'url']:
             assert key in auction[0]
             assert key in auction[1]
+
+
+def patch_tags(previous, release, sections):
+    """tags as published before, from a patch between the releases"""
+    tag = []
+    for op in jsonpatch.make_patch(previous, release).patch:
+        if op['path'] in ['/tag', '/id']:
+            continue
+        if op['op'] != 'add':
+            if not any(p in op['path'] for p in sections):
+                tag.append('tenderUpdate')
+            else:
+                for p in sections:
+                    if p in op['path']:
+                        tag.append(p[:-1] + 'Update')
+        else:
+            for p in sections:
+                if p in op['path']:
+                    tag.append(p[:-1])
+    return sorted(set(tag))
+
+
+class TestReleaseTags(object):
+
+    sections = ('awards', 'contracts', 'bids')
+    previous = {
+        'id': '1',
+        'tag': ['tender'],
+        'tender': {'id': 't', 'status': 'active', 'items': [{'id': 'i1'}]},
+        'awards': [{'id': 'a1', 'status': 'pending', 'documents': [{'id': 'd1'}]}],
+        'bids': {'details': [{'id': 'b1', 'relatedLot': 'l1'},
+                             {'id': 'b1', 'relatedLot': 'l2'}]},
+    }
+
+    def compare(self, previous, release):
+        """tags of `release`, checked to be the ones published before"""
+        tags = sorted(release_update_tags(previous, release, self.sections))
+        assert tags == patch_tags(dict(previous, tag=None), dict(release, tag=None),
+                                  self.sections)
+        return tags
+
+    def tags(self, **changes):
+        return self.compare(self.previous, dict(
+            self.previous, id='2', tag=['tenderUpdate'], **changes))
+
+    def test_unchanged(self):
+        assert self.tags() == []
+
+    def test_tender(self):
+        tender = self.previous['tender']
+        assert self.tags(tender=dict(tender, status='complete')) == ['tenderUpdate']
+        assert self.tags(tender=dict(tender, items=[])) == ['tenderUpdate']
+        # new tender fields are not tagged
+        assert self.tags(tender=dict(tender, title='new')) == []
+        assert self.tags(planning={'budget': {}}) == []
+
+    def test_sections(self):
+        awards = self.previous['awards']
+        assert self.tags(awards=awards + [{'id': 'a2'}]) == ['award']
+        assert self.tags(awards=[dict(awards[0], status='active')]) == ['awardUpdate']
+        assert self.tags(awards=[]) == ['awardUpdate']
+        assert self.tags(contracts=[{'id': 'c1'}]) == ['contract']
+        # additions within an existing award are awards too
+        assert self.tags(awards=[dict(awards[0], date='now')]) == ['award']
+        assert self.tags(awards=[dict(awards[0], documents=[{'id': 'd1'}, {'id': 'd2'}])]) == ['award']
+        assert self.tags(awards=[{'id': 'a0'}] + awards) == ['award', 'awardUpdate']
+
+    def test_moves(self):
+        details = self.previous['bids']['details']
+        assert self.tags(bids={'details': details[::-1]}) == ['bidUpdate']
+        assert self.tags(bids={'details': details[:1]}) == ['bidUpdate']
+        # moved from the tender into an award
+        tender = self.previous['tender']
+        assert self.tags(tender={'id': 't', 'status': 'active'},
+                         awards=[dict(self.previous['awards'][0], items=tender['items'])]) == ['awardUpdate']
+
+    def test_random_changes(self):
+        # lists of objects, as sections, items and documents are
+        rand = random.Random(5)
+        values = [None, 1, 'x', {'id': 'v'}, [{'id': 'w'}], {'id': 'w', 'v': [{}]}]
+        elements = [{'id': 'v'}, {'id': 'w'}, {'id': 'w', 'v': [{}]}]
+
+        def mutate(value):
+            if isinstance(value, dict) and value:
+                value = dict(value)
+                key = rand.choice(sorted(value))
+                action = rand.randint(0, 2)
+                if action == 0:
+                    del value[key]
+                elif action == 1:
+                    value['k{}'.format(rand.randint(0, 3))] = rand.choice(values)
+                else:
+                    value[key] = mutate(value[key])
+            elif isinstance(value, list) and value:
+                value = list(value)
+                index = rand.randrange(len(value))
+                action = rand.randint(0, 2)
+                if action == 0:
+                    del value[index]
+                elif action == 1:
+                    value.insert(index, rand.choice(elements))
+                elif isinstance(value[index], dict):
+                    value[index] = mutate(value[index])
+            else:
+                value = rand.choice(values)
+            return value
+
+        release = deepcopy(self.previous)
+        for _ in range(300):
+            changed = release
+            for _ in range(rand.randint(1, 2)):
+                changed = mutate(changed)
+            changed = dict(changed, id='2', tag=['tenderUpdate'])
+            self.compare(release, changed)
+            release = changed
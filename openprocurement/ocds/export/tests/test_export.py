@@ -2,6 +2,7 @@ from openprocurement.ocds.export.models import (
     Award,
     Contract,
     Tender,
+    Release,
     release_tender,
     release_tenders,
     package_tenders,
@@ -13,19 +14,95 @@ from openprocurement.ocds.export.ext.models import (
     TenderExt,
     AwardExt,
     ContractExt,
+    ReleaseExt,
     update_models_map,
     update_callbacks,
     release_tender_ext,
     release_tenders_ext,
     record_tenders_ext,
-    package_tenders_ext
+    package_tenders_ext,
+    release_tender_profiles,
+    release_tenders_profiles,
+    package_tenders_profiles,
+    package_records_profiles
 )
+from openprocurement.ocds.export.compiler import compile_model
+from openprocurement.ocds.export.builder import changed_paths
+from openprocurement.ocds.export.merge import ReleaseMerger
+from openprocurement.ocds.export.cache import ReleaseCache
+from openprocurement.ocds.export.scripts import packages
+from openprocurement.ocds.export.writer import (
+    PackageWriter,
+    FileSink,
+    ZipSink,
+    S3Sink
+)
+from openprocurement.ocds.export.uploader import Uploader
+from openprocurement.ocds.export.checkpoint import Checkpoint
+from openprocurement.ocds.export.storage import TendersStorage, join_contracts
+from openprocurement.ocds.export.index import ModifiedIndex
+from openprocurement.ocds.export.bulk import BulkWriter
+from openprocurement.ocds.export.history import (
+    LatestStates,
+    compact,
+    latest
+)
+from openprocurement.ocds.export.bridge import APIDataBridge
+from openprocurement.ocds.export.control import FetchController
+from openprocurement.ocds.export.feed import APIRetreiver
+from openprocurement.ocds.export.contrib.retreive import cookies_changed
+from openprocurement.ocds.export import feed
+from requests.cookies import RequestsCookieJar
+from requests.exceptions import ConnectionError
+from openprocurement.ocds.export.scanner import (
+    RangeScanner,
+    date_boundaries,
+    id_boundaries
+)
+from openprocurement.ocds.export.scripts.follow import Follower
+from openprocurement.ocds.export.planner import (
+    PlannedSink,
+    UploadPlanner,
+    etag
+)
+from openprocurement.ocds.export.pipeline import (
+    Pipeline,
+    Source,
+    Stage,
+    run_job
+)
+from openprocurement.ocds.export.replay import (
+    PatchReplay,
+    replay_patches,
+    apply_patches
+)
+from openprocurement.ocds.export.helpers import (
+    release_id,
+    release_tags,
+    release_update_tags
+)
+import os
+import jsonpatch
+import simplejson
+import zipfile
+import ocdsmerge
+import pytest
+import gevent
+from gevent.queue import Queue
+from hashlib import md5
+from collections import deque
+from StringIO import StringIO
+from botocore.exceptions import ClientError
+from couchdb.client import Row
+from couchdb.http import ResourceConflict
 from .utils import (
     award,
+    cancellation,
     contract,
     tender,
     config
 )
+from copy import deepcopy
 
 
 class TestModels(object):
@@ -219,3 +296,1296 @@ class TestExportExt(object):
         record = record_tenders_ext(ten, update_models_map(), update_callbacks(), 'test')
         assert len(record['releases']) == 2
         assert record['ocid'] == record['releases'][0]['ocid']
+
+
+class TestCompiledModels(object):
+
+    def prepare_tender(self):
+        ten = deepcopy(tender)
+        ten['awards'] = [deepcopy(award)]
+        ten['contracts'] = [deepcopy(contract)]
+        return ten
+
+    def test_release(self):
+        expected = Release(self.prepare_tender(), modelsMap, callbacks, 'test').__export__()
+        release = compile_model(Release, modelsMap, callbacks)(self.prepare_tender(), 'test')
+        assert 'id' not in release
+        assert expected.pop('id') == release_id(expected)
+        assert release == expected
+        assert 'numberOfTenderers' in release['tender']
+
+    def test_release_ext(self):
+        models, cbs = update_models_map(), update_callbacks()
+        expected = ReleaseExt(self.prepare_tender(), models, cbs, 'test').__export__()
+        release = compile_model(ReleaseExt, models, cbs)(self.prepare_tender(), 'test')
+        expected.pop('id')
+        assert release == expected
+        assert 'bids' in release
+
+    def test_nested_model(self):
+        convert = compile_model(Award, modelsMap, callbacks)
+        assert convert(deepcopy(award)) == Award(deepcopy(award), modelsMap, callbacks).__export__()
+
+    def test_cache(self):
+        convert = compile_model(ReleaseExt, update_models_map(), update_callbacks())
+        assert compile_model(ReleaseExt, update_models_map(), update_callbacks()) is convert
+        assert compile_model(Release, modelsMap, callbacks) is not convert
+
+
+class TestProfiles(object):
+
+    def test_release_tender_profiles(self):
+        ten = deepcopy(tender)
+        ten['awards'] = [deepcopy(award)]
+        original = deepcopy(ten)
+        release, release_ext = release_tender_profiles(ten, update_models_map(), update_callbacks(), 'test')
+        assert ten == original
+        assert release['tag'] == ['tender', 'award']
+        assert release_ext['tag'] == ['tender', 'award', 'bid']
+        assert 'bids' not in release
+        assert 'lots' not in release['tender']
+        assert release['id'] != release_ext['id']
+        expected = release_tender(deepcopy(original), modelsMap, callbacks, 'test')
+        expected_ext = release_tender_ext(original, update_models_map(), update_callbacks(), 'test')
+        for data in (release, release_ext, expected, expected_ext):
+            data.pop('id')
+        assert release == expected
+        assert release_ext == expected_ext
+
+    def cancelled_tender(self):
+        ten = deepcopy(tender)
+        ten['awards'] = [deepcopy(award)]
+        ten['items'][0]['unit'] = {'code': 'KGM', 'name': u'кілограми'}
+        ten['documents'] = [dict(cancellation['documents'][0], id='own')]
+        ten['cancellations'] = [deepcopy(cancellation)]
+        return ten
+
+    def test_canonical_release(self):
+        ten = self.cancelled_tender()
+        release, release_ext = release_tender_profiles(
+            deepcopy(ten), update_models_map(), update_callbacks(), 'test')
+        assert release_ext['tender']['items'][0]['unit']['name'] == 'kilogram'
+        assert len(release_ext['tender']['documents']) == 2
+        expected = release_tender(ten, modelsMap, callbacks, 'test')
+        assert expected['tender']['items'][0]['unit']['name'] == u'кілограми'
+        assert simplejson.dumps(release) == simplejson.dumps(expected)
+
+    def test_canonical_releases(self):
+        ten = self.cancelled_tender()
+        ten['patches'] = deepcopy(TestReleaseBuilder.patches) + [
+            [{"op": "replace", "path": "/items/0/unit/code", "value": "MTR"}],
+            [{"op": "remove", "path": "/cancellations"}],
+        ]
+        releases, _ = release_tenders_profiles(
+            deepcopy(ten), update_models_map(), update_callbacks(), 'test')
+        expected = release_tenders(ten, modelsMap, callbacks, 'test')
+        assert simplejson.dumps(releases) == simplejson.dumps(expected)
+
+    def test_release_tenders_profiles(self):
+        ten = deepcopy(tender)
+        ten['patches'] = [
+            [{"op": "replace", "path": "/description", "value": "test"}],
+            [{"op": "replace", "path": "/bids/0/status", "value": "test"},
+             {"op": "add", "path": "/awards", "value": [award]}],
+        ]
+        releases, releases_ext = release_tenders_profiles(ten, update_models_map(), update_callbacks(), 'test')
+        assert 'patches' in ten
+        assert len(releases) == len(releases_ext) == 3
+        assert releases[1]['tag'] == releases_ext[1]['tag'] == ['tenderUpdate']
+        assert sorted(releases_ext[2]['tag']) == ['award', 'bidUpdate']
+        assert releases[2]['tag'] == ['award']
+        assert releases[1]['tender']['description'] == 'test'
+
+    def test_package_tenders_profiles(self):
+        package, package_ext = package_tenders_profiles(
+            [deepcopy(tender) for _ in xrange(3)], update_models_map(), update_callbacks(), config
+        )
+        assert len(package['releases']) == len(package_ext['releases']) == 3
+        assert all('bids' in release for release in package_ext['releases'])
+        assert not any('bids' in release for release in package['releases'])
+        assert package['publisher'] == package_ext['publisher']
+
+
+class TestReleaseBuilder(object):
+
+    patches = [
+        [{"op": "replace", "path": "/awards/0/status", "value": "test"}],
+        [{"op": "replace", "path": "/description", "value": "test"},
+         {"op": "replace", "path": "/dateModified", "value": "2017-01-01T00:00:00"}],
+        [{"op": "add", "path": "/awards/1", "value": dict(award, id='second')}],
+        [{"op": "replace", "path": "/items/0/quantity", "value": 10}],
+        [{"op": "remove", "path": "/awards/0"}],
+        [{"op": "add", "path": "/contracts", "value": [contract]}],
+        [{"op": "replace", "path": "/contracts/0/status", "value": "test"}],
+        [{"op": "replace", "path": "/bids/0/status", "value": "test"}],
+    ]
+
+    def full_releases(self, ten, klass, models, cbs, tag_sections):
+        convert = compile_model(klass, models, cbs)
+        previous = convert(ten, 'test')
+        previous['tag'] = list(set(release_tags(previous, tag_sections)))
+        releases = [previous]
+        for patch in self.patches:
+            ten = jsonpatch.apply_patch(ten, patch)
+            release = convert(ten, 'test')
+            release['tag'] = release_update_tags(previous, release, tag_sections)
+            releases.append(release)
+            previous = release
+        return releases
+
+    def prepare_tender(self):
+        ten = deepcopy(tender)
+        ten['awards'] = [deepcopy(award)]
+        return ten
+
+    def strip(self, releases):
+        return [{k: v for k, v in r.items() if k != 'id'} for r in releases]
+
+    def test_changed_paths(self):
+        assert list(changed_paths(self.patches[0])) == [('awards', 0)]
+        assert list(changed_paths(self.patches[2])) == [('awards', None)]
+        assert list(changed_paths([{"op": "move", "from": "/a~1b/1", "path": "/c"}])) == \
+            [('c', None), ('a/b', None)]
+
+    def test_release_tenders(self):
+        expected = self.full_releases(self.prepare_tender(), Release, modelsMap, callbacks, ('awards', 'contracts'))
+        ten = self.prepare_tender()
+        ten['patches'] = self.patches
+        releases = release_tenders(ten, modelsMap, callbacks, 'test')
+        assert self.strip(releases) == self.strip(expected)
+        assert releases[1]['tender'] is releases[0]['tender']
+        assert releases[2]['awards'] is releases[1]['awards']
+
+    def test_deterministic_ids(self):
+        ten = self.prepare_tender()
+        ten['patches'] = self.patches
+        releases = release_tenders(deepcopy(ten), modelsMap, callbacks, 'test')
+        again = release_tenders(deepcopy(ten), modelsMap, callbacks, 'test')
+        assert [r['id'] for r in releases] == [r['id'] for r in again]
+        assert len(set(r['id'] for r in releases)) == len(releases)
+        for revision, release in enumerate(releases):
+            assert release['id'] == release_id(dict(release), revision)
+
+    def test_release_tenders_ext(self):
+        models, cbs = update_models_map(), update_callbacks()
+        expected = self.full_releases(self.prepare_tender(), ReleaseExt, models, cbs, ('awards', 'contracts', 'bids'))
+        ten = self.prepare_tender()
+        ten['patches'] = self.patches
+        releases = release_tenders_ext(ten, models, cbs, 'test')
+        assert self.strip(releases) == self.strip(expected)
+        assert releases[-1]['tag'] == ['bidUpdate']
+
+
+class TestPatchReplay(object):
+
+    patches = [
+        [{"op": "add", "path": "/awards", "value": [award]}],
+        [{"op": "replace", "path": "/awards/0/status", "value": "active"},
+         {"op": "add", "path": "/awards/0/documents", "value": []}],
+        [{"op": "add", "path": "/awards/0/documents/-", "value": {"id": "1"}},
+         {"op": "add", "path": "/a~1b", "value": {"c~d": 1}}],
+        [{"op": "copy", "from": "/awards/0", "path": "/awards/1"},
+         {"op": "replace", "path": "/awards/1/documents/0/id", "value": "2"}],
+        [{"op": "move", "from": "/a~1b", "path": "/items/0/extra"},
+         {"op": "test", "path": "/items/0/extra/c~0d", "value": 1}],
+        [{"op": "remove", "path": "/awards/0"},
+         {"op": "remove", "path": "/description"}],
+    ]
+
+    def test_matches_jsonpatch(self):
+        source = deepcopy(tender)
+        expected, current = [], source
+        for patch in self.patches:
+            current = jsonpatch.apply_patch(current, patch)
+            expected.append(current)
+        assert list(replay_patches(source, self.patches)) == expected
+        assert apply_patches(source, self.patches) == expected[-1]
+        assert source == tender
+        assert self.patches[0][0]['value'] == [award]
+
+    def test_snapshots(self):
+        replay = PatchReplay(tender)
+        replay.apply(self.patches[0])
+        first = replay.snapshot()
+        replay.apply(self.patches[1])
+        second = replay.snapshot()
+        assert first['awards'][0]['status'] == award['status']
+        assert second['awards'][0]['status'] == 'active'
+        assert first['items'] is second['items']
+
+    def test_errors(self):
+        replay = PatchReplay(deepcopy(tender))
+        with pytest.raises(jsonpatch.JsonPatchConflict):
+            replay.apply([{"op": "remove", "path": "/missing"}])
+        with pytest.raises(jsonpatch.JsonPatchConflict):
+            replay.apply([{"op": "replace", "path": "/items/5", "value": 1}])
+        with pytest.raises(jsonpatch.JsonPointerException):
+            replay.apply([{"op": "add", "path": "/missing/0", "value": 1}])
+        with pytest.raises(jsonpatch.JsonPatchTestFailed):
+            replay.apply([{"op": "test", "path": "/id", "value": 1}])
+        with pytest.raises(jsonpatch.InvalidJsonPatch):
+            replay.apply([{"op": "rename", "path": "/id"}])
+
+
+class TestReleaseMerger(object):
+
+    def records(self):
+        ten = deepcopy(tender)
+        ten['awards'] = [deepcopy(award)]
+        ten['patches'] = deepcopy(TestReleaseBuilder.patches)
+        yield record_tenders(deepcopy(ten), modelsMap, callbacks, 'test')
+        yield record_tenders_ext(deepcopy(ten), update_models_map(), update_callbacks(), 'test')
+        for package in package_records_profiles([ten], update_models_map(), update_callbacks(), config):
+            yield package['records'][0]
+
+    def test_matches_ocdsmerge(self):
+        for record in self.records():
+            assert len(record['releases']) > 1
+            assert record['compiledRelease'] == ocdsmerge.merge(record['releases'])
+
+    def test_out_of_order(self):
+        releases = [
+            {'id': '1', 'date': '2017-02-01', 'tag': ['tender'], 'tender': {'status': 'complete'}},
+            {'id': '2', 'date': '2017-01-01', 'tag': ['tender'], 'tender': {'status': 'active'}},
+        ]
+        merger = ReleaseMerger()
+        for release in releases:
+            merger.add(release)
+        assert not merger.ordered
+        assert merger.compiled(releases) == ocdsmerge.merge(releases)
+        assert merger.compiled(releases)['tender']['status'] == 'complete'
+
+
+class TestReleaseCache(object):
+
+    def converted(self):
+        ten = TestReleaseBuilder().prepare_tender()
+        ten['id'] = 'tender'
+        ten['patches'] = deepcopy(TestReleaseBuilder.patches)
+        return ten, release_tenders_profiles(ten, update_models_map(), update_callbacks(), 'test')
+
+    def test_hit(self, tmpdir):
+        cache = ReleaseCache(str(tmpdir.join('cache.sqlite')), 'v1')
+        ten, converted = self.converted()
+        assert cache.get(ten, 'releases') is None
+        raw = cache.put(ten, 'releases', converted)
+        assert simplejson.dumps(raw) == simplejson.dumps(converted)
+        cache.close()
+
+        cache = ReleaseCache(str(tmpdir.join('cache.sqlite')), 'v1')
+        assert simplejson.dumps(cache.get(ten, 'releases')) == simplejson.dumps(converted)
+        assert cache.get(ten, 'records') is None
+        assert cache.get(dict(ten, dateModified='2100-01-01'), 'releases') is None
+        assert (cache.hits, cache.misses) == (1, 2)
+        assert ReleaseCache(str(tmpdir.join('cache.sqlite')), 'v2').get(ten, 'releases') is None
+
+    def test_history(self, tmpdir):
+        cache = ReleaseCache(str(tmpdir.join('cache.sqlite')), 'v1')
+        ten, converted = self.converted()
+        ten['version'] = '3'
+        cache.put(ten, 'releases', converted)
+        assert cache.get(ten, 'releases') is not None
+        appended = dict(ten, version='4', patches=ten['patches'] + [
+            [{'op': 'replace', 'path': '/title', 'value': 'changed'}]])
+        assert appended['dateModified'] == ten['dateModified']
+        assert cache.get(appended, 'releases') is None
+        compacted = dict(ten, patches=[], history=[
+            {'revision': 0, 'patches': len(ten['patches']) - 1, 'name': 'x'}])
+        assert cache.get(compacted, 'releases') is None
+
+    def test_eviction(self, tmpdir):
+        cache = ReleaseCache(str(tmpdir.join('cache.sqlite')), 'v1')
+        ten, converted = self.converted()
+        cache.put(ten, 'releases', converted)
+        cache.max_size = cache.size * 2 - 1
+        cache.put(dict(ten, id='other'), 'releases', converted)
+        assert cache.evicted == 1
+        assert cache.get(ten, 'releases') is None
+        assert cache.get(dict(ten, id='other'), 'releases') is not None
+
+
+class FakeUpload(object):
+
+    def __init__(self, bucket, key):
+        self.bucket, self.object_key, self.stored = bucket, key, {}
+
+    def Part(self, number):
+        upload = self
+
+        class Part(object):
+            def upload(self, Body):
+                if upload.bucket.failures:
+                    upload.bucket.failures -= 1
+                    raise IOError('Connection reset')
+                upload.stored[number] = Body
+                return {'ETag': '"{}"'.format(md5(Body).hexdigest())}
+
+            def copy_from(self, CopySource, CopySourceRange):
+                first, last = map(int, CopySourceRange.split('=')[1].split('-'))
+                upload.bucket.copies.append((CopySource['Key'], upload.object_key))
+                upload.stored[number] = upload.bucket.objects[CopySource['Key']][first:last + 1]
+                return {'CopyPartResult': {
+                    'ETag': '"{}"'.format(md5(upload.stored[number]).hexdigest())}}
+        return Part()
+
+    @property
+    def parts(self):
+        return FakeCollection(
+            FakePart(number, '"{}"'.format(md5(body).hexdigest()))
+            for number, body in self.stored.items()
+        )
+
+    def complete(self, MultipartUpload):
+        numbers = [p['PartNumber'] for p in MultipartUpload['Parts']]
+        self.bucket.objects[self.object_key] = ''.join(self.stored[n] for n in numbers)
+        self.bucket.etags[self.object_key] = etag([md5(self.stored[n]) for n in numbers])
+        self.bucket.pending.remove(self)
+
+    def abort(self):
+        self.bucket.aborted.append(self.object_key)
+        self.bucket.pending.remove(self)
+
+
+class FakePart(object):
+
+    def __init__(self, part_number, e_tag):
+        self.part_number, self.e_tag = part_number, e_tag
+
+
+class FakeCollection(list):
+
+    def all(self):
+        return self
+
+    def filter(self, Prefix):
+        return [item for item in self if item.object_key.startswith(Prefix)]
+
+
+class FakeBucket(object):
+    """S3 bucket stand-in failing the next `failures` part uploads"""
+
+    name = 'fake'
+
+    def __init__(self):
+        self.objects, self.uploads, self.aborted = {}, [], []
+        self.pending = FakeCollection()
+        self.failures = 0
+        self.etags, self.copies = {}, []
+
+    @property
+    def multipart_uploads(self):
+        return self.pending
+
+    def put_object(self, Key, Body, ContentType):
+        self.objects[Key] = Body
+        self.etags[Key] = '"{}"'.format(md5(Body).hexdigest())
+
+    def Object(self, key):
+        bucket = self
+
+        def missing():
+            if key not in bucket.objects:
+                raise ClientError({'Error': {'Code': '404'}, 'ResponseMetadata': {
+                    'HTTPStatusCode': 404}}, 'HeadObject')
+
+        class Object(object):
+            def initiate_multipart_upload(self, ContentType):
+                bucket.uploads.append(key)
+                bucket.pending.append(FakeUpload(bucket, key))
+                return bucket.pending[-1]
+
+            @property
+            def e_tag(self):
+                missing()
+                return bucket.etags[key]
+
+            def get(self):
+                missing()
+                return {'Body': StringIO(bucket.objects[key])}
+        return Object()
+
+
+class TestPackageWriter(object):
+
+    def releases(self):
+        ten = TestReleaseBuilder().prepare_tender()
+        ten['patches'] = deepcopy(TestReleaseBuilder.patches)
+        return release_tenders(ten, modelsMap, callbacks, 'test')
+
+    def test_sinks(self, tmpdir):
+        releases = self.releases()
+        package = {'uri': 'test', 'publishedDate': '2017-01-01'}
+        bucket = FakeBucket()
+        archive = str(tmpdir.join('releases.zip'))
+        writer = PackageWriter(package, 'releases', [
+            FileSink(str(tmpdir.join('package.json'))),
+            ZipSink(archive, 'release-0000001.json'),
+            S3Sink(bucket, 'small'),
+            S3Sink(bucket, 'multipart', part_size=1024),
+        ])
+        writer.write_items(releases)
+        writer.close()
+        expected = dict(package, releases=releases)
+        assert simplejson.loads(tmpdir.join('package.json').read()) == expected
+        with zipfile.ZipFile(archive) as zf:
+            assert simplejson.loads(zf.read('release-0000001.json')) == expected
+        assert simplejson.loads(bucket.objects['small']) == expected
+        assert simplejson.loads(bucket.objects['multipart']) == expected
+        assert bucket.uploads == ['multipart']
+
+    def test_abort(self, tmpdir):
+        bucket = FakeBucket()
+        writer = PackageWriter({}, 'records', [S3Sink(bucket, 'key', part_size=10)])
+        writer.write({'ocid': 'test'})
+        writer.abort()
+        assert bucket.aborted == ['key']
+        assert not bucket.objects
+
+
+class RegistryTest(object):
+    """restores `packages.REGISTRY` changed by a test"""
+
+    def setup_method(self, method):
+        self.registry = dict(packages.REGISTRY)
+
+    def teardown_method(self, method):
+        packages.REGISTRY.clear()
+        packages.REGISTRY.update(self.registry)
+
+
+class TestConvertTenders(RegistryTest):
+
+    def tenders(self):
+        for index in range(5):
+            ten = TestReleaseBuilder().prepare_tender()
+            ten['id'] = 'tender{}'.format(index)
+            ten['patches'] = deepcopy(TestReleaseBuilder.patches)
+            yield ten
+
+    def test_workers(self):
+        packages.REGISTRY.update({'config': {'release': config}, 'record': True, 'cache': None})
+        inline = list(packages.convert_tenders(self.tenders()))
+        pool = packages.make_pool(2, {'release': config}, True)
+        try:
+            pooled = list(packages.convert_tenders(self.tenders(), pool, batch_size=2))
+        finally:
+            pool.terminate()
+            pool.join()
+        assert [t['id'] for t, _ in pooled] == ['tender{}'.format(i) for i in range(5)]
+        assert simplejson.dumps([c for _, c in pooled]) == simplejson.dumps([c for _, c in inline])
+
+
+class TestPipeline(object):
+
+    def test_stages(self):
+        numbers, squares, jobs = Queue(2), Queue(2), Queue(2)
+        bucket = FakeBucket()
+        sink = S3Sink(bucket, 'squares', part_size=8, jobs=jobs)
+        results = []
+        write = Stage('write', squares, func=sink.write,
+                      on_end=lambda: results.append(sink.close()), ends=[jobs])
+        stages = [
+            Source('read', iter(range(20)), numbers, threaded=True),
+            Stage('square', numbers, func=lambda x: '{},'.format(x * x),
+                  outbox=squares),
+            write,
+            Stage('upload', jobs, func=run_job, concurrency=3),
+        ]
+        Pipeline(stages).run()
+        results[0].get()
+        expected = ''.join('{},'.format(x * x) for x in range(20))
+        assert bucket.objects['squares'] == expected
+        assert bucket.uploads == ['squares']
+        assert [stage.items for stage in stages] == [20, 20, 20, len(sink.parts) + 2]
+        assert 0 <= write.utilisation() <= 1
+
+    def test_error(self):
+        numbers = Queue(2)
+
+        def fail(x):
+            if x == 3:
+                raise ValueError(x)
+        stages = [
+            Source('read', iter(range(10)), numbers),
+            Stage('fail', numbers, func=fail, concurrency=2, threaded=True),
+        ]
+        with pytest.raises(ValueError):
+            Pipeline(stages).run()
+
+
+class TestUploader(object):
+
+    def archive(self, tmpdir):
+        path = tmpdir.join('releases.zip')
+        path.write_binary(os.urandom(2500))
+        return str(path)
+
+    def test_upload_file(self, tmpdir):
+        bucket = FakeBucket()
+        bucket.failures = 2
+        path = self.archive(tmpdir)
+        uploader = Uploader(bucket, concurrency=2, part_size=1000, backoff=0)
+        uploader.upload_file(path, 'releases.zip')
+        assert bucket.objects['releases.zip'] == open(path, 'rb').read()
+        assert uploader.retried == 2
+        assert uploader.sent == 2500
+        assert not bucket.pending
+
+    def test_resume(self, tmpdir):
+        bucket = FakeBucket()
+        bucket.failures = 1
+        path = self.archive(tmpdir)
+        failing = Uploader(bucket, concurrency=1, part_size=1000, retries=0)
+        with pytest.raises(IOError):
+            failing.upload_file(path, 'releases.zip')
+        failing.pool.join()
+        assert 'releases.zip' not in bucket.objects
+        uploader = Uploader(bucket, part_size=1000, backoff=0)
+        uploader.upload_file(path, 'releases.zip')
+        assert bucket.objects['releases.zip'] == open(path, 'rb').read()
+        assert bucket.uploads == ['releases.zip']
+        assert (uploader.sent, uploader.resumed) == (1000, 1500)
+
+    def test_small(self, tmpdir):
+        bucket = FakeBucket()
+        path = self.archive(tmpdir)
+        Uploader(bucket).upload_file(path, 'releases.zip')
+        assert bucket.objects['releases.zip'] == open(path, 'rb').read()
+        assert not bucket.uploads
+
+
+class TestUploadPlanner(object):
+
+    def upload(self, bucket, date, releases):
+        planner = UploadPlanner.load(Uploader(bucket, part_size=1024))
+        package = {'uri': date, 'publishedDate': date}
+        writer = PackageWriter(package, 'releases', [
+            PlannedSink(planner, 'merged/release-0000001.json',
+                        'merged_{}/release-0000001.json'.format(date))
+        ])
+        writer.write_items(releases)
+        for result in writer.close():
+            result.get()
+        planner.save()
+        return planner
+
+    def test_unchanged(self):
+        releases = TestPackageWriter().releases()
+        bucket = FakeBucket()
+
+        def package(date):
+            return simplejson.loads(bucket.objects['merged_{}/release-0000001.json'.format(date)])
+        first = self.upload(bucket, '2017-01-01', releases)
+        assert first.saved == 0 and first.copied == 0
+        assert bucket.uploads == ['merged_2017-01-01/release-0000001.json']
+        entry = first.manifest['merged/release-0000001.json']
+        assert entry['size'] > 3 * 1024
+        # the header of an unchanged package is uploaded, the rest copied
+        for previous, date in [('2017-01-01', '2017-01-08'), ('2017-01-08', '2017-01-08T12:00')]:
+            second = self.upload(bucket, date, releases)
+            assert second.copied == 1 and second.saved == entry['size'] - 1024 + 2 * (len(date) - 10)
+            assert package(date) == {'uri': date, 'publishedDate': date, 'releases': releases}
+            key = 'merged_{}/release-0000001.json'.format(date)
+            assert bucket.copies[-1] == ('merged_{}/release-0000001.json'.format(previous), key)
+            assert bucket.etags[key] == second.manifest['merged/release-0000001.json']['etag']
+        rerun = self.upload(bucket, '2017-01-01', releases)
+        assert (rerun.copied, rerun.skipped) == (0, 1)
+        changed = self.upload(bucket, '2017-01-15', releases[:-1])
+        assert changed.saved == 0 and changed.copied == 0
+        assert bucket.uploads[-1] == 'merged_2017-01-15/release-0000001.json'
+        assert package('2017-01-15')['releases'] == releases[:-1]
+
+
+class TestDeltaExport(RegistryTest):
+
+    def test_chain(self):
+        packages.REGISTRY.update({'config': {}, 'bucket': FakeBucket(), 'uploader': None,
+                                  'max_date': '2017-01-08'})
+        assert packages.read_exports() is None
+        packages.record_export(None, 10, 3)
+        exports = packages.read_exports()
+        assert exports['full']['packages'] == 3
+        assert exports['full']['releases'][0] == 'http://fake/merged_2017-01-08/releases.json'
+        packages.REGISTRY['max_date'] = packages.delta_name('2017-01-09T12:30:15.123456+02:00')
+        assert packages.REGISTRY['max_date'] == 'delta_2017-01-09T123015'
+        packages.record_export(exports, 25, 1)
+        exports = packages.read_exports()
+        assert exports['seq'] == 25
+        assert exports['deltas'] == [{
+            'name': 'delta_2017-01-09T123015',
+            'packages': 1,
+            'since': 10,
+            'seq': 25,
+            'releases': [
+                'http://fake/merged_delta_2017-01-09T123015/releases.json',
+                'http://fake/merged_with_extensions_delta_2017-01-09T123015/releases.json',
+            ]
+        }]
+
+    def test_changed_since(self):
+        # a historical tender changed by its patches only, saved after a
+        # later modified one
+        feed = [
+            {'seq': 11, 'id': 'later', 'doc': {'id': 'later', 'dateModified': '2017-02'}},
+            {'seq': 12, 'id': 'historical', 'doc': {
+                'id': 'historical', 'dateModified': '2017-01', 'patches': [[]]}},
+            {'seq': 13, 'id': 'gone', 'deleted': True},
+            {'seq': 14, 'id': 'later', 'doc': {'id': 'later', 'dateModified': '2017-03'}},
+        ]
+        requests = []
+
+        def changes(since, limit, **options):
+            requests.append(since)
+            results = [change for change in feed if change['seq'] > since][:limit]
+            return {'results': results,
+                    'last_seq': results[-1]['seq'] if results else since}
+
+        storage = TendersStorage.__new__(TendersStorage)
+        storage.changes = changes
+        tenders = list(storage.get_changed_since(10, batch=2))
+        assert [t['id'] for t in tenders] == ['later', 'historical']
+        assert tenders[0]['dateModified'] == '2017-02'
+        assert requests == [10, 12, 14]
+
+
+class TestFollower(RegistryTest):
+
+    def test_checkpoint(self, tmpdir):
+        bucket = FakeBucket()
+        packages.REGISTRY.update({
+            'config': {'release': config, 'bucket': 'fake'}, 'bucket': bucket,
+            'uploader': None, 'record': False, 'cache': None,
+            'contracts_storage': None, 'max_date': 'live'
+        })
+        checkpoint = Checkpoint(str(tmpdir.join('follow.json')))
+        follower = Follower(checkpoint, max_tenders=2)
+        first = TestReleaseBuilder().prepare_tender()
+        first['id'] = 'first'
+        follower.add({'seq': 1, 'id': 'first', 'doc': deepcopy(first)})
+        first['title'] = 'changed'
+        follower.add({'seq': 2, 'id': 'first', 'doc': first})
+        follower.add({'seq': 3, 'id': 'gone', 'deleted': True})
+        assert list(follower.pending) == ['first'] and not follower.due()
+        # a tender failing to convert is recorded and the feed goes on
+        follower.add({'seq': 4, 'id': 'bad', 'doc': {'id': 'bad', 'history': [{}]}})
+        assert list(follower.pending) == ['first'] and follower.seq == 4
+        second = TestReleaseBuilder().prepare_tender()
+        second['id'] = 'second'
+        follower.add({'seq': 5, 'id': 'second', 'doc': second})
+        assert follower.due()
+        follower.publish()
+        assert checkpoint.load() == {'last_seq': 5, 'packages': 1, 'failed': ['bad']}
+        assert not follower.pending and follower.timeout() is None
+        package = simplejson.loads(bucket.objects['merged_live/release-0000001.json'])
+        assert package['uri'] == 'http://fake/merged_live/release-0000001.json'
+        assert [r['tender']['title'] for r in package['releases']] == [
+            'changed', second['title']]
+        assert 'merged_with_extensions_live/release-0000001.json' in bucket.objects
+        resumed = Follower(checkpoint)
+        assert (resumed.seq, resumed.nth) == (5, 1)
+        assert resumed.failed == set(['bad'])
+
+    def test_index(self, tmpdir):
+        bucket = FakeBucket()
+        packages.REGISTRY.update({
+            'config': {'release': config, 'bucket': 'fake'}, 'bucket': bucket,
+            'uploader': None, 'record': False, 'cache': None,
+            'contracts_storage': None, 'max_date': 'live'
+        })
+        follower = Follower(Checkpoint(str(tmpdir.join('follow.json'))), index_size=2)
+        tender = dict(TestReleaseBuilder().prepare_tender(), id='first')
+
+        def index(name):
+            return simplejson.loads(bucket.objects['merged_live/' + name])['links']
+
+        def url(name):
+            return 'http://fake/merged_live/' + name
+        for nth in range(1, 4):
+            follower.add({'seq': nth, 'id': tender['id'], 'doc': deepcopy(tender)})
+            follower.publish()
+            if nth == 2:
+                assert index('releases-0001.json') == index('releases.json')
+        assert index('releases-0001.json') == {'all': [
+            url('release-0000001.json'), url('release-0000002.json')]}
+        assert index('releases.json') == {'all': [url('release-0000003.json')],
+                                          'prev': url('releases-0001.json')}
+        assert 'merged_live/releases-0002.json' not in bucket.objects
+        assert 'merged_with_extensions_live/releases.json' in bucket.objects
+
+
+class TestJoinContracts(object):
+
+    class Contracts(object):
+
+        def __init__(self):
+            self.requests = []
+
+        def get_contracts_by_ten_ids(self, tender_ids):
+            self.requests.append(tender_ids)
+            return {
+                tender_id: [{'id': 'contract-{}'.format(tender_id)}]
+                for tender_id in tender_ids if tender_id % 2
+            }
+
+    def test_batches(self):
+        contracts = self.Contracts()
+        tenders = list(join_contracts(({'id': i} for i in range(5)), contracts, size=2))
+        assert contracts.requests == [[0, 1], [2, 3], [4]]
+        assert [t['id'] for t in tenders] == range(5)
+        assert [t.get('contracts') for t in tenders] == [
+            None, [{'id': 'contract-1'}], None, [{'id': 'contract-3'}], None]
+
+
+class TestConfigure(RegistryTest):
+
+    def test_contracting(self, tmpdir, monkeypatch):
+        opened = []
+
+        def contracts_storage(url, name):
+            opened.append((url, name))
+            return TestJoinContracts.Contracts()
+
+        def tenders_storage(url, name):
+            storage = TendersStorage.__new__(TendersStorage)
+            storage.iterview = lambda name, size, **options: [
+                FakeRow(tender_id, {'id': tender_id}) for tender_id in range(3)]
+            return storage
+        monkeypatch.setattr(packages, 'ContractsStorage', contracts_storage)
+        monkeypatch.setattr(packages, 'TendersStorage', tenders_storage)
+        handlers = list(packages.LOGGER.handlers)
+        try:
+            packages.configure({
+                'log_dir': str(tmpdir), 'bucket': 'fake', 'path_can': '', 'path_ext': '',
+                'tenders_db': {'url': 'http://couch', 'name': 'tenders'},
+                'contracts_db': {'url': 'http://couch', 'name': 'contracts'},
+            }, contracting=True)
+        finally:
+            packages.LOGGER.handlers = handlers
+        assert opened == [('http://couch', 'contracts')]
+        tenders = packages.REGISTRY['tenders_storage'].get_tender(
+            packages.REGISTRY['contracts_storage'])
+        assert [t.get('contracts') for t in tenders] == [
+            None, [{'id': 'contract-1'}], None]
+
+
+class FakeRow(object):
+
+    def __init__(self, key, doc):
+        self.key = key
+        self.id = doc['id']
+        self.doc = doc
+
+
+class FakeViewDb(object):
+    """rows of a view ordered by key and document id"""
+
+    def __init__(self, docs, key='id'):
+        self.rows = sorted(
+            (FakeRow(doc[key], doc) for doc in docs),
+            key=lambda row: (row.key, row.id))
+        self.limits = []
+
+    def view(self, name, startkey=None, startkey_docid=None, endkey=None,
+             inclusive_end=True, limit=None, **options):
+        self.limits.append(limit)
+        rows = [
+            row for row in self.rows
+            if (startkey is None or (row.key, row.id) >= (startkey, startkey_docid or ''))
+            and (endkey is None or row.key < endkey or inclusive_end and row.key == endkey)
+        ]
+        return rows[:limit]
+
+
+class TestRangeScanner(object):
+
+    docs = [{'id': '{:04x}'.format(i * 997 % 65536), 'dateModified': '2017-01-{:02d}'.format(i % 28 + 1)}
+            for i in range(200)]
+
+    def test_order(self):
+        db = FakeViewDb(self.docs)
+        scanner = RangeScanner(db, 'tenders/all', id_boundaries(4), page=7)
+        assert [doc['id'] for doc in scanner] == sorted(doc['id'] for doc in self.docs)
+        assert scanner.docs == 200
+
+    def test_readers(self):
+        db = FakeViewDb(self.docs)
+        scanner = RangeScanner(db, 'tenders/all', id_boundaries(16), readers=3,
+                               prefetch=2, buffer=3, page=4, min_page=4, max_page=4)
+        ids = []
+        for doc in scanner:
+            ids.append(doc['id'])
+            assert scanner.buffered <= scanner.buffer + scanner.prefetch
+        assert ids == sorted(doc['id'] for doc in self.docs)
+        assert scanner.pool.size == 0
+
+    def test_dates(self):
+        db = FakeViewDb(self.docs, key='dateModified')
+        boundaries = date_boundaries('2017-01-05', '2017-01-20', 3)
+        assert len(boundaries) == 2
+        scanner = RangeScanner(db, 'tenders/by_dateModified_pack', boundaries,
+                               startkey='2017-01-05', endkey='2017-01-20', page=3)
+        expected = [row.id for row in db.rows if '2017-01-05' <= row.key <= '2017-01-20']
+        assert [doc['id'] for doc in scanner] == expected
+
+    def test_page_size(self):
+        db = FakeViewDb(self.docs)
+        scanner = RangeScanner(db, 'tenders/all', [], page=10, min_page=5,
+                               page_bytes=1000)
+        list(scanner)
+        size = len(simplejson.dumps(self.docs[0]))
+        assert db.limits[0] == 11
+        assert db.limits[1] == 1000 // size + 1
+
+    def test_prepare(self):
+        db = FakeViewDb(self.docs)
+        pages = []
+
+        def prepare(docs):
+            pages.append(len(docs))
+            return [dict(doc, prepared=True) for doc in docs]
+        scanner = RangeScanner(db, 'tenders/all', id_boundaries(2), page=50,
+                               prepare=prepare)
+        assert all(doc['prepared'] for doc in scanner)
+        assert sum(pages) == 200
+
+    def test_error(self):
+        db = FakeViewDb(self.docs)
+
+        def prepare(docs):
+            raise ValueError('failed')
+        with pytest.raises(ValueError):
+            list(RangeScanner(db, 'tenders/all', id_boundaries(2), prepare=prepare))
+
+
+class TestModifiedIndex(object):
+
+    class Storage(object):
+
+        def __init__(self, dates):
+            self.dates = dates
+            self.requests = []
+
+        def rows(self, ids):
+            return [FakeRow(i, {'id': i}) for i in ids if i in self.dates]
+
+        def iterview(self, name, batch):
+            for row in self.rows(sorted(self.dates)):
+                row.value = self.dates[row.id]
+                yield row
+
+        def view(self, name, keys):
+            self.requests.append(keys)
+            rows = self.rows(keys)
+            for row in rows:
+                row.value = self.dates[row.id]
+            return rows
+
+    def test_filter(self):
+        storage = self.Storage({'a': '2017-01-01', 'b': '2017-01-02'})
+        index = ModifiedIndex(storage)
+        index.load()
+        storage.dates['c'] = '2017-01-03'
+        items = [
+            {'id': 'a', 'dateModified': '2017-01-01'},
+            {'id': 'b', 'dateModified': '2017-01-05'},
+            {'id': 'c', 'dateModified': '2017-01-03'},
+            {'id': 'd', 'dateModified': '2017-01-04'},
+        ]
+        assert [i['id'] for i in index.filter(items)] == ['b', 'd']
+        assert storage.requests == [['c', 'd']]
+        index.update({'id': 'd', 'dateModified': '2017-01-04'})
+        assert index.filter(items[2:]) == []
+        assert storage.requests == [['c', 'd']]
+        assert index.hits == 4 and index.misses == 2
+        assert index.size() > 0
+
+
+class TestBulkWriter(object):
+
+    class Db(object):
+
+        def __init__(self, revs, conflicts=()):
+            self.revs = revs
+            self.conflicts = list(conflicts)
+            self.lookups = []
+            self.updates = []
+
+        def view(self, name, keys):
+            self.lookups.append(keys)
+            return [
+                Row(key=key, value={'rev': self.revs[key]}) if key in self.revs
+                else Row(key=key, error='not_found')
+                for key in keys
+            ]
+
+        def update(self, docs):
+            self.updates.append([doc['_id'] for doc in docs])
+            results = []
+            for doc in docs:
+                if doc['_id'] in self.conflicts or doc.get('_rev') != self.revs.get(doc['_id']):
+                    if doc['_id'] in self.conflicts:
+                        self.conflicts.remove(doc['_id'])
+                    results.append((False, doc['_id'], ResourceConflict('conflict')))
+                    continue
+                rev = '{}-x'.format(int(doc.get('_rev', '0-x').split('-')[0]) + 1)
+                self.revs[doc['_id']] = rev
+                results.append((True, doc['_id'], rev))
+            return results
+
+    def writer(self, db, queue, **kwargs):
+        saved = []
+        writer = BulkWriter(db, queue, prepare=lambda doc: dict(doc, _id=doc['id']),
+                            on_saved=saved.append, **kwargs)
+        return writer, saved
+
+    def test_batches(self):
+        queue = Queue()
+        for i in range(5):
+            queue.put({'id': str(i)})
+        queue.put({'id': '1', 'title': 'later'})
+        db = self.Db({'1': '1-x'})
+        writer, saved = self.writer(db, queue, max_docs=3, interval=0.01)
+        first = writer.batch()
+        assert [doc['_id'] for doc in first] == ['0', '1', '2']
+        writer.write(first)
+        second = writer.batch()
+        assert [doc['_id'] for doc in second] == ['3', '4', '1']
+        assert second[-1]['title'] == 'later'
+        writer.write(second)
+        assert db.revs['1'] == '3-x'
+        assert db.lookups == [['0', '1', '2'], ['3', '4']]
+        assert len(saved) == 6
+
+    def test_done(self):
+        queue = Queue()
+        items = [{'id': 'a'}, {'id': 'b'}, {'id': 'a', 'title': 'later'}]
+        for item in items:
+            queue.put(item)
+        done = []
+        writer, saved = self.writer(self.Db({}), queue, interval=0.01,
+                                    on_done=done.append)
+        runner = gevent.spawn(writer.run)
+        gevent.sleep(0.05)
+        runner.kill()
+        assert [doc['_id'] for doc in saved] == ['b', 'a']
+        assert done == items and writer.items == []
+
+    def test_conflicts(self):
+        db = self.Db({'a': '1-x'}, conflicts=['a'])
+        writer, saved = self.writer(db, Queue())
+        writer.write([{'_id': 'a'}, {'_id': 'b'}])
+        assert db.updates == [['a', 'b'], ['a']]
+        assert writer.conflicts == 1 and writer.saved == 2
+        db.conflicts = ['c'] * 10
+        writer.write([{'_id': 'c'}])
+        assert writer.failed == 1
+
+
+class TestRevisions(object):
+
+    class Client(object):
+
+        def __init__(self, failing, errors):
+            self.failing = failing
+            self.errors = errors
+
+        def get_tender(self, tender_id, version=''):
+            if not version:
+                return '5', {'id': tender_id, 'revision': 5}
+            if self.failing.get(version):
+                self.failing[version] -= 1
+                return '', {}
+            if self.errors.get(version):
+                self.errors[version] -= 1
+                raise ConnectionError(version)
+            # later revisions come first
+            gevent.sleep(0.001 * (5 - int(version)))
+            return version, {'id': tender_id, 'revision': int(version)}
+
+    class Retreiver(object):
+
+        def __init__(self):
+            self.done_items = []
+
+        def done(self, page):
+            self.done_items.append(page)
+
+    def bridge(self, failing, errors=None):
+        bridge = APIDataBridge.__new__(APIDataBridge)
+        bridge.client = self.Client(failing, errors or {})
+        bridge.index = ModifiedIndex(None)
+        bridge.tenders_queue = Queue()
+        bridge.revision_concurrency = 3
+        bridge.revision_retries = 1
+        bridge.revision_backoff = 0
+        bridge.controller = FetchController(Queue(), Queue())
+        bridge.revisions = bridge.revisions_retried = 0
+        bridge.prepare_pached = lambda revisions, version, first: revisions
+        return bridge
+
+    def test_order(self):
+        bridge = self.bridge({'3': 1})
+        revisions = bridge.fetch_tender_versioned({'id': 'a'})
+        assert [r['revision'] for r in revisions] == [1, 2, 3, 4, 5]
+        assert bridge.revisions == 4 and bridge.revisions_retried == 1
+
+    def test_failed(self):
+        bridge = self.bridge({'2': 2})
+        assert bridge.fetch_tender_versioned({'id': 'a'}) is None
+
+    def test_errors(self):
+        bridge = self.bridge({}, errors={'2': 1, '4': 1})
+        revisions = bridge.fetch_tender_versioned({'id': 'a'})
+        assert [r['revision'] for r in revisions] == [1, 2, 3, 4, 5]
+        assert bridge.revisions_retried == 2
+
+    def test_skipped(self, tmpdir):
+        bridge = self.bridge({}, errors={'2': 2})
+        bridge.historical = True
+        bridge.in_flight = bridge.fetched = 0
+        bridge.latencies = deque(maxlen=10)
+        bridge.fetch_queue = Queue()
+        bridge.retreiver = self.Retreiver()
+        bridge.skipped_checkpoint = Checkpoint(str(tmpdir.join('skipped.json')))
+        bridge.skipped, bridge.saved_skipped, bridge.retrying = set(), set(), set()
+        bridge.fetch_item('page', {'id': 'a'})
+        assert bridge.skipped == set(['a']) and bridge.tenders_queue.empty()
+        assert bridge.retreiver.done_items == ['page']
+        bridge.save_skipped()
+        assert bridge.skipped_checkpoint.load() == {'ids': ['a']}
+        bridge.retry_skipped()
+        bridge.retry_skipped()
+        assert bridge.fetch_queue.qsize() == 1
+        page, feed_item = bridge.fetch_queue.get()
+        bridge.fetch_item(page, feed_item)
+        page, revisions = bridge.tenders_queue.get()
+        assert page is None and len(revisions) == 5
+        assert not bridge.skipped and not bridge.retrying
+        assert bridge.retreiver.done_items == ['page']
+        bridge.save_skipped()
+        assert bridge.skipped_checkpoint.load() == {'ids': []}
+
+
+class TestHistory(object):
+
+    def revisions(self, count):
+        return [
+            {'id': 'a', 'title': 'revision {}'.format(i), 'items': range(i % 4)}
+            for i in range(count)
+        ]
+
+    def test_compaction(self):
+        revisions = self.revisions(7)
+        doc = dict(revisions[0], _id='a', doc_type='Tender', patches=[])
+        segments = {}
+        for revision in revisions[1:]:
+            doc['patches'].append(jsonpatch.make_patch(latest(doc), revision).patch)
+            doc = compact(doc, every=2)
+            assert latest(doc) == revision
+            for name, attachment in doc.get('_attachments', {}).items():
+                segments[name] = attachment['data'].decode('base64')
+        assert [e['revision'] for e in doc['history']] == [0, 2, 4]
+        assert len(doc['patches']) == 0
+        assert doc['title'] == 'revision 6' and doc['doc_type'] == 'Tender'
+        storage = TendersStorage.__new__(TendersStorage)
+        storage.get_attachment = lambda tender, name: StringIO(segments[name])
+        untouched = {'id': 'b', 'patches': []}
+        restored, other = storage.restore_history([doc, untouched])
+        assert other is untouched
+        assert 'history' not in restored and '_attachments' not in restored
+        assert restored['title'] == 'revision 0' and len(restored['patches']) == 6
+        assert list(replay_patches(revisions[0], restored['patches'])) == revisions[1:]
+
+
+class TestLatestStates(object):
+
+    class Db(object):
+
+        def __init__(self, docs):
+            self.docs = docs
+            self.reads = 0
+
+        def get(self, doc_id):
+            self.reads += 1
+            return deepcopy(self.docs[doc_id])
+
+    def test_lru(self):
+        states = LatestStates(size=2)
+        for doc_id in 'abc':
+            states.put({'id': doc_id}, {})
+        assert states.get('a') is None
+        assert states.get('b')[0] == {'id': 'b'}
+        states.put({'id': 'd'}, {})
+        assert states.get('c') is None and states.get('b')
+        doc = states.get('d')[0]
+        states.discard({'id': 'd'})
+        assert states.get('d')
+        states.discard(doc)
+        assert states.get('d') is None
+
+    def test_updates(self):
+        stored = {'id': 'a', '_id': 'a', 'version': '2', 'title': 'one',
+                  'patches': [[{'op': 'replace', 'path': '/title', 'value': 'two'}]]}
+        bridge = APIDataBridge.__new__(APIDataBridge)
+        bridge._db = self.Db({'a': stored})
+        bridge.latest = LatestStates()
+        bridge.compact_every = 100
+        for version, title in [('3', 'three'), ('4', 'four')]:
+            doc = bridge.prepare_pached([{'id': 'a', 'title': title}], version,
+                                        bridge.stored('a'))
+        assert bridge._db.reads == 1
+        assert doc['version'] == '4' and doc['title'] == 'one'
+        assert apply_patches({'id': 'a', 'title': 'one'}, doc['patches']) == {
+            'id': 'a', 'title': 'four'}
+
+
+class TestFetchController(object):
+
+    def controller(self):
+        return FetchController(Queue(10), Queue(10), workers_min=2,
+                               workers_max=4, pace_min=1, pace_max=8,
+                               latency_max=1.0, error_max=0.1)
+
+    def test_backlog(self):
+        controller = self.controller()
+        assert controller.adjust()['workers'] == 3
+        assert controller.pace == 4
+        for _ in range(8):
+            controller.backlog.put([])
+        for _ in range(3):
+            metrics = controller.adjust()
+        assert metrics['workers'] == 4 and metrics['backlog'] == 80
+
+    def test_overload(self):
+        controller = self.controller()
+        controller.adjust()
+        controller.observe(200, 0.1)
+        controller.observe(429, 0.1)
+        assert controller.delay == 0.1
+        metrics = controller.adjust()
+        assert metrics['errors'] == 0.5
+        assert metrics['workers'] == 2 and metrics['pace'] == 8
+        controller.observe(200, 0.1)
+        assert round(controller.delay, 3) == 0.08
+        for _ in range(8):
+            controller.output.put({})
+        controller.backlog.put([])
+        controller.responses.clear()
+        assert controller.adjust()['saving'] == 80
+        assert controller.workers == 2
+
+
+class TestStreamingFetch(object):
+
+    class Retreiver(object):
+
+        commits = 0
+
+        def __init__(self):
+            self.done_items = []
+
+        def done(self, page):
+            self.done_items.append(page)
+
+        def commit(self):
+            self.commits += 1
+
+    class Client(object):
+
+        def get_tender(self, tender_id, version=''):
+            if tender_id == 'slow':
+                gevent.sleep(0.2)
+            if tender_id == 'broken':
+                raise ValueError(tender_id)
+            return '1', {'id': tender_id}
+
+    def test_stream(self, tmpdir):
+        bridge = APIDataBridge.__new__(APIDataBridge)
+        bridge.client = self.Client()
+        bridge.historical = False
+        bridge.tenders_queue = Queue()
+        bridge.fetch_queue = Queue()
+        bridge.controller = FetchController(bridge.fetch_queue, bridge.tenders_queue,
+                                            workers_min=2, workers_max=2)
+        bridge.in_flight = bridge.fetched = 0
+        bridge.latencies = deque(maxlen=10)
+        bridge.fetchers = {}
+        bridge.writer = BulkWriter(None, bridge.tenders_queue)
+        bridge.retreiver = self.Retreiver()
+        bridge.skipped_checkpoint = Checkpoint(str(tmpdir.join('skipped.json')))
+        bridge.skipped, bridge.saved_skipped, bridge.retrying = set(), set(), set()
+        supervisor = gevent.spawn(bridge.fetch_workers)
+        for tender_id in ['slow', 'broken', 'a', 'b', 'c']:
+            bridge.fetch_queue.put(('page', {'id': tender_id}))
+        gevent.sleep(0.05)
+        assert [bridge.tenders_queue.get()[1]['id'] for _ in range(3)] == ['a', 'b', 'c']
+        assert bridge.in_flight == 1
+        assert bridge.retreiver.done_items == ['page']
+        assert bridge.skipped == set(['broken'])
+        assert bridge.tenders_queue.get() == ('page', {'id': 'slow'})
+        bridge.report_fetch()
+        assert bridge.fetched == 4 and len(bridge.latencies) == 5
+        gevent.sleep(1.1)
+        assert bridge.retreiver.commits == 2
+        assert bridge.skipped_checkpoint.load() == {'ids': ['broken']}
+        supervisor.kill()
+        gevent.killall(bridge.fetchers.values())
+
+
+class TestFeedCursor(object):
+
+    class Client(object):
+
+        def __init__(self, cookies, requests):
+            self.session = type('Session', (object,), {'cookies': cookies})()
+            self.requests = requests
+
+        def get_tenders(self, params):
+            self.requests.append(dict(params))
+            offset = params['offset']
+            if params.get('descending'):
+                if offset == 'b2':
+                    return {'data': [], 'next_page': {'offset': 'b3'}}
+                return {'data': [{'id': offset}], 'next_page': {'offset': 'b2'}}
+            return {'data': [{'id': offset}], 'next_page': {'offset': offset + '+'}}
+
+    def test_resume(self, tmpdir, monkeypatch):
+        requests = []
+        cookies = RequestsCookieJar()
+        cookies['SERVER_ID'] = 'fresh'
+
+        def clients(*args):
+            return cookies, self.Client(cookies, requests), self.Client(cookies, requests)
+        monkeypatch.setattr(feed, 'get_retreive_clients', clients)
+        checkpoint = Checkpoint(str(tmpdir.join('feed.json')))
+        checkpoint.save({'cookies': {'SERVER_ID': 'saved'}, 'forward': 'f1',
+                         'backward': 'b1', 'backward_done': False})
+        retreiver = APIRetreiver({}, checkpoint=checkpoint, pause=lambda: 10)
+        pages = iter(retreiver)
+        read = dict((page.name, page) for page in [next(pages), next(pages)])
+        assert read['forward'][0]['id'] == 'f1' and read['backward'][0]['id'] == 'b1'
+        gevent.sleep(0.01)
+        assert dict(cookies) == {'SERVER_ID': 'saved'}
+        assert sorted(r['offset'] for r in requests) == ['b1', 'f1']
+        # committed only past the pages with all items stored
+        retreiver.done(read['forward'])
+        retreiver.commit()
+        assert checkpoint.load() == {'cookies': {'SERVER_ID': 'saved'}, 'forward': 'f1+',
+                                     'backward': 'b1', 'backward_done': False}
+        retreiver.done(read['backward'])
+        retreiver.commit()
+        assert checkpoint.load() == {'cookies': {'SERVER_ID': 'saved'}, 'forward': 'f1+',
+                                     'backward': 'b2', 'backward_done': False}
+        retreiver.read['backward_done'] = True
+        retreiver._restart()
+        assert retreiver.workers[1].get() == 1
+        gevent.sleep(0.01)
+        assert requests[-1] == {'feed': 'changes', 'offset': 'f1+'}
+        gevent.killall(retreiver.workers)
+
+    def test_cookies_changed(self):
+        session = type('Session', (object,), {'cookies': RequestsCookieJar()})()
+        session.cookies['SERVER_ID'] = 'a'
+        assert not cookies_changed(session, {'SERVER_ID': 'a'})
+        session.cookies.set('SERVER_ID', 'b', domain='example.com')
+        assert cookies_changed(session, {'SERVER_ID': 'a'})
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""Parallel uploads of packages and archives to S3.
+
+Requests of an `Uploader` run in its own gevent thread pool, so at most
+`concurrency` of them are in flight at a time. Failed requests are
+retried with exponential backoff. Files are sent as multipart uploads
+with their parts sent in parallel. When an upload of a file fails, it
+is not aborted: the next `upload_file` of the same key resumes it and
+does not send again the parts already stored with the same content.
+"""
+import os
+import logging
+from hashlib import md5
+from time import sleep
+from threading import Lock
+from botocore.exceptions import BotoCoreError, ClientError
+from gevent.threadpool import ThreadPool
+
+
+logger = logging.getLogger(__name__)
+# errors of requests worth retrying
+ERRORS = (BotoCoreError, ClientError, EnvironmentError)
+# client errors worth retrying: timeouts and throttling
+RETRIED_STATUSES = (408, 429)
+
+
+def retryable(error):
+    """if a request failed with `error` may succeed when repeated"""
+    if not isinstance(error, ClientError):
+        return True
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 500)
+    return status >= 500 or status in RETRIED_STATUSES
+
+
+class Uploader(object):
+    """uploads to a boto3 `bucket` with at most `concurrency` requests"""
+
+    def __init__(self, bucket, concurrency=4, part_size=8 * 1024 ** 2,
+                 retries=3, backoff=1.0):
+        self.bucket = bucket
+        self.concurrency = concurrency
+        self.part_size = part_size
+        self.retries = retries
+        self.backoff = backoff
+        self.pool = ThreadPool(concurrency)
+        self.requests = self.retried = 0
+        self.sent = self.resumed = 0
+        self.lock = Lock()
+
+    def _count(self, name, value=1):
+        # counters are updated from threads of the pool
+        with self.lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def _retry(self, func, args, kwargs):
+        for attempt in range(self.retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except ERRORS as e:
+                if attempt == self.retries or not retryable(e):
+                    raise
+                self._count('retried')
+                logger.warning('Retrying S3 request: {}'.format(e))
+                sleep(self.backoff * 2 ** attempt)
+
+    def spawn(self, func, args=(), kwargs=None):
+        """starts `func` in the pool, returns its `AsyncResult`
+
+        Waits for a free thread of the pool first.
+        """
+        kwargs = kwargs or {}
+        self._count('requests')
+        self._count('sent', len(kwargs.get('Body') or ''))
+        return self.pool.spawn(self._retry, func, args, kwargs)
+
+    def apply(self, func, args=(), kwargs=None):
+        """calls `func` in the pool and waits for its result"""
+        return self.spawn(func, args, kwargs).get()
+
+    def put(self, key, body, content_type='application/json'):
+        self.apply(self.bucket.put_object, kwargs={
+            'Key': key, 'Body': body, 'ContentType': content_type})
+        logger.info("Successfully uploaded {}".format(key))
+
+    def upload_file(self, path, key, content_type='application/zip'):
+        """uploads the file at `path` to `key`, resuming a failed upload"""
+        size = os.path.getsize(path)
+        if size <= self.part_size:
+            with open(path, 'rb') as stream:
+                return self.put(key, stream.read(), content_type)
+        upload, stored = self.apply(self._unfinished, (key,))
+        if upload is None:
+            upload = self.apply(
+                self.bucket.Object(key).initiate_multipart_upload,
+                kwargs={'ContentType': content_type})
+        results = [
+            self.spawn(self._send_part,
+                       (upload, number, path, offset, stored.get(number)))
+            for number, offset in enumerate(range(0, size, self.part_size), 1)
+        ]
+        parts = [
+            {'ETag': result.get(), 'PartNumber': number}
+            for number, result in enumerate(results, 1)
+        ]
+        self.apply(upload.complete, kwargs={'MultipartUpload': {'Parts': parts}})
+        logger.info("Successfully uploaded {} to {}".format(path, key))
+
+    def upload_head(self, path, key, source, shift, content_type='application/json'):
+        """uploads the first part of the file at `path` to `key` and copies the rest
+
+        Past its first part the file holds the bytes of the object
+        `source` of the bucket `shift` bytes further, which are copied
+        by S3 rather than sent.
+        """
+        size = os.path.getsize(path)
+        upload = self.apply(self.bucket.Object(key).initiate_multipart_upload,
+                            kwargs={'ContentType': content_type})
+        results = [self.spawn(self._send_part, (upload, 1, path, 0, None))] + [
+            self.spawn(self._copy_part, (upload, number, source, offset + shift,
+                                         min(offset + self.part_size, size) - 1 + shift))
+            for number, offset in enumerate(range(self.part_size, size, self.part_size), 2)
+        ]
+        parts = [
+            {'ETag': result.get(), 'PartNumber': number}
+            for number, result in enumerate(results, 1)
+        ]
+        self.apply(upload.complete, kwargs={'MultipartUpload': {'Parts': parts}})
+        logger.info("Uploaded the head of {} to {}, copied the rest from {}".format(
+            path, key, source))
+
+    def _copy_part(self, upload, number, source, first, last):
+        result = upload.Part(number).copy_from(
+            CopySource={'Bucket': self.bucket.name, 'Key': source},
+            CopySourceRange='bytes={}-{}'.format(first, last))
+        return result['CopyPartResult']['ETag']
+
+    def _unfinished(self, key):
+        """the failed multipart upload of `key` and the ETags of its parts"""
+        for upload in self.bucket.multipart_uploads.filter(Prefix=key):
+            if upload.object_key == key:
+                return upload, {
+                    part.part_number: part.e_tag for part in upload.parts.all()
+                }
+        return None, {}
+
+    def _send_part(self, upload, number, path, offset, etag):
+        with open(path, 'rb') as stream:
+            stream.seek(offset)
+            data = stream.read(self.part_size)
+        if etag == '"{}"'.format(md5(data).hexdigest()):
+            self._count('resumed', len(data))
+            return etag
+        etag = upload.Part(number).upload(Body=data)['ETag']
+        self._count('sent', len(data))
+        return etag
+
+    def report(self):
+        logger.info('Uploads: {} requests, {} retried, {} bytes sent,'
+                    ' {} bytes resumed'.format(self.requests, self.retried,
+                                               self.sent, self.resumed))
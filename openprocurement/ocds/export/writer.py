@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""Streaming writer of release and record packages.
+
+A package is written as its header, its releases (or records) one at a
+time and a footer. Every release is serialized once and the bytes are
+passed to all sinks of the package, so neither the package dict nor its
+serialization is ever held in memory as a whole.
+Sinks given a `jobs` queue do not block on S3 requests or archiving:
+these are queued to the upload and archive stages of the pipeline.
+"""
+import os
+import zipfile
+import logging
+from hashlib import md5
+from tempfile import NamedTemporaryFile
+from gevent import spawn
+from simplejson import dumps
+from openprocurement.ocds.export.pipeline import submit
+
+
+logger = logging.getLogger(__name__)
+
+
+class FileSink(object):
+    """writes a package to a local file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.stream = open(path, 'wb')
+
+    def write(self, data):
+        self.stream.write(data)
+
+    def close(self, digest=None):
+        self.stream.close()
+
+    def abort(self):
+        self.stream.close()
+        os.remove(self.path)
+
+
+class ZipSink(object):
+    """writes a package as entry `name` of the zip archive at `path`
+
+    zipfile can not stream an entry, so the package is written to a
+    temporary file next to the archive and deflated into it on close.
+    Entries are appended one at a time, so all sinks of an archive
+    share the same `jobs` queue.
+    """
+
+    def __init__(self, path, name, jobs=None):
+        self.path = path
+        self.name = name
+        self.jobs = jobs
+        self.stream = NamedTemporaryFile(dir=os.path.dirname(path) or None)
+
+    def write(self, data):
+        self.stream.write(data)
+
+    def close(self, digest=None):
+        self.stream.flush()
+        return submit(self.jobs, self.archive)
+
+    def archive(self):
+        with zipfile.ZipFile(self.path, 'a', zipfile.ZIP_DEFLATED,
+                             allowZip64=True) as archive:
+            archive.write(self.stream.name, self.name)
+        self.stream.close()
+        logger.info("{} written to archive {}".format(self.name, self.path))
+
+    def abort(self):
+        self.stream.close()
+
+
+class S3Sink(object):
+    """uploads a package to `key` of a boto3 `bucket`
+
+    Data is sent in parts of `part_size` bytes (S3 requires at least
+    5MB) with a multipart upload. Packages smaller than a part are sent
+    with a single request. With `jobs` parts are uploaded concurrently
+    by the upload stage while the next ones are written.
+    """
+
+    def __init__(self, bucket, key, content_type='application/json',
+                 part_size=8 * 1024 ** 2, jobs=None):
+        self.bucket = bucket
+        self.key = key
+        self.content_type = content_type
+        self.part_size = part_size
+        self.jobs = jobs
+        self.buffer = []
+        self.size = 0
+        self.upload = None
+        self.parts = []
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.part_size:
+            self.flush()
+
+    def flush(self):
+        if self.upload is None:
+            self.upload = submit(
+                self.jobs,
+                self.bucket.Object(self.key).initiate_multipart_upload,
+                ContentType=self.content_type
+            ).get()
+        number = len(self.parts) + 1
+        self.parts.append(submit(self.jobs, self.upload.Part(number).upload,
+                                 Body=''.join(self.buffer)))
+        self.buffer = []
+        self.size = 0
+
+    def close(self, digest=None):
+        """sends the rest of the package
+
+        Returns a result (or greenlet) to wait for the end of the upload.
+        """
+        body = None
+        if self.upload is None:
+            body = ''.join(self.buffer)
+        elif self.buffer:
+            self.flush()
+        self.buffer = []
+        if self.jobs is None:
+            return submit(None, self._complete, body)
+        return spawn(self._complete, body)
+
+    def _complete(self, body):
+        if self.upload is None:
+            submit(self.jobs, self.bucket.put_object, Key=self.key, Body=body,
+                   ContentType=self.content_type).get()
+        else:
+            parts = [
+                {'ETag': result.get()['ETag'], 'PartNumber': number}
+                for number, result in enumerate(self.parts, 1)
+            ]
+            submit(self.jobs, self.upload.complete,
+                   MultipartUpload={'Parts': parts}).get()
+        logger.info("Successfully uploaded {}".format(self.key))
+
+    def abort(self):
+        if self.upload is not None:
+            self.upload.abort()
+        self.buffer = []
+
+
+class PackageWriter(object):
+    """streams `package` with the list `key` of items into `sinks`
+
+    `package` holds the package metadata, items are passed to `write`
+    one at a time. Items may be `RawJSON`, which are written as is.
+    Sinks are closed with the md5 of the items, which unlike the whole
+    package does not depend on the date it was published.
+    """
+
+    def __init__(self, package, key, sinks):
+        self.sinks = sinks
+        self.count = 0
+        self.digest = md5()
+        header = dumps(package)[:-1]
+        if package:
+            header += ', '
+        self._write('{}{}: ['.format(header, dumps(key)))
+
+    def _write(self, data):
+        for sink in self.sinks:
+            sink.write(data)
+
+    def write(self, item):
+        data = dumps(item)
+        self.digest.update(data)
+        self._write(', ' + data if self.count else data)
+        self.count += 1
+
+    def write_items(self, items):
+        for item in items:
+            self.write(item)
+
+    def close(self):
+        """finishes the package, returns the results of closing its sinks"""
+        self._write(']}')
+        digest = self.digest.hexdigest()
+        return [sink.close(digest) for sink in self.sinks]
+
+    def abort(self):
+        for sink in self.sinks:
+            sink.abort()
@@ -32,6 +32,7 @@ entry_points = {
     'console_scripts': [
         'bridge = openprocurement.ocds.export.scripts.run:run',
         'packages = openprocurement.ocds.export.scripts.packages:run',
+        'exporter = openprocurement.ocds.export.scripts.follow:run',
         'releases = openprocurement.ocds.export.scripts.release:run'
     ]
 }